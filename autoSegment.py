@@ -1,48 +1,156 @@
+from collections import namedtuple
+
 import numpy as np
 import pandas as pd
 import mahotas as mh
+from scipy import ndimage
 
-def remove_close_to_edge(labels, img_size=2048):
-    centers = mh.center_of_mass(labels, labels)
+import profiling
+from background import LocalBackground
 
-    # Create numpy array with as many empty items as the number of centers
-    is_close_to_edge = [False] * len(centers)
 
-    for c, pix in enumerate(centers):  # Iterates over all label centers
-        if c == 0:
-            # This is the background region
-            continue
+class LabelSums:
+    """
+    Sums of values over every labeled region of a label image (np.bincount on the foreground pixels).
+    The foreground pixels, their labels and their coordinates are found once and shared by all the sums, so area,
+    centers, intensities and moments of the regions cost one bincount each
+    """
+
+    def __init__(self, labels):
+        """
+        :param labels: labeled image (background = 0)
+        """
+        flat = labels.ravel()
+        self.shape = labels.shape
+        self.n_labels = int(flat.max()) if flat.size else 0
+        self.pixels = np.flatnonzero(flat)
+        self.labels = flat[self.pixels]
+        self._coords = None
+        self.area = self.sum()
+
+    def sum(self, values=None):
+        """
+        :param values: image with the shape of the label image, or values of the foreground pixels (e.g. coords).
+        None counts the pixels
+        :return sums: array indexed by label - 1 (background excluded)
+        """
+        if values is not None and np.shape(values) == self.shape:
+            values = np.ravel(values)[self.pixels]
+        return np.bincount(self.labels, weights=values, minlength=self.n_labels + 1)[1:]
 
-        x = int(pix[0])
-        y = int(pix[1])
+    def mean(self, values):
+        """
+        :return means: mean of the values over every region (NaN for missing labels), indexed by label - 1
+        """
+        with np.errstate(invalid="ignore", divide="ignore"):
+            return self.sum(values) / self.area
 
-        #print(x, y)
+    @property
+    def coords(self):
+        """
+        :return rows, cols: coordinates of the foreground pixels
+        """
+        if self._coords is None:
+            self._coords = np.divmod(self.pixels, self.shape[1])
+        return self._coords
 
-        if x - 100 < 0 or y - 100 < 0 or x + 100 > img_size or y + 100 > img_size:
-            is_close_to_edge[c] = True
-            #print("Close to edge")
-    #print(is_close_to_edge)
-    labels = mh.labeled.remove_regions(labels, np.where(is_close_to_edge))
-    labels, n_labels = mh.labeled.relabel(labels)
+    def centers(self):
+        """
+        :return centers: array of shape (n_labels, 2) with the (row, column) center of mass of every region, following
+        the convention of mh.center_of_mass
+        """
+        rows, cols = self.coords
+        return np.stack([self.mean(rows), self.mean(cols)], axis=1)
 
-    centers = mh.center_of_mass(labels, labels)
-    centers = centers[1:] # Removes background region from data
 
-    #print(n_labels)
+def region_table(labels, sums=None):
+    """
+    Calculates the properties of all labeled regions in a single pass over the label image
+    :param labels: labeled image (background = 0)
+    :param sums: LabelSums of the label image, if already calculated
+    :return regions: DataFrame indexed by label (background excluded) with the area, center of mass
+    ("row", "col") and bounding box ("row0", "col0", "row1", "col1", end excluded) of each region
+    """
+    if sums is None:
+        sums = LabelSums(labels)
+    n_labels = sums.n_labels
+    centers = sums.centers()
 
-    return labels
+    # Bounding boxes. Missing labels get an empty box
+    boxes = np.zeros((n_labels, 4), dtype=int)
+    for i, sl in enumerate(ndimage.find_objects(labels, max_label=n_labels)):
+        if sl is not None:
+            boxes[i] = [sl[0].start, sl[1].start, sl[0].stop, sl[1].stop]
+
+    return pd.DataFrame({"area": sums.area,
+                         "row": centers[:, 0],
+                         "col": centers[:, 1],
+                         "row0": boxes[:, 0],
+                         "col0": boxes[:, 1],
+                         "row1": boxes[:, 2],
+                         "col1": boxes[:, 3]},
+                        index=pd.RangeIndex(1, n_labels + 1, name="label"))
+
+
+def keep_regions(labels, keep):
+    """
+    Removes regions and relabels the remaining ones sequentially (in a single lookup)
+    :param labels: labeled image
+    :param keep: bool array indexed by label - 1, True for the regions to keep
+    :return labels: relabeled image
+    """
+    keep = np.concatenate([[False], np.asarray(keep, dtype=bool)])
+    lut = np.where(keep, np.cumsum(keep), 0).astype(labels.dtype)
+    return lut[labels]
+
+
+def close_to_edge(regions, shape, margin=100):
+    """
+    :param regions: region table (see region_table)
+    :param shape: shape of the image
+    :param margin: minimum distance between the center of a region and the edges of the image (px)
+    :return: bool array, True for regions whose center is closer than margin to the edges
+    """
+    x = np.floor(regions["row"].to_numpy())
+    y = np.floor(regions["col"].to_numpy())
+    return (x - margin < 0) | (y - margin < 0) | (x + margin > shape[0]) | (y + margin > shape[1])
+
+
+def touches_border(regions, shape):
+    """
+    :param regions: region table (see region_table)
+    :param shape: shape of the image
+    :return: bool array, True for regions touching the edges of the image
+    """
+    return ((regions["row0"] == 0) | (regions["col0"] == 0) |
+            (regions["row1"] == shape[0]) | (regions["col1"] == shape[1])).to_numpy()
+
+
+def remove_close_to_edge(labels, img_size=None, margin=100):
+    """
+    Removes regions whose center is too close to the edges of the image
+    :param labels: labeled image
+    :param img_size: size of the image. None uses the shape of labels
+    :param margin: minimum distance between the center of a region and the edges (px)
+    :return labels: relabeled image
+    """
+    shape = labels.shape if img_size is None else (img_size, img_size)
+    regions = region_table(labels)
+    return keep_regions(labels, ~close_to_edge(regions, shape, margin=margin))
 
 
-def get_bg_box(x, y, img_size=2048):
+def get_bg_box(x, y, img_size=2048, box_size=200):
     """
     Calculates coordinates of a 200x200 box without overlapping with the edges
     :param x: x coordinate of center
     :param y: y coordinate of center
     :param img_size: size of the image, used to clip the box coordinates to the borders
+    :param box_size: side of the box (px)
     :return coords: list of coordinates for the 200x200 box
     """
     # Calculates coordinates of 200x200 box
-    coords = [x - 100, x + 100, y - 100, y + 100]
+    half = box_size // 2
+    coords = [x - half, x + half, y - half, y + half]
     for i in range(len(coords)):
         if coords[i] < 0:
             coords[i] = 0
@@ -51,78 +159,146 @@ def get_bg_box(x, y, img_size=2048):
     return coords
 
 
-def segment(pillar_mask):
+# View of one cell: label, center (row, col), 200x200 box (x0, x1, y0, y1), bounding box slices of the cell in the
+# frame, image in the box (context) and bool mask of the cell in the box
+CellCrop = namedtuple("CellCrop", ["label", "center", "box", "bbox", "context", "mask"])
+
+
+def iter_cells(img, cells, box_size=200, regions=None):
+    """
+    Iterates over the labeled cells using small views around each of them, instead of full-frame temporaries.
+    Bounding boxes of all the cells are obtained in a single pass (ndimage.find_objects).
+    :param img: image
+    :param cells: labeled image with cell selections
+    :param box_size: side of the box around the center of each cell (px)
+    :param regions: region table of cells, if already calculated (see region_table)
+    :return: generator of CellCrop, in label order
+    """
+    if regions is None:
+        regions = region_table(cells)
+
+    h, w = cells.shape
+    half = box_size // 2
+    for label, r in zip(regions.index, regions.itertuples(index=False)):
+        if r.area == 0:
+            continue
+
+        x = int(r.row)
+        y = int(r.col)
+        x0, x1 = min(max(x - half, 0), h), min(max(x + half, 0), h)
+        y0, y1 = min(max(y - half, 0), w), min(max(y + half, 0), w)
+
+        # The label is only compared inside the bounding box of the cell (clipped to the box around its center)
+        mask = np.zeros((x1 - x0, y1 - y0), dtype=bool)
+        r0, r1 = max(r.row0, x0), min(r.row1, x1)
+        c0, c1 = max(r.col0, y0), min(r.col1, y1)
+        if r0 < r1 and c0 < c1:
+            mask[r0 - x0:r1 - x0, c0 - y0:c1 - y0] = cells[r0:r1, c0:c1] == label
+
+        yield CellCrop(label=label,
+                       center=(r.row, r.col),
+                       box=(x0, x1, y0, y1),
+                       bbox=(slice(r.row0, r.row1), slice(r.col0, r.col1)),
+                       context=img[x0:x1, y0:y1],
+                       mask=mask)
+
+
+def segment(pillar_mask, max_size=20000, margin=100):
     """
     Filters regions drawn by the normalization script in pillar_mask
     :param pillar_mask: mask with background = False and cells and pillars = True.
+    :param max_size: regions larger than this are pillars (px)
+    :param margin: minimum distance between the center of a cell and the edges of the image (px)
     :return cells: image with labeled regions
     """
 
     # Uses pillar_mask to find separated cells
-    pillar_mask, n_elem = mh.label(pillar_mask)
-    sizes = mh.labeled.labeled_size(pillar_mask)
-    pillar_mask = mh.labeled.remove_regions(pillar_mask, np.where(sizes > 20000))  # Threshold size to remove pillars
-    pillar_mask = mh.labeled.remove_bordering(pillar_mask)  # Removes selections touching the edges
-    cells, n_cells = mh.labeled.relabel(pillar_mask)
+    with profiling.stage("label"):
+        pillar_mask, n_elem = mh.label(pillar_mask)
+
+    # Computes the properties of all regions once and applies all the filters on that table
+    with profiling.stage("region_filters"):
+        regions = region_table(pillar_mask)
+        is_pillar = (regions["area"] > max_size).to_numpy()  # Threshold size to remove pillars
+        is_bordering = touches_border(regions, pillar_mask.shape)  # Removes selections touching the edges
+        is_close = close_to_edge(regions, pillar_mask.shape, margin=margin)  # Removes regions close to the edges
 
-    # Removes regions close to the edges
-    cells = remove_close_to_edge(cells)
+        cells = keep_regions(pillar_mask, ~(is_pillar | is_bordering | is_close))
 
     return cells
 
 
-def get_volume(img, bg_mask, cells, pillar_height=5.6, pixel_size=0.325):
+def labeled_stats(img, cells, sums=None):
     """
-    Calculates cell volume based on input parameters
+    Calculates pixel count, mean intensity and center of mass of every labeled region in a single pass
+    over the label image (O(pixels) instead of one full-frame mask per region)
     :param img: image
-    :param bg_mask: mask with background = 0 and cells and pillars = 127.
-    :param cells: labeled image with cell selections
-    :param pillar_height: Height of microfluidic chamber
-    :param pixel_size: Size of pixel given camera pixel size and microscope magnification
-    :return df: DataFrame with all image analysis parameters, including cell volume
+    :param cells: labeled image with cell selections (background = 0)
+    :param sums: LabelSums of the label image, if already calculated
+    :return sizes, means, centers: arrays indexed by label - 1 (background excluded). centers has shape (n_labels, 2)
+    and follows the (row, column) convention of mh.center_of_mass
     """
+    if sums is None:
+        sums = LabelSums(cells)
+    return sums.area, sums.mean(img), sums.centers()
 
-    img_size = img.shape[0]
 
-    # Gets values of intensity, surface and center of mass
-    surfaces = mh.labeled.labeled_size(cells)
-    centers = mh.center_of_mass(cells, cells)
+def marker_stats(marker, cells, sums=None):
+    """
+    Calculates the mean, integrated and maximum intensity of every labeled region of a marker image in a single pass
+    over the label image
+    :param marker: marker image
+    :param cells: labeled image with cell selections (background = 0)
+    :param sums: LabelSums of the label image, if already calculated
+    :return stats: DataFrame indexed by label (background excluded) with the "mean", "integrated" and "max" intensities
+    """
+    if sums is None:
+        sums = LabelSums(cells)
+    n_labels = sums.n_labels
+    integrated = sums.sum(marker)
+    maxima = ndimage.maximum(marker, cells, np.arange(1, n_labels + 1)) if n_labels else np.zeros(0)
 
-    # Removes background region from data
-    surfaces = surfaces[1:]
-    centers = centers[1:]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = integrated / sums.area
 
-    intensities = []
-    bg_intensities = []
-    volumes = []
-    for c, pix in enumerate(centers):  # Iterates over all intensity centers
-        x = int(pix[0])
-        y = int(pix[1])
+    return pd.DataFrame({"mean": means, "integrated": integrated, "max": np.asarray(maxima, dtype=float)},
+                        index=pd.RangeIndex(1, n_labels + 1, name="label"))
 
-        [x0, x1, y0, y1] = get_bg_box(x, y, img_size=img_size)
 
-        # Gets mask corresponding to region, applies it and calculates mean intensity (darkness of cells)
-        current_mask = (cells == c + 1)
-        img_masked = img[current_mask]
-        mean = np.mean(img_masked)
-        intensities.append(mean)
+def get_volume(img, bg_mask, cells, pillar_height=5.6, pixel_size=0.325, bg_box=200, bg_estimator="median",
+               bg_tile=None, sums=None):
+    """
+    Calculates cell volume based on input parameters
+    :param img: image
+    :param bg_mask: mask with background = 0 and cells and pillars = 127.
+    :param cells: labeled image with cell selections
+    :param pillar_height: Height of microfluidic chamber
+    :param pixel_size: Size of pixel given camera pixel size and microscope magnification
+    :param bg_box: side of the box around each cell used to calculate the local background (px)
+    :param bg_estimator: estimator of the local background ("median" or "trimmed_mean")
+    :param bg_tile: side of the tiles of the shared background grid (px). None (default) calculates the exact
+    estimator on the box of every cell (see background.LocalBackground for the tolerance of the grid)
+    :param sums: LabelSums of the label image, if already calculated
+    :return df: DataFrame with all image analysis parameters, including cell volume
+    """
 
-        # Creates 200x200 box in both image and background and calculates median intensity (brightness of background)
-        selection = img[x0:x1, y0:y1]
-        selected_bg = bg_mask[x0:x1, y0:y1]
-        median = np.median(selection[np.where(selected_bg == 0)])
+    # Gets values of surface, intensity and center of mass for all regions in one pass over the labels
+    with profiling.stage("labeled_stats"):
+        surfaces, intensities, centers = labeled_stats(img, cells, sums=sums)
 
-        """
-        Basis of the FXm:
-        median - mean = difference between background intensity and cell intensity (excluded fluorescence)
-        surface = number of pixels
-        pillar_height = height of the microfluidic chamber (µm)
-        pixel_size = camera pixel size (µm)
-        """
-        vol = (median-mean) * surfaces[c] * pillar_height * pixel_size ** 2
-        volumes.append(vol)
+    # Calculates the local background (brightness around the cells) once for the whole frame and looks it up per cell
+    with profiling.stage("background"):
+        background = LocalBackground(img, bg_mask, box_size=bg_box, estimator=bg_estimator, tile=bg_tile)
+        bg_intensities = background.at(centers)
 
-        bg_intensities.append(median)
+    """
+    Basis of the FXm:
+    median - mean = difference between background intensity and cell intensity (excluded fluorescence)
+    surface = number of pixels
+    pillar_height = height of the microfluidic chamber (µm)
+    pixel_size = camera pixel size (µm)
+    """
+    volumes = (bg_intensities - intensities) * surfaces * pillar_height * pixel_size ** 2
 
     df = pd.DataFrame({"Path": None,
                        "ID": list(range(len(centers))),
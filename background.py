@@ -0,0 +1,163 @@
+import numpy as np
+from scipy import stats
+
+
+ESTIMATORS = ("median", "trimmed_mean")
+
+
+class LocalBackground:
+    """
+    Local background estimator shared by all the cells of a frame.
+
+    The background pixels (bg_mask == 0) of the frame are binned once into a grid of tiles x tiles
+    histograms, which are then accumulated into an integral histogram. The histogram of any box aligned
+    to the tile grid is obtained with 4 lookups, so the cost per cell is constant (O(bins)) instead of
+    sorting the background pixels of a full box for every cell.
+
+    Tolerance: each edge of the box is snapped to the nearest tile boundary (it moves by at most tile/2 px)
+    and the intensities are quantized into `bins` bins spanning the background range. The median is
+    interpolated inside its bin. On normalized FXm frames (flat background) the estimate agrees with the exact
+    per-cell median of the 200x200 box within 0.1 % of the background intensity, but with a background gradient
+    the error reaches about 0.3 % of the background and 0.7 % of the volume.
+
+    By default (tile=None), the exact value of the estimator is computed on the box of every cell. The tile grid
+    is opt-in and only pays off on dense frames.
+    """
+
+    def __init__(self, img, bg_mask, box_size=200, estimator="median", tile=None, bins=512, trim=0.1):
+        """
+        :param img: image
+        :param bg_mask: mask with background = 0 and cells and pillars > 0
+        :param box_size: side of the square box around each cell used to estimate the background (px)
+        :param estimator: "median" or "trimmed_mean"
+        :param tile: side of the tiles of the background grid (px). None (default) computes the exact estimator per cell
+        :param bins: number of intensity bins of the tile histograms
+        :param trim: fraction of background pixels cut from each side by the trimmed mean
+        """
+        if estimator not in ESTIMATORS:
+            raise ValueError(f"Unknown background estimator '{estimator}'. Use one of: {', '.join(ESTIMATORS)}")
+
+        self.img = img
+        self.bg_mask = bg_mask
+        self.box_size = box_size
+        self.estimator = estimator
+        self.tile = tile
+        self.bins = bins
+        self.trim = trim
+
+        if tile is not None:
+            self._build_grid()
+
+    def _build_grid(self):
+        """
+        Bins the background pixels in tile histograms and accumulates them into an integral histogram
+        """
+        h, w = self.img.shape
+        bg = np.flatnonzero(self.bg_mask.ravel() == 0)
+        values = self.img.ravel()[bg]
+
+        # Intensity range of the background. Extreme values are clipped to the first and last bins,
+        # which does not change the median
+        if values.size:
+            lo, hi = np.percentile(values, [0.05, 99.95])
+        else:
+            lo, hi = 0., 1.
+        if hi <= lo:
+            hi = lo + 1.
+        self.lo = lo
+        self.width = (hi - lo) / self.bins
+        b = np.clip(((values - lo) / self.width).astype(np.int64), 0, self.bins - 1)
+
+        # Tile of each background pixel
+        rows, cols = np.divmod(bg, w)
+        ny = -(-h // self.tile)
+        nx = -(-w // self.tile)
+        t = (rows // self.tile) * nx + cols // self.tile
+
+        hist = np.bincount(t * self.bins + b, minlength=ny * nx * self.bins).reshape(ny, nx, self.bins)
+
+        # Integral histogram with a zero row and column to simplify box queries
+        integral = np.zeros((ny + 1, nx + 1, self.bins), dtype=np.int32)
+        integral[1:, 1:] = hist.cumsum(axis=0).cumsum(axis=1)
+        self.integral = integral
+        self.shape = (h, w)
+
+    def box_histograms(self, centers):
+        """
+        Histograms of the background pixels in the box around each center
+        :param centers: array of (row, column) centers
+        :return hists: array with shape (len(centers), bins)
+        """
+        h, w = self.shape
+        ny = self.integral.shape[0] - 1
+        nx = self.integral.shape[1] - 1
+
+        x = centers[:, 0].astype(int)
+        y = centers[:, 1].astype(int)
+        half = self.box_size // 2
+
+        # Same clipped box as auto.get_bg_box, snapped to the tile grid
+        x0 = np.clip(np.rint(np.clip(x - half, 0, h) / self.tile).astype(int), 0, ny)
+        x1 = np.clip(np.rint(np.clip(x + half, 0, h) / self.tile).astype(int), 0, ny)
+        y0 = np.clip(np.rint(np.clip(y - half, 0, w) / self.tile).astype(int), 0, nx)
+        y1 = np.clip(np.rint(np.clip(y + half, 0, w) / self.tile).astype(int), 0, nx)
+        x1 = np.maximum(x1, np.minimum(x0 + 1, ny))
+        y1 = np.maximum(y1, np.minimum(y0 + 1, nx))
+
+        s = self.integral
+        return (s[x1, y1].astype(np.int64) - s[x0, y1] - s[x1, y0] + s[x0, y0])
+
+    def at(self, centers):
+        """
+        Estimates the local background around each center
+        :param centers: array of (row, column) centers, as returned by mh.center_of_mass
+        :return bg: array with the background intensity of each center
+        """
+        centers = np.asarray(centers, dtype=float).reshape(-1, 2)
+        if len(centers) == 0:
+            return np.zeros(0)
+
+        if self.tile is None:
+            return np.array([self._exact(int(x), int(y)) for x, y in centers], dtype=float)
+
+        hists = self.box_histograms(centers)
+        cdf = hists.cumsum(axis=1)
+        total = cdf[:, -1]
+        prev = cdf - hists  # Number of pixels below each bin
+
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self.estimator == "median":
+                target = total / 2
+                k = np.argmax(cdf >= target[:, None], axis=1)
+                rows = np.arange(len(centers))
+                frac = (target - prev[rows, k]) / hists[rows, k]
+                bg = self.lo + (k + frac) * self.width
+
+            else:
+                # Counts of each bin kept after trimming both tails, weighted by the bin centers
+                low = (self.trim * total)[:, None]
+                high = ((1 - self.trim) * total)[:, None]
+                kept = np.clip(cdf, low, high) - np.clip(prev, low, high)
+                bin_centers = self.lo + (np.arange(self.bins) + 0.5) * self.width
+                bg = (kept * bin_centers).sum(axis=1) / kept.sum(axis=1)
+
+        bg[total == 0] = np.nan
+        return bg
+
+    def _exact(self, x, y):
+        """
+        Exact estimator of the background in the box around (x, y)
+        """
+        h, w = self.img.shape
+        half = self.box_size // 2
+        x0, x1 = min(max(x - half, 0), h), min(max(x + half, 0), h)
+        y0, y1 = min(max(y - half, 0), w), min(max(y + half, 0), w)
+        selection = self.img[x0:x1, y0:y1]
+        selected_bg = self.bg_mask[x0:x1, y0:y1]
+        values = selection[np.where(selected_bg == 0)]
+        if values.size == 0:
+            return np.nan
+
+        if self.estimator == "median":
+            return np.median(values)
+        return stats.trim_mean(values, self.trim)
@@ -0,0 +1,177 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import mahotas as mh
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import autoSegment as auto
+import loader
+import cell_export
+from detecdiv_extract_cells import save_cells
+from synthetic import make_frame, save_frame
+
+
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baselines.json")
+
+
+def measure(func, repeat=3):
+    """
+    Runs func several times
+    :return result, seconds, peak: result of the last run, best wall time (s) and peak traced memory (MB)
+    """
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func()
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+
+    return result, best, peak
+
+
+def check_volumes(volumes, truth):
+    """
+    Uses the known volumes of the synthetic cells as a correctness oracle
+    :return matched, error: number of segmented cells matched to a synthetic cell and median relative error
+    """
+    if volumes.empty:
+        return 0, np.nan
+    centers = truth[["Center X", "Center Y"]].to_numpy()
+    errors = []
+    for _, row in volumes.iterrows():
+        d = np.hypot(centers[:, 0] - row["Center X"], centers[:, 1] - row["Center Y"])
+        i = np.argmin(d)
+        if d[i] < 3:
+            errors.append(abs(row["Volume"] / truth["Volume"].iloc[i] - 1))
+    return len(errors), float(np.median(errors)) if errors else np.nan
+
+
+def run_case(size, n_cells, repeat=3, pillar_height=5.6, pixel_size=0.325):
+    """
+    Times every stage of the analysis on one synthetic frame
+    :return results: list of dictionaries with the timings of each stage
+    """
+    image, mask, truth = make_frame(size=size, n_cells=n_cells, pillar_height=pillar_height, pixel_size=pixel_size)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        path = save_frame(os.path.join(tmp, "strain", "pos0"), image, mask)
+
+        (image, mask), t, peak = measure(lambda: loader.load_frame(path), repeat)
+        results.append(("load_frame", t, peak))
+
+        labels, _ = mh.label(mask)
+        _, t, peak = measure(lambda: auto.remove_close_to_edge(labels), repeat)
+        results.append(("remove_close_to_edge", t, peak))
+
+        cells, t, peak = measure(lambda: auto.segment(mask), repeat)
+        results.append(("segment", t, peak))
+
+        volumes, t, peak = measure(lambda: auto.get_volume(image, mask, cells, pillar_height=pillar_height,
+                                                           pixel_size=pixel_size), repeat)
+        results.append(("get_volume", t, peak))
+
+        def extract():
+            out = tempfile.mkdtemp(dir=tmp)
+            with contextlib.redirect_stdout(None):
+                writer = cell_export.make_writer(out, "both", fmt="npz", background=False)
+                save_cells(path, "both", 1, writer=writer, verbose=False)
+                writer.close()
+
+        _, t, peak = measure(extract, repeat)
+        results.append(("save_cells", t, peak))
+
+    n_segmented = len(volumes)
+    matched, error = check_volumes(volumes, truth)
+
+    return [{"stage": stage,
+             "size": size,
+             "cells": n_segmented,
+             "seconds": t,
+             "cells/s": n_segmented / t if t > 0 else np.inf,
+             "frames/s": 1 / t if t > 0 else np.inf,
+             "peak MB": peak,
+             "matched": matched,
+             "median error": error} for stage, t, peak in results]
+
+
+def case_key(r):
+    return f"{r['stage']}@{r['size']}px/{r['cells']}cells"
+
+
+def print_results(results, baselines=None, tolerance=1.5):
+    """
+    Prints the timings and compares them to the stored baselines
+    :return regressions: number of stages slower than tolerance * baseline
+    """
+    regressions = 0
+    print(f"{'stage':22}{'size':>6}{'cells':>7}{'time (ms)':>11}{'cells/s':>11}{'frames/s':>10}{'peak MB':>9}"
+          f"{'baseline':>10}")
+    for r in results:
+        line = (f"{r['stage']:22}{r['size']:6d}{r['cells']:7d}{r['seconds'] * 1000:11.1f}{r['cells/s']:11.0f}"
+                f"{r['frames/s']:10.2f}{r['peak MB']:9.1f}")
+        if baselines and case_key(r) in baselines:
+            ratio = r["seconds"] / baselines[case_key(r)]["seconds"]
+            line += f"{ratio:9.2f}x"
+            if ratio > tolerance:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the FXm analysis on synthetic frames.")
+    parser.add_argument("-s", "--sizes", type=int, nargs="+", default=[1024, 2048], help="Frame sizes (px)")
+    parser.add_argument("-n", "--cells", type=int, nargs="+", default=[50, 300], help="Number of cells per frame")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of runs of each stage (best is kept)")
+    parser.add_argument("--save-baseline", action="store_true", help=f"Store the timings in {BASELINE_FILE}")
+    parser.add_argument("--tolerance", type=float, default=1.5,
+                        help="Slowdown factor over the baseline reported as a regression")
+    parser.add_argument("--max-error", type=float, default=0.05,
+                        help="Maximum median relative error of the volumes of the synthetic cells")
+
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        for n in args.cells:
+            results += run_case(size, n, repeat=args.repeat)
+
+    baselines = None
+    if os.path.isfile(BASELINE_FILE):
+        with open(BASELINE_FILE) as f:
+            baselines = json.load(f)["cases"]
+
+    regressions = print_results(results, baselines, tolerance=args.tolerance)
+
+    # Correctness oracle
+    print()
+    failed = 0
+    for r in results:
+        if r["stage"] == "get_volume":
+            print(f"Volumes @{r['size']}px: {r['matched']} cells matched, median error {r['median error'] * 100:.2f} %")
+            if not r["median error"] <= args.max_error:
+                failed += 1
+
+    if args.save_baseline:
+        with open(BASELINE_FILE, "w") as f:
+            json.dump({"machine": platform.platform(), "python": platform.python_version(),
+                       "cases": {case_key(r): r for r in results}}, f, indent=1)
+        print(f"Baseline saved to {BASELINE_FILE}")
+
+    if regressions or failed:
+        sys.exit(1)
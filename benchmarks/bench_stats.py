@@ -0,0 +1,107 @@
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import stats
+
+
+def make_volumes(n_cells, n_groups, seed=0):
+    """
+    :return volumes, groups: log-normal volumes (skewed like the cell volumes) and the group of every cell
+    """
+    rng = np.random.default_rng(seed)
+    volumes = rng.lognormal(np.log(100), 0.4, n_cells)
+    groups = np.repeat(np.arange(n_groups), int(np.ceil(n_cells / n_groups)))[:n_cells]
+    return volumes, groups
+
+
+def sorted_segments(volumes, groups):
+    order = np.lexsort((volumes, groups))
+    return volumes[order], np.bincount(groups)
+
+
+def resample(volumes, n_boot, ci, seed=1):
+    """
+    Reference bootstrap: draws every value of every resample
+    :return bounds: mean_low, mean_high, median_low, median_high
+    """
+    rng = np.random.default_rng(seed)
+    q = [(1 - ci) / 2 * 100, (1 + ci) / 2 * 100]
+    samples = volumes[rng.integers(0, len(volumes), (n_boot, len(volumes)))]
+    return np.concatenate([np.percentile(samples.mean(axis=1), q), np.percentile(np.median(samples, axis=1), q)])
+
+
+def run_case(n_cells, n_groups, n_boot, ci, repeat=3):
+    """
+    Times segment_bootstrap on n_cells volumes split in n_groups groups
+    :return seconds, peak: best wall time (s) and peak traced memory (MB)
+    """
+    sorted_values, counts = sorted_segments(*make_volumes(n_cells, n_groups))
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        stats.segment_bootstrap(sorted_values, counts, n_boot=n_boot, ci=ci)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    stats.segment_bootstrap(sorted_values, counts, n_boot=n_boot, ci=ci)
+    peak = tracemalloc.get_traced_memory()[1] / 1024 ** 2
+    tracemalloc.stop()
+    return best, peak
+
+
+def check_accuracy(sizes, n_boot, ci):
+    """
+    Compares the intervals to the reference bootstrap for several group sizes
+    :return error: largest difference, relative to the width of the reference interval
+    """
+    errors = []
+    for size in sizes:
+        volumes, _ = make_volumes(size, 1, seed=size)
+        bounds = stats.segment_bootstrap(np.sort(volumes), [size], n_boot=n_boot, ci=ci).to_numpy()[0]
+        reference = resample(volumes, n_boot, ci)
+        width = np.repeat([reference[1] - reference[0], reference[3] - reference[2]], 2)
+        error = np.max(np.abs(bounds - reference) / width)
+        print(f"{size:8d} cells: {error * 100:5.2f} % of the interval width")
+        errors.append(error)
+    return max(errors)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the bootstrap confidence intervals of stats.py.")
+    parser.add_argument("-n", "--cells", type=int, default=100000, help="Number of cells")
+    parser.add_argument("-g", "--groups", type=int, nargs="+", default=[1, 100, 500, 5000],
+                        help="Numbers of groups (e.g. positions with -s Path)")
+    parser.add_argument("-b", "--bootstrap", type=int, default=10000, help="Number of resamples")
+    parser.add_argument("--ci", type=float, default=0.95, help="Confidence level")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Number of runs of each case (best is kept)")
+    parser.add_argument("--target", type=float, default=10.,
+                        help="Maximum time per resampled value of a single group (ns)")
+    parser.add_argument("--max-error", type=float, default=0.05,
+                        help="Maximum difference with the reference bootstrap, relative to the interval width")
+
+    args = parser.parse_args()
+
+    print(f"{'cells':>8}{'groups':>8}{'resamples':>11}{'time (ms)':>11}{'ns/value':>10}{'peak MB':>9}")
+    slow = 0
+    for n_groups in args.groups:
+        t, peak = run_case(args.cells, n_groups, args.bootstrap, args.ci, repeat=args.repeat)
+        per_value = t / (args.cells * args.bootstrap) * 1e9
+        line = f"{args.cells:8d}{n_groups:8d}{args.bootstrap:11d}{t * 1000:11.1f}{per_value:10.2f}{peak:9.1f}"
+        if n_groups == 1 and per_value > args.target:
+            line += "  SLOWER THAN TARGET"
+            slow += 1
+        print(line)
+
+    # Correctness oracle: the reference bootstrap draws every value, so it only runs on small groups
+    print()
+    error = check_accuracy([5, 12, 20, 21, 50, 200, 1000], args.bootstrap, args.ci)
+
+    if slow or error > args.max_error:
+        sys.exit(1)
@@ -0,0 +1,110 @@
+import os
+
+import numpy as np
+import pandas as pd
+from scipy.io import savemat
+
+
+def make_frame(size=2048, n_cells=300, n_pillars=4, pillar_height=5.6, pixel_size=0.325, noise=0.01, seed=0):
+    """
+    Generates a synthetic normalized FXm frame: flat fluorescent background (= 1), dark ellipsoidal cells that
+    exclude the fluorescence proportionally to their height, and large pillars that exclude it completely.
+    :param size: side of the frame (px)
+    :param n_cells: number of cells to place (less if the frame is too crowded)
+    :param n_pillars: number of pillars
+    :param pillar_height: height of the microfluidic chamber (µm)
+    :param pixel_size: size of the pixels (µm)
+    :param noise: standard deviation of the gaussian noise added to the image
+    :param seed: seed of the random generator
+    :return image, mask, truth: normalized image, deadZoneMask (background = 0, cells and pillars = 127) and
+    DataFrame with the center and the true volume (µm3) of every cell
+    """
+    rng = np.random.default_rng(seed)
+    image = np.ones((size, size))
+    mask = np.zeros((size, size), dtype=np.uint8)
+
+    # Pillars: discs larger than the size threshold of the segmentation
+    pillar_radius = 110
+    pillars = []
+    for _ in range(n_pillars):
+        r, c = rng.uniform(pillar_radius, size - pillar_radius, 2)
+        pillars.append((r, c))
+        r0, r1 = int(max(r - pillar_radius, 0)), int(min(r + pillar_radius + 1, size))
+        c0, c1 = int(max(c - pillar_radius, 0)), int(min(c + pillar_radius + 1, size))
+        rr, cc = np.mgrid[r0:r1, c0:c1]
+        disc = (rr - r) ** 2 + (cc - c) ** 2 <= pillar_radius ** 2
+        image[r0:r1, c0:c1][disc] = 0
+        mask[r0:r1, c0:c1][disc] = 127
+
+    # Cells: rods of S. pombe approximated by ellipsoids, separated from each other and from the pillars
+    rows = []
+    centers = []
+    attempts = 0
+    while len(rows) < n_cells and attempts < n_cells * 50:
+        attempts += 1
+        a = rng.uniform(12, 30)  # Semi-length (px)
+        b = rng.uniform(5, 7)  # Semi-width (px)
+        c = min(b * pixel_size, pillar_height / 2)  # Semi-height (µm)
+        theta = rng.uniform(0, np.pi)
+        r, col = rng.uniform(a + 2, size - a - 2, 2)
+
+        if any((r - pr) ** 2 + (col - pc) ** 2 < (pillar_radius + a + 4) ** 2 for pr, pc in pillars):
+            continue
+        if centers:
+            d = np.hypot(*(np.array(centers)[:, :2] - [r, col]).T)
+            if np.any(d < np.array(centers)[:, 2] + a + 4):
+                continue
+
+        r0, r1 = int(r - a - 1), int(r + a + 2)
+        c0, c1 = int(col - a - 1), int(col + a + 2)
+        rr, cc = np.mgrid[r0:r1, c0:c1]
+        dr, dc = rr - r, cc - col
+        u = (dc * np.cos(theta) + dr * np.sin(theta)) / a
+        v = (-dc * np.sin(theta) + dr * np.cos(theta)) / b
+        inside = u ** 2 + v ** 2 < 1
+        height = np.where(inside, 2 * c * np.sqrt(np.clip(1 - u ** 2 - v ** 2, 0, None)), 0)
+
+        image[r0:r1, c0:c1] -= height / pillar_height
+        mask[r0:r1, c0:c1][inside] = 127
+
+        centers.append((r, col, a))
+        rows.append({"Center X": r,
+                     "Center Y": col,
+                     "Surface": int(inside.sum()),
+                     "Volume": height.sum() * pixel_size ** 2,  # Volume of the discretized cell
+                     "Ellipsoid Volume": 4 / 3 * np.pi * a * b * pixel_size ** 2 * c})
+
+    image += rng.normal(0, noise, image.shape)
+
+    return image, mask, pd.DataFrame(rows)
+
+
+def save_frame(folder, image, mask):
+    """
+    Saves a frame like the MATLAB normalization script: <folder>/Normalization/frame1.mat, with an empty
+    <folder>/Segmentation folder for the outputs
+    :return path: folder of the normalization file
+    """
+    path = os.path.join(folder, "Normalization")
+    os.makedirs(path, exist_ok=True)
+    os.makedirs(os.path.join(folder, "Segmentation"), exist_ok=True)
+    savemat(os.path.join(path, "frame1.mat"), {"imageFlat": image, "deadZoneMask": mask})
+    return path
+
+
+def make_experiment(root, n_frames=4, **kwargs):
+    """
+    Creates an experiment folder with synthetic frames: <root>/pos<i>/Normalization/frame1.mat
+    :param root: experiment folder
+    :param n_frames: number of frames
+    :param kwargs: arguments of make_frame
+    :return truth: DataFrame with the true volumes of the cells of all frames, with the frame folder in "Path"
+    """
+    seed = kwargs.pop("seed", 0)
+    truths = []
+    for i in range(n_frames):
+        image, mask, truth = make_frame(seed=seed + i, **kwargs)
+        path = save_frame(os.path.join(root, f"pos{i}"), image, mask)
+        truth["Path"] = os.path.abspath(os.path.join(path, ".."))
+        truths.append(truth)
+    return pd.concat(truths, ignore_index=True)
@@ -0,0 +1,139 @@
+import hashlib
+import json
+import os
+
+import pandas as pd
+
+
+# Increase when a change in the analysis invalidates the cached results
+CACHE_VERSION = 2
+
+# Running size of the caches written by this process (bytes), {cache directory: size}. Worker processes of a parallel
+# run keep their own running size from one frame to the next
+_sizes = {}
+
+
+class ResultCache:
+    """
+    On-disk cache of the per-frame DataFrames calculated by main.analyze_experiment.
+
+    Results are keyed by the normalization file and the other input files of the frame (absolute path, size and
+    modification time, or the hash of their content) and by the analysis parameters, so re-runs only analyze the
+    frames that are new or have changed.
+    When the cache grows over max_size, the least recently used results are removed. The size of the cache is only
+    read once per process and then updated as results are added, so the cache directory is only listed again when
+    it is full.
+    """
+
+    def __init__(self, cache_dir, max_size=1024, content_hash=False):
+        """
+        :param cache_dir: directory where the results are stored
+        :param max_size: maximum size of the cache (MB)
+        :param content_hash: if True, identifies normalization files by the hash of their content instead of their
+        path, size and modification time (slower, but survives moving or copying the experiment)
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_size * 1024 ** 2)
+        self.content_hash = content_hash
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _file_id(self, file):
+        """
+        :return: hash of the content of a file, or its absolute path, size and modification time
+        """
+        if self.content_hash:
+            h = hashlib.sha1()
+            with open(file, "rb") as f:
+                for block in iter(lambda: f.read(1024 ** 2), b""):
+                    h.update(block)
+            return h.hexdigest()
+        st = os.stat(file)
+        return [os.path.abspath(file), st.st_size, st.st_mtime_ns]
+
+    def key(self, mat_file, files=(), **params):
+        """
+        Calculates the cache key of a normalization file
+        :param mat_file: path to the normalization file
+        :param files: other input files of the frame (e.g. images of other channels)
+        :param params: analysis parameters that change the result (pillar height, pixel size, segmentation...)
+        :return key: hexadecimal key
+        """
+        file_ids = [self._file_id(file) for file in [mat_file] + list(files)]
+        payload = json.dumps([CACHE_VERSION, file_ids, sorted(params.items())], default=str)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def get(self, key):
+        """
+        :return df: cached DataFrame, or None if the key is not in the cache
+        """
+        file = self._file(key)
+        try:
+            df = pd.read_pickle(file)
+        except (FileNotFoundError, EOFError):
+            return None
+        except Exception:
+            # Unreadable entry (e.g. written by an incompatible pandas version)
+            self._remove(file)
+            return None
+
+        os.utime(file)  # Marks the entry as recently used
+        return df
+
+    def put(self, key, df):
+        """
+        Stores a DataFrame and removes the least recently used entries if the cache is too big
+        """
+        file = self._file(key)
+        tmp = f"{file}.{os.getpid()}.tmp"
+        df.to_pickle(tmp)
+        size = os.path.getsize(tmp)
+        try:
+            size -= os.path.getsize(file)  # Replaced entry
+        except FileNotFoundError:
+            pass
+        os.replace(tmp, file)  # Atomic, several processes may write to the cache at the same time
+
+        if self.cache_dir not in _sizes:
+            _sizes[self.cache_dir] = sum(e[1] for e in self._entries())
+        else:
+            _sizes[self.cache_dir] += size
+        if _sizes[self.cache_dir] > self.max_bytes:
+            self.evict()
+
+    def _entries(self):
+        """
+        :return entries: list of (last use, size, name) of the cached results
+        """
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(".pkl"):
+                continue
+            try:
+                st = os.stat(os.path.join(self.cache_dir, name))
+            except FileNotFoundError:
+                continue
+            entries.append((st.st_mtime, st.st_size, name))
+        return entries
+
+    def evict(self):
+        """
+        Removes the least recently used entries until the cache fits in max_size
+        """
+        entries = self._entries()
+        total = sum(e[1] for e in entries)
+        for mtime, size, name in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            self._remove(os.path.join(self.cache_dir, name))
+            total -= size
+        _sizes[self.cache_dir] = total
+
+    @staticmethod
+    def _remove(file):
+        try:
+            os.remove(file)
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,328 @@
+import os
+import queue
+import threading
+
+import numpy as np
+import mahotas as mh
+import pandas as pd
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+
+EXPORT_FORMATS = ("files", "tiff", "npz")
+MASK_DIR = "single_cells_mask"
+IMG_DIR = "single_cells_img"
+INDEX_FILE = "cell_index.tsv"
+INDEX_COLUMNS = ["Cell", "File", "Page", "Path", "ID"]
+
+
+def cell_file_name(cell):
+    """
+    Name of the image of one cell in the per-file layout
+    """
+    return f"cell_{cell:04d}_w1GFP.tif"
+
+
+def _make_dir(path, created):
+    """
+    Creates an output directory the first time it is used
+    """
+    if path not in created:
+        if not os.path.exists(path):
+            os.makedirs(path)
+            print("Created path: {}".format(path))
+        created.add(path)
+
+
+def write_index(out_root, rows):
+    """
+    Appends rows (as kept in CellIndex.rows) to the cell index file of out_root
+    """
+    index = CellIndex(out_root)
+    index.rows = list(rows)
+    index.flush()
+
+
+def read_index(index_file):
+    """
+    Reads a cell index file. Cells exported several times (e.g. extraction run again on the same folder) keep their
+    last row
+    :param index_file: path to the cell_index.tsv file
+    :return index: DataFrame with the INDEX_COLUMNS columns, one row per cell number
+    """
+    index = pd.read_csv(index_file, sep="\t", dtype={"Path": str, "File": str})
+    return index.drop_duplicates("Cell", keep="last").reset_index(drop=True)
+
+
+class CellIndex:
+    """
+    Index of the exported cells: cell number, file and page where the crop is stored,
+    and the frame (Path) and ID of the cell in the FXm analysis table
+    """
+
+    def __init__(self, out_root):
+        """
+        :param out_root: folder of the index file. None keeps the rows in memory (see rows)
+        """
+        self.file = os.path.join(out_root, INDEX_FILE) if out_root is not None else None
+        self.new = self.file is not None and not os.path.exists(self.file)
+        self.rows = []
+
+    def add(self, cell, file, page, path, cell_id):
+        self.rows.append(f"{cell}\t{file}\t{page}\t{path}\t{cell_id}\n")
+
+    def flush(self):
+        if not self.rows or self.file is None:
+            return
+        with open(self.file, "a") as f:
+            if self.new:
+                f.write("\t".join(INDEX_COLUMNS) + "\n")
+                self.new = False
+            f.writelines(self.rows)
+        self.rows = []
+
+
+class FileWriter:
+    """
+    Original layout: one .tif file per cell in single_cells_mask and single_cells_img
+    """
+
+    def __init__(self, out_root, image_type, index=True):
+        """
+        :param out_root: folder where the single cell folders are created
+        :param image_type: "mask", "image" or "both"
+        :param index: write the cell index file. If False, the index rows are only kept in memory (index.rows)
+        """
+        self.out_root = out_root
+        self.image_type = image_type
+        self.index = CellIndex(out_root if index else None)
+        self.created = set()
+
+    def write(self, cell, path, cell_id, selection, selection_masked, out_root=None):
+        """
+        Saves the crops of one cell
+        :param cell: global cell number
+        :param path: frame of the cell (Path column of the FXm analysis)
+        :param cell_id: ID of the cell in its frame
+        :param selection: 16-bit image around the cell
+        :param selection_masked: 16-bit image around the cell with the background masked out
+        :param out_root: folder where the single cell folders are created, if different for this cell
+        """
+        out_root = out_root or self.out_root
+        name = cell_file_name(cell)
+
+        if self.image_type in ['mask', 'both']:
+            mask_out_path = os.path.join(out_root, MASK_DIR)
+            _make_dir(mask_out_path, self.created)
+            mh.imsave(os.path.join(mask_out_path, name), selection_masked)
+
+        if self.image_type in ['image', 'both']:
+            img_out_path = os.path.join(out_root, IMG_DIR)
+            _make_dir(img_out_path, self.created)
+            mh.imsave(os.path.join(img_out_path, name), selection)
+
+        self.index.add(cell, name, 0, path, cell_id)
+
+    def close(self):
+        self.index.flush()
+
+
+class StackWriter:
+    """
+    Stores the crops in chunks of cells: multi-page .tif stacks (one page per cell) or .npz arrays
+    with shape (cells, 200, 200). The cell index gives the file and page of every cell.
+    """
+
+    def __init__(self, out_root, image_type, fmt="npz", chunk=1000, box_size=200, index=True):
+        """
+        :param out_root: folder where the single cell folders are created
+        :param image_type: "mask", "image" or "both"
+        :param fmt: "tiff" or "npz"
+        :param chunk: number of cells per file
+        :param box_size: side of the crops (px). Smaller crops are padded with zeros
+        :param index: write the cell index file. If False, the index rows are only kept in memory (index.rows)
+        """
+        if fmt == "tiff" and tifffile is None:
+            raise ImportError("Exporting .tif stacks requires the tifffile package. Install it with: "
+                              "pip install tifffile")
+
+        self.out_root = out_root
+        self.image_type = image_type
+        self.fmt = fmt
+        self.chunk = chunk
+        self.box_size = box_size
+        self.index = CellIndex(out_root if index else None)
+        self.created = set()
+        self._reset()
+
+    def _reset(self):
+        self.cells = []
+        self.keys = []
+        self.images = []
+        self.masks = []
+
+    def _pad(self, crop):
+        if crop.shape == (self.box_size, self.box_size):
+            return crop
+        padded = np.zeros((self.box_size, self.box_size), dtype=crop.dtype)
+        padded[:crop.shape[0], :crop.shape[1]] = crop
+        return padded
+
+    def write(self, cell, path, cell_id, selection, selection_masked, out_root=None):
+        """
+        Adds the crops of one cell to the current chunk (see FileWriter.write)
+        """
+        self.cells.append(cell)
+        self.keys.append((path, cell_id))
+        if self.image_type in ['image', 'both']:
+            self.images.append(self._pad(selection))
+        if self.image_type in ['mask', 'both']:
+            self.masks.append(self._pad(selection_masked))
+
+        if len(self.cells) >= self.chunk:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the current chunk
+        """
+        if not self.cells:
+            return
+
+        stem = f"cells_{self.cells[0]:06d}"
+
+        if self.fmt == "npz":
+            out_path = os.path.join(self.out_root, IMG_DIR if self.images else MASK_DIR)
+            _make_dir(out_path, self.created)
+            name = stem + ".npz"
+            arrays = {"cell": np.array(self.cells)}
+            if self.images:
+                arrays["img"] = np.stack(self.images)
+            if self.masks:
+                arrays["mask"] = np.stack(self.masks)
+            np.savez(os.path.join(out_path, name), **arrays)
+        else:
+            name = stem + ".tif"
+            for folder, crops in [(IMG_DIR, self.images), (MASK_DIR, self.masks)]:
+                if crops:
+                    out_path = os.path.join(self.out_root, folder)
+                    _make_dir(out_path, self.created)
+                    tifffile.imwrite(os.path.join(out_path, name), np.stack(crops))
+
+        for page, (cell, (path, cell_id)) in enumerate(zip(self.cells, self.keys)):
+            self.index.add(cell, name, page, path, cell_id)
+        self.index.flush()
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.index.flush()
+
+
+def read_stack(out_root, name):
+    """
+    Reads a stack written by a StackWriter
+    :param out_root: folder of the single cell folders
+    :param name: file name of the stack (File column of the cell index)
+    :return images, masks: arrays of shape (cells, 200, 200). None if the stack has no images or no masks
+    """
+    if name.endswith(".npz"):
+        folder = IMG_DIR if os.path.exists(os.path.join(out_root, IMG_DIR, name)) else MASK_DIR
+        with np.load(os.path.join(out_root, folder, name)) as arrays:
+            return arrays["img"] if "img" in arrays else None, arrays["mask"] if "mask" in arrays else None
+
+    stacks = []
+    for folder in [IMG_DIR, MASK_DIR]:
+        file = os.path.join(out_root, folder, name)
+        if os.path.exists(file):
+            stack = tifffile.imread(file)
+            stacks.append(stack.reshape(-1, *stack.shape[-2:]))  # Single page stacks are read as 2D images
+        else:
+            stacks.append(None)
+    return tuple(stacks)
+
+
+def merge_stacks(writer, out_root, rows):
+    """
+    Copies the cells of stacks written by another StackWriter (e.g. one stack per frame, written by parallel workers)
+    into the chunks of writer, in the order of the index rows, and deletes the copied stacks
+    :param writer: StackWriter (or BackgroundWriter) receiving the cells
+    :param out_root: folder of the single cell folders of the copied stacks
+    :param rows: index rows of the copied stacks (see CellIndex.rows)
+    """
+    stacks = {}
+    for row in rows:
+        cell, name, page, path, cell_id = row.rstrip("\n").split("\t")
+        if name not in stacks:
+            stacks[name] = read_stack(out_root, name)
+        images, masks = stacks[name]
+        page = int(page)
+        writer.write(int(cell), path, int(cell_id), None if images is None else images[page],
+                     None if masks is None else masks[page])
+
+    for folder in [IMG_DIR, MASK_DIR]:
+        for name in stacks:
+            file = os.path.join(out_root, folder, name)
+            if os.path.exists(file):
+                os.remove(file)
+
+
+class BackgroundWriter:
+    """
+    Runs the writes of a FileWriter or StackWriter in a background thread, so the extraction of the next
+    cells does not wait for the disk. Errors of the writer are raised by write() or close().
+    """
+
+    def __init__(self, writer, maxsize=64):
+        self.writer = writer
+        self.queue = queue.Queue(maxsize=maxsize)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if self.error is not None:
+                continue  # Drains the queue after an error
+            try:
+                self.writer.write(*item[0], **item[1])
+            except Exception as e:
+                self.error = e
+
+    def write(self, *args, **kwargs):
+        if self.error is not None:
+            raise self.error
+        self.queue.put((args, kwargs))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        self.writer.close()
+
+
+def make_writer(out_root, image_type, fmt="files", chunk=1000, background=True, index=True):
+    """
+    Creates the writer of an export format
+    :param out_root: folder where the single cell folders are created
+    :param image_type: "mask", "image" or "both"
+    :param fmt: "files" (one .tif per cell), "tiff" (multi-page .tif stacks) or "npz" (.npz arrays)
+    :param chunk: number of cells per stack
+    :param background: write in a background thread
+    :param index: write the cell index file (see FileWriter)
+    """
+    if fmt == "files":
+        writer = FileWriter(out_root, image_type, index=index)
+    else:
+        writer = StackWriter(out_root, image_type, fmt=fmt, chunk=chunk, index=index)
+
+    if background:
+        writer = BackgroundWriter(writer)
+    return writer
@@ -0,0 +1,105 @@
+import numpy as np
+from scipy.cluster.vq import kmeans2
+from scipy.spatial import cKDTree
+
+import autoSegment as auto
+
+
+# Marker statistics of every cell (see autoSegment.marker_stats) and their columns in the analysis file
+FEATURES = {"mean": "Marker Mean", "integrated": "Marker Integrated", "max": "Marker Max"}
+
+
+def match_labels(cells, centers, tolerance=2.):
+    """
+    Finds the cells of the analysis file in a labeled image, by their centers
+    :param cells: labeled image (see autoSegment.segment)
+    :param centers: array of shape (n, 2) with the Center X and Center Y of the cells (row, column)
+    :param tolerance: maximum distance between the center in the analysis file and the center of the region (px)
+    :return labels: label of every cell. 0 for the cells without a matching region
+    """
+    labels = np.zeros(len(centers), dtype=int)
+    regions = auto.region_table(cells)
+    regions = regions[regions["area"] > 0]
+    if regions.empty or not len(centers):
+        return labels
+
+    tree = cKDTree(regions[["row", "col"]].to_numpy())
+    distance, nearest = tree.query(np.asarray(centers, dtype=float))
+    found = distance <= tolerance
+    labels[found] = regions.index.to_numpy()[nearest[found]]
+    return labels
+
+
+def marker_features(marker, mask, centers):
+    """
+    Calculates the marker statistics of the cells of a frame
+    :param marker: marker image
+    :param mask: segmentation mask of the frame (background = 0)
+    :param centers: array of shape (n, 2) with the Center X and Center Y of the cells of the analysis file
+    :return features: DataFrame with a row per cell and a column per feature (see FEATURES). NaN for the cells that
+    were not found in the mask
+    """
+    cells = auto.segment(mask > 0)
+    labels = match_labels(cells, centers)
+    stats = auto.marker_stats(marker, cells)
+    features = stats.reindex(labels).reset_index(drop=True)
+    return features.rename(columns=FEATURES)
+
+
+def threshold_groups(values, thresholds, borderline=0.1):
+    """
+    Assigns groups by comparing a feature with thresholds: group 1 below the first threshold, group 2 between the first
+    and the second one, etc.
+    :param values: feature of every cell
+    :param thresholds: ng - 1 thresholds
+    :param borderline: cells closer to a threshold than this fraction of the threshold are borderline
+    :return groups, borderline: group of every cell (0 if the feature is NaN) and bool array, True for the borderline
+    cells (and the cells without feature)
+    """
+    values = np.asarray(values, dtype=float)
+    thresholds = np.sort(np.asarray(thresholds, dtype=float))
+    valid = np.isfinite(values)
+
+    groups = np.where(valid, np.searchsorted(thresholds, values, side="right") + 1, 0)
+
+    distance = np.abs(values[:, None] - thresholds[None, :])
+    nearest = np.argmin(np.where(valid[:, None], distance, np.inf), axis=1)
+    with np.errstate(invalid="ignore"):
+        close = distance[np.arange(len(values)), nearest] <= borderline * np.abs(thresholds[nearest])
+
+    return groups, close | ~valid
+
+
+def kmeans_groups(features, ng, borderline=0.1, seed=0):
+    """
+    Assigns groups by k-means clustering of the standardized features.
+    Groups are numbered by increasing value of the first feature.
+    :param features: array of shape (n, f) with the features of every cell
+    :param ng: number of groups
+    :param borderline: cells whose distances to the two nearest centroids differ by less than this fraction of their
+    sum are borderline
+    :param seed: seed of the initialization of the centroids, for reproducible groups
+    :return groups, borderline: group of every cell (0 if a feature is NaN) and bool array, True for the borderline
+    cells (and the cells without features)
+    """
+    features = np.asarray(features, dtype=float).reshape(len(features), -1)
+    valid = np.isfinite(features).all(axis=1)
+    groups = np.zeros(len(features), dtype=int)
+    close = ~valid
+    if valid.sum() < ng:
+        close[:] = True
+        return groups, close
+
+    z = features[valid]
+    std = z.std(axis=0)
+    z = (z - z.mean(axis=0)) / np.where(std > 0, std, 1)
+
+    centroids, codes = kmeans2(z, ng, minit="++", seed=seed)
+    rank = np.argsort(np.argsort(centroids[:, 0]))
+    groups[valid] = rank[codes] + 1
+
+    distance = np.sort(np.linalg.norm(z[:, None, :] - centroids[None, :, :], axis=2), axis=1)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        close[valid] = (distance[:, 1] - distance[:, 0]) <= borderline * (distance[:, 1] + distance[:, 0])
+
+    return groups, close
@@ -0,0 +1,124 @@
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+
+def curation_file(df_file):
+    """
+    :param df_file: experiment output file (e.g. <strain>_M.tsv)
+    :return: path of its curation file (e.g. <strain>_M_curation.jsonl), shared by all the output formats
+    """
+    return os.path.splitext(df_file)[0] + "_curation.jsonl"
+
+
+class CurationStore:
+    """
+    Decisions taken by the user in the interactive windows (manual filtering or groups), keyed by frame (Path column)
+    and cell ID.
+
+    Every reviewed frame is appended to the file as soon as its window is closed, so an interrupted session loses at
+    most the frame being reviewed. The decisions can be applied again to a volume table without opening any window.
+    """
+
+    def __init__(self, file, column):
+        """
+        :param file: curation file (see curation_file)
+        :param column: column of the output file set by the decisions (ManualFilter or Group)
+        """
+        self.file = file
+        self.column = column
+        self.frames = {}  # {frame: {cell ID: decision}}
+
+        lines = 0
+        try:
+            with open(file) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:  # Last line of an interrupted write
+                        continue
+                    lines += 1
+                    if record.get("column") == column:
+                        self.frames[record["frame"]] = dict(zip(record["ids"], record["values"]))
+        except FileNotFoundError:
+            pass
+
+        # Frames reviewed several times: only keeps the last decisions
+        if lines > len(self.frames):
+            self.compact()
+
+    def __contains__(self, frame):
+        return frame in self.frames
+
+    def __len__(self):
+        return len(self.frames)
+
+    def _record(self, frame):
+        decisions = self.frames[frame]
+        return json.dumps({"column": self.column, "frame": frame, "ids": list(decisions),
+                           "values": list(decisions.values())})
+
+    def record(self, frame, ids, values):
+        """
+        Saves the decisions of a frame
+        :param frame: frame (value of the Path column)
+        :param ids: IDs of the cells of the frame
+        :param values: decision for every cell
+        """
+        self.frames[frame] = dict(zip(np.asarray(ids).tolist(), np.asarray(values).tolist()))
+        with open(self.file, "a") as f:
+            f.write(self._record(frame) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def lookup(self, frame, ids):
+        """
+        :param frame: frame (value of the Path column)
+        :param ids: IDs of the cells of the frame
+        :return: list with the decision of every cell. None if the frame was not reviewed or if some cells have no
+        decision (e.g. the frame was segmented again)
+        """
+        decisions = self.frames.get(frame)
+        if decisions is None:
+            return None
+        try:
+            return [decisions[i] for i in np.asarray(ids).tolist()]
+        except KeyError:
+            return None
+
+    def apply(self, df):
+        """
+        Sets the decisions column of a volume table from the saved decisions, without opening any window
+        :param df: DataFrame with the Path and ID columns
+        :return reviewed: boolean array, True for the rows with a saved decision. The other rows are left unchanged
+        (or NaN if the column did not exist)
+        """
+        frames = [frame for frame, decisions in self.frames.items() for _ in decisions]
+        ids = [i for decisions in self.frames.values() for i in decisions]
+        values = [v for decisions in self.frames.values() for v in decisions.values()]
+        saved = pd.Series(values, index=pd.MultiIndex.from_arrays([frames, ids]), dtype=object)
+
+        keys = pd.MultiIndex.from_arrays([np.asarray(df["Path"], dtype=object), np.asarray(df["ID"])])
+        decisions = saved.reindex(keys)
+        reviewed = decisions.notna().to_numpy()
+
+        if self.column not in df.columns:
+            df[self.column] = np.nan
+        if reviewed.all():
+            df[self.column] = decisions.to_numpy().tolist()
+        else:
+            df.loc[reviewed, self.column] = decisions.to_numpy()[reviewed].tolist()
+
+        return reviewed
+
+    def compact(self):
+        """
+        Rewrites the file with the last decisions of every frame
+        """
+        tmp = f"{self.file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            for frame in self.frames:
+                f.write(self._record(frame) + "\n")
+        os.replace(tmp, self.file)
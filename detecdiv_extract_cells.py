@@ -1,10 +1,13 @@
 import re
 import os
+import shutil
+import tempfile
 import numpy as np
-from scipy.io import loadmat
-import mahotas as mh
 import autoSegment as auto
-import matplotlib.pyplot as plt
+import loader
+import cell_export
+import pipeline
+import profiling
 
 import argparse
 
@@ -23,99 +26,196 @@ def natural_keys(text):
     return [ atoi(c) for c in re.split(r'(\d+)', text) ]
 
 
-def save_cells(image_path, image_type, cell_count) -> int:
+def find_frames(experiment_folder) -> list:
+    """
+    Looks for normalization files inside the experiment folder.
+    experiment_folder: path to the experiment.
+
+    Returns the folders to process, in the order that gives the cells their numbers (human order).
+    """
+    frames = []
+    for root, dirs, files in os.walk(experiment_folder):
+        dirs.sort(key=natural_keys)  # Sort directories in human order
+        for file in files:
+            if file.endswith('.mat'):
+                frames.append(root)
+    return frames
+
+
+def count_cells(image_path) -> int:
+    """
+    Counts the cells that save_cells will extract from an image.
+    image_path: path to the image to process.
+
+    Returns the number of segmented cells.
+    """
+    image, mask = loader.load_frame(image_path)
+    cells = auto.segment(mask)
+    return int(cells.max())
+
+
+def extract_frame(task, image_type, out_root, export_format="files", chunk=1000) -> list:
+    """
+    Saves the cells of one image with its own writer, to process images in parallel.
+    task: (image_path, cell_count) with the path to the image and the number of its first cell.
+    image_type: string with the type of image to process.
+    out_root: folder where the single cell folders are created.
+    export_format: export format (see cell_export.make_writer).
+    chunk: number of cells per stack.
+
+    Returns the rows of the cell index of the image.
+    """
+    image_path, cell_count = task
+    writer = cell_export.make_writer(out_root, image_type, fmt=export_format, chunk=chunk, background=False,
+                                     index=False)
+    save_cells(image_path, image_type, cell_count, writer=writer, verbose=False)
+    writer.close()
+    return writer.index.rows
+
+
+def save_cells(image_path, image_type, cell_count, writer=None, verbose=True) -> int:
     """
     Saves the cells in the image as individual images.
     image_path: path to the image to process.
     image_type: string with the type of image to process.
     cell_count: number of cells to process.
+    writer: cell_export writer used to save the crops. Defaults to one .tif file per cell.
+    verbose: print every saved cell.
 
     Returns the number of cells processed.
     """
 
-    # Load MATLAB normalization data
+    # Load MATLAB normalization data. Only the image and the mask are read from the file
     #path = os.path.join("giles", "GFP", "Normalization")
-    mat = loadmat(os.path.join(image_path, "frame1.mat"))
-    image = mat["imageFlat"]
-    mask = mat["deadZoneMask"]
+    with profiling.stage("load_frame", frame=image_path):
+        image, mask = loader.load_frame(image_path)
 
-    # Normalize image in case there are pixels with value > 1
-    image = image / image.max()
+        # Normalize image in case there are pixels with value > 1
+        image = image / image.max()
 
     # Run automatic segmentation of cells
-    cells = auto.segment(mask)
-
-    # Get centers of preselected regions
-    centers = mh.center_of_mass(cells, cells)
+    with profiling.stage("segment", frame=image_path):
+        cells = auto.segment(mask)
 
-    # Remove background region from data
-    centers = centers[1:]
-    
-    for cellID, pix in enumerate(centers):  # Iterate over all intensity centers
+    # Output folder, and frame of the cells as written in the Path column of the FXm analysis
+    out_root = os.path.join(image_path, "../..")
+    frame = os.path.abspath(os.path.join(image_path, ".."))
 
-        # Get coodinates of the center   
-        x = int(pix[0])
-        y = int(pix[1])
+    own_writer = writer is None
+    if own_writer:
+        writer = cell_export.FileWriter(out_root, image_type)
 
-        # Get coordinates of 200x200 box around each cell
-        [x0, x1, y0, y1] = auto.get_bg_box(x, y)
+    with profiling.stage("extract", frame=image_path):
+        # Iterate over all cells using small views around each of them
+        for crop in auto.iter_cells(image, cells):
 
-        # Select 200x200 image around the center
-        selection = image[x0:x1, y0:y1]
+            # Select 200x200 image around the center
+            selection = crop.context
 
-        # Mask out the background
-        current_mask = (cells == cellID + 1)
-        img_masked = image * current_mask
-        selection_masked = img_masked[x0:x1, y0:y1]
-        
-        # Convert to 16-bit image
-        selection = (selection * (2**16-1)).astype(np.uint16) 
-        selection_masked = (selection_masked * (2**16-1)).astype(np.uint16) 
+            # Mask out the background
+            selection_masked = selection * crop.mask
 
-        # Save cell box
-        mask_out_path = os.path.join(image_path, "../..", "single_cells_mask")
-        img_out_path = os.path.join(image_path, "../..", "single_cells_img")
+            # Convert to 16-bit image
+            selection = (selection * (2**16-1)).astype(np.uint16) 
+            selection_masked = (selection_masked * (2**16-1)).astype(np.uint16) 
 
-        if image_type in ['mask', 'both']:
-            # Create path if it doesn't exist
-            if not os.path.exists(mask_out_path):
-                os.makedirs(mask_out_path)
-                print("Created path: {}".format(mask_out_path))
+            # Save cell box
+            writer.write(cell_count, frame, crop.label - 1, selection, selection_masked, out_root=out_root)
 
-            mh.imsave(os.path.join(mask_out_path, f"cell_{cell_count:04d}_w1GFP.tif"), selection_masked)
+            if verbose:
+                print(f"Saved {cell_count}")
+            cell_count += 1
 
-        if image_type in ['image', 'both']:
-            # Create path if it doesn't exist
-            if not os.path.exists(img_out_path):
-                os.makedirs(img_out_path)
-
-            mh.imsave(os.path.join(img_out_path, f"cell_{cell_count:04d}_w1GFP.tif"), selection)
-
-        print(f"Saved {cell_count}")
-        cell_count += 1
+    if own_writer:
+        writer.close()
 
     return cell_count
 
 
-# User interaction and parameter logic
-parser = argparse.ArgumentParser(description="Extract masked cells from normalized images and save them as individual .tif files.")
-parser.add_argument("path", type=str, help="Path to images directory.")
-parser.add_argument("type", choices=['mask', 'image', 'both'], help='Choose which image(s) you want to extract.')
-parser.add_argument("-c", "--cell_count", type=int, default=1, help="Starting cell count, useful to add cells to existing dataset.")
-
-args = parser.parse_args()
-
-experiment_folder = args.path
-image_type = args.type
-cell_count = args.cell_count
+if __name__ == "__main__":
+    # User interaction and parameter logic
+    parser = argparse.ArgumentParser(description="Extract masked cells from normalized images and save them as individual .tif files.")
+    parser.add_argument("path", type=str, help="Path to images directory.")
+    parser.add_argument("type", choices=['mask', 'image', 'both'], help='Choose which image(s) you want to extract.')
+    parser.add_argument("-c", "--cell_count", type=int, default=1, help="Starting cell count, useful to add cells to existing dataset.")
+    parser.add_argument("-e", "--export", choices=cell_export.EXPORT_FORMATS, default="files",
+                        help="Export format: one .tif file per cell (files), multi-page .tif stacks (tiff) or .npz arrays "
+                             "(npz). Stacks are indexed in cell_index.tsv.")
+    parser.add_argument("--chunk", type=int, default=1000, help="Number of cells per stack (tiff and npz formats).")
+    parser.add_argument("-j", "--jobs", type=int, default=1,
+                        help="Number of images processed in parallel. Cells get the same numbers as in a serial run.")
+    parser.add_argument("--profile", type=str, nargs="?", const="", metavar="TRACE",
+                        help="Record the time and memory of every stage. Saves the trace to TRACE.json and TRACE.csv "
+                             "(default: <path>/extract_profile)")
+    parser.add_argument("--profile-stage", type=str, action="append", default=[], metavar="STAGE",
+                        help="Also profile a stage with cProfile. Can be used several times")
+
+    args = parser.parse_args()
+
+    experiment_folder = args.path
+    image_type = args.type
+    cell_count = args.cell_count
+    export_format = args.export
+    jobs = args.jobs
+
+    if args.profile is not None:
+        profiling.enable(cprofile_stages=args.profile_stage)
+        if jobs > 1:
+            print("Profiling: the stages of images processed in worker processes are not recorded. Use -j 1 to "
+                  "profile every stage.")
+
+    if cell_count != 1:
+        print("Starting at cell count: {}".format(cell_count))
+
+    # Look for normalization files inside given path
+    frames = find_frames(experiment_folder)
+
+    if jobs > 1:
+        # First pass: counts the cells of every image in parallel and assigns a range of cell numbers to each image
+        counts = []
+        for root, n, e in pipeline.map_frames(count_cells, frames, jobs=jobs):
+            if e is not None:
+                print(f"{root}\nImage could not be processed due to an exception:\n{e}")
+                exit()
+            counts.append(n)
+        starts = cell_count + np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(int)
+
+        # Second pass: extracts and saves the cells of every image in parallel. Stacks are written per image in a
+        # temporary folder, then copied in chunks of --chunk cells in the order of the serial run
+        stacked = export_format != "files"
+        out_root = tempfile.mkdtemp(prefix=".extract_", dir=experiment_folder) if stacked else experiment_folder
+        writer = cell_export.make_writer(experiment_folder, image_type, fmt=export_format, chunk=args.chunk,
+                                         background=False) if stacked else None
+
+        tasks = [(root, int(start)) for root, start in zip(frames, starts)]
+        try:
+            for (root, start), rows, e in pipeline.map_frames(extract_frame, tasks, jobs=jobs, image_type=image_type,
+                                                               out_root=out_root, export_format=export_format,
+                                                               chunk=args.chunk):
+                print(root)
+                if e is not None:
+                    print(f"Image could not be processed due to an exception:\n{e}")
+                    exit()
+                if stacked:
+                    cell_export.merge_stacks(writer, out_root, rows)
+                else:
+                    cell_export.write_index(experiment_folder, rows)  # Index rows are written in the serial order
+                if rows:
+                    print(f"Saved {start} to {start + len(rows) - 1}")
+        finally:
+            if stacked:
+                writer.close()
+                shutil.rmtree(out_root, ignore_errors=True)
+
+    else:
+        # Crops are written in a background thread while the next cells are extracted
+        writer = cell_export.make_writer(experiment_folder, image_type, fmt=export_format, chunk=args.chunk)
+
+        for root in frames:
+            print(root)
+            cell_count = save_cells(root, image_type, cell_count, writer=writer)
 
-if cell_count != 1:
-    print("Starting at cell count: {}".format(cell_count))
+        with profiling.stage("close_writer"):
+            writer.close()
 
-# Look for normalization files inside given path
-for root, dirs, files in os.walk(experiment_folder):
-    dirs.sort(key=natural_keys)  # Sort directories in human order
-    for file in files:
-        if file.endswith('.mat'):
-            print(root)
-            cell_count = save_cells(root, image_type, cell_count)
+    profiling.report(args.profile or os.path.join(experiment_folder, "extract_profile"))
@@ -5,14 +5,18 @@ import numpy as np
 
 import argparse
 
+import cell_export
+import output
+import stats as st
+
 def print_output_stats(data, class_group) -> None:
     """
-    Prints the output of the analysis extracted from pd.DataFrame.describe().
+    Prints the output of the analysis calculated by stats.summarize().
     data: pd.DataFrame containing the FXm data.
     class_group: string with the name of the classification group to print stats for.
     """
 
-    stats = data.loc[data["DetecDivGroup"] == class_group, "Volume"].describe()
+    stats = st.summarize(data["Volume"], data["DetecDivGroup"] == class_group).iloc[0]
 
     cell_count = int(stats["count"])
     mean_vol = stats["mean"]
@@ -20,7 +24,7 @@ def print_output_stats(data, class_group) -> None:
     min_vol = stats["min"]
     Q1_vol = stats["25%"]
     med_vol = stats["50%"]
-    mad = data.loc[data["DetecDivGroup"] == class_group, "Volume"].mad()
+    mad = stats["mad"]
     Q3_vol = stats["75%"]
     max_vol = stats["max"]
     
@@ -37,26 +41,175 @@ def print_output_stats(data, class_group) -> None:
     #print(f"{'3rd quartile:':16}{Q3_vol:.1f} µm3")
     #print(f"{'Max. volume:':16}{max_vol:.1f} µm3")
 
+def load_classification(mat_file):
+    """
+    Reads the classes of a DetecDiv result file, in the order of the classified cells.
+    mat_file: path to the .mat file saved by DetecDiv.
+
+    Returns an array with the class of every cell, as strings.
+    """
+    mat = loadmat(mat_file)
+    data = mat['results'].item()[0][0][0][0][0]
+
+    # Cell arrays of strings are read as arrays of 1-element arrays
+    classes = np.asarray(data, dtype=object).ravel()
+    return np.array([str(c.ravel()[0]) if isinstance(c, np.ndarray) and c.size == 1 else str(c) for c in classes])
+
+
+def classification_table(mat_files, first_cells=None) -> pd.DataFrame:
+    """
+    Numbers the classified cells of one or several DetecDiv result files.
+    mat_files: list of .mat files. Each file classifies consecutive cells (cell numbers of detecdiv_extract_cells.py).
+    first_cells: number of the first cell of every file. Default: the files follow each other, starting at cell 1.
+
+    Returns a DataFrame with the Cell number and DetecDivGroup of every classified cell.
+    """
+    tables = []
+    next_cell = 1
+    for i, mat_file in enumerate(mat_files):
+        classes = load_classification(mat_file)
+        first = first_cells[i] if first_cells else next_cell
+        tables.append(pd.DataFrame({"Cell": np.arange(first, first + len(classes)), "DetecDivGroup": classes}))
+        next_cell = first + len(classes)
+
+    table = pd.concat(tables, ignore_index=True)
+    if table["Cell"].duplicated().any():
+        print("Warning: several result files classify the same cells. The last class of every cell is kept.")
+        table = table.drop_duplicates("Cell", keep="last")
+    return table
+
+
+def find_index(fxm_file):
+    """
+    Looks for the cell index written by detecdiv_extract_cells.py next to the FXm analysis file
+    (<folder>/cell_index.tsv) or in the folder of the strain (<folder>/<strain>/cell_index.tsv for <strain>_A.tsv).
+
+    Returns the path to the index file, or None if it does not exist.
+    """
+    root = os.path.splitext(fxm_file)[0]
+    for strain_suffix in ("_A", "_M"):
+        if root.endswith(strain_suffix):
+            root = root[:-len(strain_suffix)]
+    for folder in (os.path.dirname(fxm_file), root):
+        index_file = os.path.join(folder, cell_export.INDEX_FILE)
+        if os.path.isfile(index_file):
+            return index_file
+    return None
+
+
+def frame_keys(paths, depth):
+    """
+    Shortens frame paths to their last folders, so that the frames of an experiment that was moved or copied still
+    match.
+    paths: frame paths (Path column).
+    depth: number of folders kept (1 for pos0, 2 for strainA/pos0...).
+
+    Returns an array with the key of every path. Every distinct path is only split once.
+    """
+    codes, uniques = pd.factorize(np.asarray(paths, dtype=object))
+    keys = np.array(["/".join(str(p).replace("\\", "/").rstrip("/").split("/")[-depth:]) for p in uniques],
+                    dtype=object)
+    return keys[codes] if len(keys) else np.zeros(len(codes), dtype=object)
+
+
+def join_classification(vm_df, classes, index) -> pd.Series:
+    """
+    Matches the classified cells to the rows of the FXm table by their frame (Path) and ID, with hash joins.
+    If the frames of the index do not match the FXm table (e.g. the experiment was moved between the analysis and the
+    export), the frames are matched by their last folders instead, as long as they identify a single frame.
+    vm_df: FXm analysis table.
+    classes: DataFrame with the Cell number and DetecDivGroup of every classified cell (see classification_table).
+    index: cell index (see cell_export.read_index).
+
+    Returns the DetecDivGroup of every row of vm_df (NaN for the cells that were not classified).
+    """
+    keyed = classes.merge(index[["Cell", "Path", "ID"]], on="Cell", how="inner", validate="one_to_one")
+    keyed = keyed.drop_duplicates(["Path", "ID"], keep="last")
+
+    def join(class_paths, row_paths):
+        groups = pd.Series(keyed["DetecDivGroup"].to_numpy(),
+                           index=pd.MultiIndex.from_arrays([class_paths, keyed["ID"].to_numpy()]))
+        keys = pd.MultiIndex.from_arrays([row_paths, np.asarray(vm_df["ID"])])
+        return pd.Series(groups.reindex(keys).to_numpy(), index=vm_df.index)
+
+    joined = join(keyed["Path"].to_numpy(dtype=object), np.asarray(vm_df["Path"], dtype=object))
+    if joined.notna().sum() == len(keyed) or keyed.empty or vm_df.empty:
+        return joined
+
+    # Shortest path ends that still tell the frames apart, in the index and in the FXm table
+    index_paths, row_paths = keyed["Path"].unique(), pd.unique(np.asarray(vm_df["Path"], dtype=object))
+    paths = np.concatenate([index_paths, row_paths])
+    depth = max(len(str(p).replace("\\", "/").strip("/").split("/")) for p in paths)
+    for d in range(1, depth + 1):
+        if (len(set(frame_keys(index_paths, d))) == len(index_paths)
+                and len(set(frame_keys(row_paths, d))) == len(row_paths)):
+            by_folder = join(frame_keys(keyed["Path"], d), frame_keys(vm_df["Path"], d))
+            if by_folder.notna().sum() > joined.notna().sum():
+                print(f"Warning: the frames of the cell index do not match the Path column. Frames are matched by "
+                      f"their last {d} folder(s).")
+                return by_folder
+            break
+    return joined
+
+
 # User interaction and parameter logic
 parser = argparse.ArgumentParser(description="Extract DetecDiv classification and calculate volume of experiment.")
-parser.add_argument("path", type=str, help="Path to .tsv.")
-parser.add_argument("classification", type=str, help="Path to .mat file with clasification")
+parser.add_argument("path", type=str, help="Path to .tsv, .parquet or .feather FXm analysis file.")
+parser.add_argument("classification", type=str, nargs="+",
+                    help="Path to .mat file with clasification. Several files classifying consecutive cells (e.g. "
+                         "shards of the same export) can be given")
+parser.add_argument("-i", "--index", type=str,
+                    help="Cell index written by detecdiv_extract_cells.py (default: cell_index.tsv next to the FXm "
+                         "file or in the strain folder)")
+parser.add_argument("--first-cell", type=int, nargs="+", metavar="N",
+                    help="Number of the first cell classified by each .mat file (default: the files follow each "
+                         "other, starting at cell 1)")
 parser.add_argument("-g", "--group", type=str, help="Classification group name to print experiment stats for.", required=False)
+parser.add_argument("-s", "--summary-by", type=str, action="append", default=[], metavar="COLUMN",
+                    help="Save the volume statistics of every classification group for every value of COLUMN "
+                         "(e.g. Path) to <FXm file>_D_summary. Can be used several times")
+parser.add_argument("--bootstrap", type=int, nargs="?", const=10000, default=0, metavar="N",
+                    help="Add bootstrap confidence intervals of the mean and median volumes, with N resamples "
+                         "(default: 10000), to the summary")
+parser.add_argument("--ci", type=float, default=0.95, help="Confidence level of the bootstrap intervals")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator of the bootstrap")
 
 args = parser.parse_args()
-mat_file = args.classification
+mat_files = args.classification
 class_group = args.group
 
-# Extract classification data from matlab file
-mat = loadmat(mat_file)
-data = mat['results'].item()[0][0][0][0][0]
+if args.first_cell and len(args.first_cell) != len(mat_files):
+    print("Give the first cell of every .mat file.")
+    exit()
 
-# Convert classification data to pd DataFrame as string
-class_df = pd.DataFrame(data, columns={"DetecDivGroup"})
+# Extract classification data from matlab files
+class_df = classification_table(mat_files, args.first_cell)
 
 # Open FXm data and add the new classification column
-vm_df = pd.read_csv(args.path, sep="\t", index_col=0)
-vm_df["DetecDivGroup"] = class_df["DetecDivGroup"].astype(str)
+vm_df = output.load_table(args.path)
+
+index_file = args.index or find_index(args.path)
+if index_file is not None:
+    # Cells are matched by their frame and ID, whatever the order of the rows
+    index = cell_export.read_index(index_file)
+    vm_df["DetecDivGroup"] = join_classification(vm_df, class_df, index)
+    matched = vm_df["DetecDivGroup"].notna().sum()
+    print(f"{matched} of {len(vm_df)} cells classified ({len(class_df)} classes, index {index_file})")
+    if matched == 0:
+        print(f"No classified cell matches a row of {args.path}. Check that the cell index and the classification "
+              f"come from the same experiment.")
+        exit()
+    if matched < len(class_df) / 2:
+        print(f"Warning: only {matched} of the {len(class_df)} classified cells match a row of {args.path}. Check "
+              f"that the cell index and the classification come from the same experiment.")
+elif len(mat_files) == 1 and not args.first_cell:
+    # Old exports without index: the crops were saved in the order of the rows of the FXm file
+    print(f"Warning: no {cell_export.INDEX_FILE} found. Classes are assigned to the rows in order.")
+    vm_df["DetecDivGroup"] = class_df["DetecDivGroup"].astype(str)
+else:
+    print(f"No {cell_export.INDEX_FILE} found: several result files can only be merged with the cell index. "
+          f"Use -i to give its path.")
+    exit()
 
 if class_group:
     
@@ -67,11 +220,17 @@ if class_group:
     
     print_output_stats(vm_df, class_group)
 
-# Save the new data
-tsv_file_name = os.path.splitext(os.path.basename(args.path))[0]  # Get name of FXm .tsv file, without extension
-expt_folder = os.path.dirname(args.path)  # Get path to FXm .tsv file
+# Save the new data, in the same format as the FXm file
+tsv_file_name, ext = os.path.splitext(os.path.basename(args.path))  # Get name of FXm file, without extension
+expt_folder = os.path.dirname(args.path)  # Get path to FXm file
 
-output_file = os.path.join(expt_folder, f"{tsv_file_name}_D.tsv")
-vm_df.to_csv(output_file, sep="\t")
+output_file = os.path.join(expt_folder, f"{tsv_file_name}_D{ext}")
+output.save_table(vm_df, output_file)
 
 print(f"DetecDiv filtered data saved to {output_file}")
+
+if args.summary_by:
+    summary_file = os.path.join(expt_folder, f"{tsv_file_name}_D_summary{ext}")
+    output.save_table(st.grouped_summary(vm_df, args.summary_by + ["DetecDivGroup"], n_boot=args.bootstrap,
+                                         ci=args.ci, seed=args.seed), summary_file)
+    print(f"Summary saved to {summary_file}")
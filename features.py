@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+
+import autoSegment as auto
+from background import LocalBackground
+
+
+def shape_features(cells, pixel_size=0.325, sums=None):
+    """
+    Calculates shape descriptors of every labeled region from its second moments, in a single pass over the label
+    image. Length and width are the axes of the ellipse with the same second moments (long axis of rod-shaped cells)
+    :param cells: labeled image with cell selections (background = 0)
+    :param pixel_size: size of a pixel (µm)
+    :param sums: autoSegment.LabelSums of the label image, if already calculated
+    :return shape: DataFrame indexed by label (background excluded) with the "Area" (µm2), "Length" and "Width" (µm),
+    "Aspect Ratio" and "Eccentricity" of every region
+    """
+    if sums is None:
+        sums = auto.LabelSums(cells)
+    rows, cols = sums.coords
+    rows, cols = rows.astype(float), cols.astype(float)
+
+    mean_r, mean_c = sums.mean(rows), sums.mean(cols)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        var_r = sums.mean(rows ** 2) - mean_r ** 2
+        var_c = sums.mean(cols ** 2) - mean_c ** 2
+        cov = sums.mean(rows * cols) - mean_r * mean_c
+
+        # Eigenvalues of the covariance matrix of the pixel coordinates
+        half_sum = (var_r + var_c) / 2
+        half_diff = np.sqrt(((var_r - var_c) / 2) ** 2 + cov ** 2)
+        major = half_sum + half_diff
+        minor = np.maximum(half_sum - half_diff, 0)
+
+        length = 4 * np.sqrt(major)
+        width = 4 * np.sqrt(minor)
+        eccentricity = np.sqrt(1 - minor / major)
+        aspect = length / width
+
+    return pd.DataFrame({"Area": sums.area * pixel_size ** 2,
+                         "Length": length * pixel_size,
+                         "Width": width * pixel_size,
+                         "Aspect Ratio": aspect,
+                         "Eccentricity": eccentricity},
+                        index=pd.RangeIndex(1, sums.n_labels + 1, name="label"))
+
+
+def channel_features(img, cells, bg_mask, centers, bg_box=200, bg_estimator="median", bg_tile=None, sums=None):
+    """
+    Calculates the intensity statistics of every labeled region in an image of another channel, and the local
+    background of the channel around every region
+    :param img: image of the channel (same size as the label image)
+    :param cells: labeled image with cell selections (background = 0)
+    :param bg_mask: mask with background = 0 and cells and pillars > 0
+    :param centers: array of shape (n_labels, 2) with the (row, column) center of every region
+    :param bg_box: side of the box around each cell used to calculate the local background (px)
+    :param bg_estimator: estimator of the local background ("median" or "trimmed_mean")
+    :param bg_tile: side of the tiles of the shared background grid (px). None calculates the exact estimator per cell
+    :param sums: autoSegment.LabelSums of the label image, if already calculated
+    :return stats: DataFrame indexed by label (background excluded) with the "Mean", "Integrated" and "Max" intensities,
+    the local "Background" and the background-corrected "Net Mean" and "Net Integrated" intensities
+    """
+    if img.shape != cells.shape:
+        raise ValueError(f"The channel image ({img.shape}) and the mask ({cells.shape}) have different sizes")
+
+    if sums is None:
+        sums = auto.LabelSums(cells)
+    stats = auto.marker_stats(img, cells, sums=sums)
+    stats.columns = ["Mean", "Integrated", "Max"]
+
+    background = LocalBackground(img, bg_mask, box_size=bg_box, estimator=bg_estimator, tile=bg_tile)
+    stats["Background"] = background.at(centers) if len(stats) else np.zeros(0)
+
+    stats["Net Mean"] = stats["Mean"] - stats["Background"]
+    stats["Net Integrated"] = stats["Integrated"] - stats["Background"] * sums.area
+
+    return stats
+
+
+def cell_features(cells, bg_mask, centers, channels=None, shape=True, pixel_size=0.325, bg_box=200,
+                  bg_estimator="median", bg_tile=None, sums=None):
+    """
+    Calculates the features of every cell: shape descriptors and the statistics of every additional channel.
+    New features are added by joining their table (indexed by label) here
+    :param cells: labeled image with cell selections (see autoSegment.segment)
+    :param bg_mask: mask with background = 0 and cells and pillars > 0
+    :param centers: array of shape (n_labels, 2) with the (row, column) center of every region
+    :param channels: dictionary {channel name: image}. Columns are prefixed with the name of the channel
+    :param shape: if True, calculates the shape descriptors (see shape_features)
+    :param pixel_size: size of a pixel (µm)
+    :param bg_box: see channel_features
+    :param bg_estimator: see channel_features
+    :param bg_tile: see channel_features
+    :param sums: autoSegment.LabelSums of the label image, if already calculated
+    :return features: DataFrame with a row per label (in the order of the labels, background excluded)
+    """
+    # The foreground pixels are found once for all the features
+    if sums is None:
+        sums = auto.LabelSums(cells)
+    tables = [pd.DataFrame(index=pd.RangeIndex(1, sums.n_labels + 1, name="label"))]
+
+    if shape:
+        tables.append(shape_features(cells, pixel_size=pixel_size, sums=sums))
+
+    for name, img in (channels or {}).items():
+        stats = channel_features(img, cells, bg_mask, centers, bg_box=bg_box, bg_estimator=bg_estimator,
+                                 bg_tile=bg_tile, sums=sums)
+        tables.append(stats.add_prefix(f"{name} "))
+
+    return pd.concat(tables, axis=1).reset_index(drop=True)
@@ -1,20 +1,39 @@
 import numpy as np
 import matplotlib.pyplot as plt
 from matplotlib.widgets import RadioButtons
-import autoSegment as auto
 import mahotas as mh
-import pandas as pd
 import os.path
 import argparse
 
+import classify
+import interactive as inter
+import loader
+from curation import CurationStore, curation_file
+import output
+import pipeline
+import profiling
+import stats as st
 
-def on_click(event):
+
+def group_label(group):
+    """
+    :return label, color: text and color of the label of a group
+    """
+    palette = ["lime", "yellow", "cyan", "darkorange", "skyblue", "salmon", "blueviolet", "lightgray"]
+    if group == 0:
+        return "None", "red"
+    return f"G{group}", palette[group % len(palette) - 1]
+
+
+def on_click(event, ax, preselection, ng):
     """
     Executed when user clicks on an object.
     Changes group assigned to object and displays it accordingly.
+    :param event: matplotlib click event
+    :param ax: subplot of every object (None for the objects that are not displayed)
+    :param preselection: group of every object. Updated with the new group
+    :param ng: number of groups
     """
-    global ix
-    ix = event.xdata
     axes = event.inaxes
 
     if not axes or not axes in ax:  # Catches when user does not click on an image
@@ -24,8 +43,6 @@ def on_click(event):
     index = ax.index(axes)
 
     # Group handling
-    palette = ["lime", "yellow", "cyan", "darkorange", "skyblue", "salmon", "blueviolet", "lightgray"]
-    global ng
     old_group = preselection[index]
     
     if event.button == 1:
@@ -34,22 +51,90 @@ def on_click(event):
         new_group = (old_group - 1) % (ng + 1)
 
     # Formats group labels
-    if new_group == 0:
-        group_label = "None"
-        group_color = "red"
-
-    else:
-        group_label = f"G{new_group}"
-        group_color = palette[new_group % len(palette) - 1]
+    label, color = group_label(new_group)
 
     axes.texts[-1].remove()
-    axes.text(10, 100, group_label, bbox=dict(facecolor=group_color, alpha=1))
+    axes.text(10, 100, label, bbox=dict(facecolor=color, alpha=1))
     plt.draw()
 
     preselection[index] = new_group
 
 
-def filter_cells(img, marker, mask, cells_df, path=None, ng=0):
+def image_files(file, fxm_prefix=None, marker_prefix=None):
+    """
+    :param file: path of the FXm image without extension (Path column of the analysis file)
+    :param fxm_prefix: prefix of the FXm file name
+    :param marker_prefix: prefix of the marker file name. None if there is no marker image
+    :return fxm_file, marker_file, mask_file: image files of the frame (marker_file is None without marker_prefix)
+    """
+    marker_file = file.replace(fxm_prefix, marker_prefix) + ".tif" if marker_prefix else None
+    return file + ".tif", marker_file, file + "_maskFram1.png"
+
+
+def load_images(file, fxm_prefix=None, marker_prefix=None, images=None):
+    """
+    Loads the images of a frame
+    :param file: path of the FXm image without extension (Path column of the analysis file)
+    :param fxm_prefix: prefix of the FXm file name
+    :param marker_prefix: prefix of the marker file name. None if there is no marker image
+    :param images: loader.ImageCache used to read the images. None reads them directly
+    :return img, marker, mask: FXm image, marker image (None without marker_prefix) and segmentation mask
+    """
+    imread = mh.imread if images is None else images.get
+    fxm_file, marker_file, mask_file = image_files(file, fxm_prefix, marker_prefix)
+
+    img = imread(fxm_file)
+    marker = imread(marker_file) if marker_file else None
+    mask = imread(mask_file)
+
+    return img, marker, mask
+
+
+def prepare_frame(file, centers, images=None, fxm_prefix=None, marker_prefix=None):
+    """
+    Loads the images of a frame and crops its cells.
+    Used to prepare the next frame in the background while the user groups the cells of the current one
+    :param file: path of the FXm image without extension (Path column of the analysis file)
+    :param centers: dictionary {file: array of shape (n, 2) with the centers of the objects of the frame}
+    :param images: loader.ImageCache used to read the images. None reads them directly
+    :param fxm_prefix: prefix of the FXm file name
+    :param marker_prefix: prefix of the marker file name. None if there is no marker image
+    :return img, marker, mask, tiles, marker_tiles: images of the frame (see load_images) and images of the objects
+    in both channels (see interactive.make_tiles)
+    """
+    with profiling.stage("load_images", frame=file):
+        img, marker, mask = load_images(file, fxm_prefix, marker_prefix, images)
+
+    with profiling.stage("make_tiles", frame=file):
+        tiles = inter.make_tiles(img, mask, centers[file])
+        marker_tiles = inter.make_tiles(marker, mask, centers[file]) if marker is not None else None
+
+    return img, marker, mask, tiles, marker_tiles
+
+
+def frame_features(file, centers, images=None, fxm_prefix=None, marker_prefix=None):
+    """
+    Loads the marker image and the mask of a frame and calculates the marker statistics of its cells
+    :param file: path of the FXm image without extension (Path column of the analysis file)
+    :param centers: dictionary {file: array of shape (n, 2) with the centers of the objects of the frame}
+    :param images: loader.ImageCache used to read the images. None reads them directly
+    :param fxm_prefix: prefix of the FXm file name
+    :param marker_prefix: prefix of the marker file name
+    :return features: DataFrame with the features of every object of the frame (see classify.marker_features)
+    """
+    imread = mh.imread if images is None else images.get
+    _, marker_file, mask_file = image_files(file, fxm_prefix, marker_prefix)
+
+    with profiling.stage("load_images", frame=file):
+        marker = imread(marker_file)
+        mask = imread(mask_file)
+
+    with profiling.stage("marker_features", frame=file):
+        return classify.marker_features(marker, mask, centers[file])
+
+
+def filter_cells(img, marker, mask, cells_df, path=None, ng=0, tiles=None, marker_tiles=None, groups=None,
+                 show=None):
     """
     Displays segmented cells and allows the user to assign them to different groups
     :param img: original image
@@ -58,55 +143,57 @@ def filter_cells(img, marker, mask, cells_df, path=None, ng=0):
     :param cells_df: DataFrame with volume data
     :param path: path of the image being analyzed. Will be displayed as the window title.
     :param ng: Number of groups to classify the cells in
-    :return df: DataFrame with updated "Filtered" column (True for discarded objects)
+    :param tiles: images of the objects already calculated by interactive.make_tiles. None calculates them
+    :param marker_tiles: same for the marker image
+    :param groups: initial group of every object (e.g. assigned automatically). Default: group 1
+    :param show: bool array, True for the objects to display. Default: the objects accepted as cells
+    :return preselection: group of every object (0 for the objects that are not displayed)
     """
     print(path)
 
-    img_size = img.shape[0]
-
-    # Initializes bool list with groups.
-    global preselection
-    if "ManualFilter" in cells_df.head():
-        # Analysis file from manual mode: Only shows objects accepted as cells
-        preselection = list(cells_df["ManualFilter"] == False)
-        if sum(preselection) == 0:
-            # There are no cells
-            preselection = [0] * len(cells_df["Volume"])
-            print("There are no cells in this image")
-            return preselection
-
+    centers = cells_df[["Center X", "Center Y"]].to_numpy()
+    if tiles is None:
+        tiles = inter.make_tiles(img, mask, centers)
+    if marker_tiles is None and marker is not None:
+        marker_tiles = inter.make_tiles(marker, mask, centers)
+
+    # Initializes list with groups.
+    if show is None:
+        if "ManualFilter" in cells_df.head():
+            # Analysis file from manual mode: Only shows objects accepted as cells
+            show = cells_df["ManualFilter"] == False
         else:
-            n_cells = sum(preselection)  # Number of cells to show (+1 for the radiobutton)
+            # Analysis file from automatic mode: Shows all objects
+            show = [True] * len(cells_df["Volume"])
+    show = np.asarray(show, dtype=bool)
 
-    else:
-        # Analysis file from automatic mode: Shows all objects
-        n_cells = len(cells_df["Volume"]) # Number of cells to show (all, +1 for the radiobutton)
-        preselection = [True] * n_cells
+    initial = np.ones(len(show), dtype=int) if groups is None else np.asarray(groups, dtype=int)
+    preselection = np.where(show, initial, 0).tolist()
+
+    n_cells = int(show.sum())  # Number of cells to show (+1 for the radiobutton)
+    if n_cells == 0:
+        # There are no cells
+        print("There are no cells in this image")
+        return preselection
 
     # Plotting parameters
-    rows = np.ceil(np.sqrt(n_cells + 1))
+    rows = int(np.ceil(np.sqrt(n_cells + 1)))
     columns = rows
     fig = plt.figure(figsize=(16, 9))  # Adapts these parameters for smaller screens
     fig.suptitle(path)
 
-    centers = cells_df[["Center X", "Center Y"]].to_numpy()
-
     # Saves subplots in a list to be able to access them
-    global ax, fxm_list, marker_list
     ax = []
     fxm_list = []
     marker_list = []
 
     j = 0  # Counts objects that have been shown
-    for i, pix in enumerate(centers):
+    for i in range(len(centers)):
         # Checks if item should be displayed
-        if not preselection[i]:
-            preselection[i] = 0  # Sets group to 0
+        if not show[i]:
             ax.append(None)
             continue
 
-        preselection[i] = 1  # Sets here the initial group
-
         # Adds new empty plot to selection window
         subp = fig.add_subplot(rows, columns, j + 1)
 
@@ -116,25 +203,17 @@ def filter_cells(img, marker, mask, cells_df, path=None, ng=0):
         ax.append(subp)
 
         # Creates group label
-        ax[-1].text(10, 100, 'G1', bbox=dict(facecolor='lime', alpha=1))
-
-        # Gets center coordinates of object
-        x = int(pix[0])
-        y = int(pix[1])
+        label, color = group_label(preselection[i])
+        ax[-1].text(10, 100, label, bbox=dict(facecolor=color, alpha=1))
 
-        # Gets 200x200 pixels area around object
-        [x0, x1, y0, y1] = auto.get_bg_box(x, y, img_size=img_size)
-        msk_img = img[x0:x1, y0:y1] * (mask[x0:x1, y0:y1] > 0)
-
-        fxm_img = plt.imshow(msk_img)
+        # 200x200 pixels area around object
+        fxm_img = plt.imshow(tiles[i])
         fxm_list.append(fxm_img)
 
         if type(marker) != type(None):
-            msk_marker = marker[x0:x1, y0:y1] * (mask[x0:x1, y0:y1] > 0)
-
             # Changes the color map if your marker is not red
             # You can edit vmin and vmax values to change the display of the marker
-            marker_img = plt.imshow(msk_marker, cmap=plt.cm.Reds, alpha=1, vmin=250, vmax=450)
+            marker_img = plt.imshow(marker_tiles[i], cmap=plt.cm.Reds, alpha=1, vmin=250, vmax=450)
             marker_list.append(marker_img)
 
         # Uncomments next line to draw point to identify cell
@@ -142,11 +221,11 @@ def filter_cells(img, marker, mask, cells_df, path=None, ng=0):
 
         j += 1  # Update counter of displayed objects
 
-    cid = fig.canvas.mpl_connect('button_press_event', on_click)  # Listens for click on object
+    # Listens for click on object
+    cid = fig.canvas.mpl_connect('button_press_event', lambda event: on_click(event, ax, preselection, ng))
 
     if type(marker) != type(None):
         def change_channel(label):
-            global ax, fxm_list, marker_list
             if label == "FXm":
                 for c, v in enumerate(fxm_list):
                     v.set_alpha(1)
@@ -181,22 +260,26 @@ def filter_cells(img, marker, mask, cells_df, path=None, ng=0):
     return preselection
 
 
-def print_group_stats(data, group_number):
+def print_group_stats(data, group_number, stats=None, ci=0.95):
     """
-    Prints the output of the analysis extracted from pd.DataFrame.describe()
+    Prints the output of the analysis calculated by stats.summarize()
+    :param data: DataFrame with the volume data and the Group column
+    :param group_number: group to print. 0 prints all the groups together (except the discarded objects)
+    :param stats: statistics of the group (row of stats.grouped_summary). None calculates them
+    :param ci: confidence level of the bootstrap intervals, if stats includes them
     """
 
     if group_number != 0:
         # Get data from group
-        stats = data.loc[data["Group"] == group_number, "Volume"].describe()
-        mad = data.loc[data["Group"] == group_number, "Volume"].mad()
+        if stats is None:
+            stats = st.summarize(data["Volume"], data["Group"] == group_number).iloc[0]
         print("-" * 40)
-        print(f"DATA FOR GROUP {i}:")
+        print(f"DATA FOR GROUP {group_number}:")
         print("-" * 40)
     else:
         # Get data from all groups except 0 (discarded objects)
-        stats = data.loc[data["Group"] != 0, "Volume"].describe()
-        mad = data.loc[data["Group"] != 0, "Volume"].mad()
+        if stats is None:
+            stats = st.summarize(data["Volume"], data["Group"] != 0).iloc[0]
         print("-" * 40)
         print(f"DATA FOR ALL GROUPS:")
         print("-" * 40)
@@ -209,6 +292,7 @@ def print_group_stats(data, group_number):
     med_vol = stats["50%"]
     Q3_vol = stats["75%"]
     max_vol = stats["max"]
+    mad = stats["mad"]
     
     print(f"Total number\n{'of objects:':18}{len(data)}")
     if group_number != 0:
@@ -229,15 +313,49 @@ def print_group_stats(data, group_number):
         print(f"{'3rd quartile:':18}{Q3_vol:.1f} µm3")
         print(f"{'Max. volume:':18}{max_vol:.1f} µm3")
 
+        if "mean_low" in stats:
+            print()
+            print(f"Bootstrap {ci * 100:g} % confidence intervals:")
+            print(f"{'Mean volume:':18}[{stats['mean_low']:.1f}, {stats['mean_high']:.1f}] µm3")
+            print(f"{'Median:':18}[{stats['median_low']:.1f}, {stats['median_high']:.1f}] µm3")
+
 
 # User interaction and parameter logic
 parser = argparse.ArgumentParser(description="Separate FXm cells in groups")
-parser.add_argument("path", type=str, help="Path to .tsv analysis file")
+parser.add_argument("path", type=str, help="Path to .tsv, .parquet or .feather analysis file")
 parser.add_argument("-g", "--groups", type=int, help="Number of groups to classify the cells in.")
 # TODO deal with prefix arguments properly
 parser.add_argument("-f", "--fxm-prefix", type=str, help="Prefix of the fxm file name (e.g. FITC, for FITC-1.tif file)")
 parser.add_argument("-m", "--marker-prefix", type=str,
                     help="Prefix of the marker file name (e.g. mCherry, for mCherry-1.tif file)")
+parser.add_argument("--profile", type=str, nargs="?", const="", metavar="TRACE",
+                    help="Record the time and memory of every stage. Saves the trace to TRACE.json and TRACE.csv "
+                         "(default: <analysis file>_profile)")
+parser.add_argument("--profile-stage", type=str, action="append", default=[], metavar="STAGE",
+                    help="Also profile a stage with cProfile. Can be used several times")
+parser.add_argument("-s", "--summary-by", type=str, action="append", default=[], metavar="COLUMN",
+                    help="Save the volume statistics of every group for every value of COLUMN (e.g. Path) to "
+                         "<analysis file>_grp_summary. Can be used several times")
+parser.add_argument("--bootstrap", type=int, nargs="?", const=10000, default=0, metavar="N",
+                    help="Calculate bootstrap confidence intervals of the mean and median volumes with N resamples "
+                         "(default: 10000)")
+parser.add_argument("--reapply", action="store_true",
+                    help="Apply the groups saved by previous sessions without opening any window. Frames that were not "
+                         "grouped are left out")
+parser.add_argument("-a", "--auto", action="store_true",
+                    help="Assign the groups automatically from the marker intensity of every cell (requires -m). Only "
+                         "the borderline cells are displayed for review")
+parser.add_argument("--feature", choices=list(classify.FEATURES), action="append", default=[],
+                    help="Marker statistic used to assign the groups automatically (default: mean). Can be used "
+                         "several times to cluster several statistics together")
+parser.add_argument("--marker-thresholds", type=float, nargs="+", metavar="T",
+                    help="Values of the first feature separating the groups (groups - 1 values). Default: k-means "
+                         "clustering of the features")
+parser.add_argument("--borderline", type=float, default=0.1,
+                    help="Cells closer to a threshold than this fraction of the threshold (or almost as close to two "
+                         "k-means centroids) are borderline and displayed for review")
+parser.add_argument("--ci", type=float, default=0.95, help="Confidence level of the bootstrap intervals")
+parser.add_argument("--seed", type=int, default=0, help="Seed of the random generator of the bootstrap")
 
 # Changes the following defaults to match your image filenames
 """
@@ -251,11 +369,12 @@ parser.set_defaults(
 args = parser.parse_args()
 
 path = args.path
-global ng
 ng = args.groups
 fxm_prefix = args.fxm_prefix
 marker_prefix = args.marker_prefix
 
+if args.profile is not None:
+    profiling.enable(cprofile_stages=args.profile_stage)
 
 if os.path.isdir(path):
     print("You provided a folder, not an analysis file. Run main.py first to calculate the volumes!")
@@ -266,40 +385,144 @@ elif not os.path.isfile(path):
     print(f"Path '{path}' does not exist")
     exit()
 
-if ng < 2:
-    print("You need at least 2 groups to separate cells.")
+if (args.auto or not args.reapply) and (ng is None or ng < 2):
+    print("You need at least 2 groups to separate cells: use -g to give the number of groups.")
+    exit()
+
+if args.auto and not marker_prefix:
+    print("Automatic groups are calculated from the marker images: use -m to give the marker prefix.")
     exit()
 
-if marker_prefix:
+if args.auto and args.marker_thresholds and len(args.marker_thresholds) != ng - 1:
+    print(f"{ng} groups need {ng - 1} thresholds.")
+    exit()
+
+if args.reapply and not args.auto:
+    print("Applying the groups saved by previous sessions")
+elif args.auto:
+    print(f"Grouping cells in {ng} groups automatically from the '{marker_prefix}*.tif' marker images")
+elif marker_prefix:
     print(f"Grouping cells in {ng} groups. Using '{fxm_prefix}*.tif' FXm images and '{marker_prefix}*.tif' marker images")
 else:
     print(f"Grouping cells in {ng} groups. Using '{fxm_prefix}*.tif' FXm images")
 
-# Opens .tsv file
-df = pd.read_csv(path, sep='\t', index_col=0)
-# Extracting image filenames from analysis file
-filenames = list(df["Path"].value_counts().index)
-filenames.sort()
-
-# Opens image by image in the interactive window
-for file in filenames:
-    img = mh.imread(file + ".tif")
+# Opens analysis file
+df = output.load_table(path)
 
-    if marker_prefix:
-        marker_file = file.replace(fxm_prefix, marker_prefix) + ".tif"
-        marker = mh.imread(marker_file)
-    else:
-        marker = None
+missing = [c for c in args.summary_by if c not in df.columns]
+if missing:
+    print(f"Columns not found in the analysis file: {', '.join(missing)}")
+    exit()
 
-    mask_file = file + "_maskFram1.png"
-    mask = mh.imread(mask_file)
+# Row positions of every frame, found in a single pass
+rows = df.groupby("Path", sort=False, observed=True).indices
+xy = df[["Center X", "Center Y"]].to_numpy()
+centers = {file: xy[idx] for file, idx in rows.items()}
+
+# Images are read ahead in background threads, LOOKAHEAD frames in advance
+LOOKAHEAD = 2
+images = loader.ImageCache(max_images=3 * (LOOKAHEAD + 2))
+
+borderline = None
+if args.auto:
+    # Marker statistics of all the cells, frame by frame
+    filenames = sorted(rows)
+    features = np.full((len(df), len(classify.FEATURES)), np.nan)
+    failed = np.zeros(len(df), dtype=bool)
+    for file in filenames[:LOOKAHEAD + 1]:
+        images.load(image_files(file, fxm_prefix, marker_prefix)[1:])
+    frames = pipeline.prefetch(frame_features, filenames, centers=centers, images=images, fxm_prefix=fxm_prefix,
+                               marker_prefix=marker_prefix)
+    for i, (file, frame_df, e) in enumerate(frames):
+        if i + LOOKAHEAD + 1 < len(filenames):
+            images.load(image_files(filenames[i + LOOKAHEAD + 1], fxm_prefix, marker_prefix)[1:])
+        if e is not None:
+            # The cells of the frame are left in group 0 and are not reviewed
+            print(f"Marker statistics of {file} could not be calculated due to an exception:\n{e}")
+            failed[rows[file]] = True
+            continue
+        features[rows[file]] = frame_df.to_numpy()
+    for c, column in enumerate(classify.FEATURES.values()):
+        df[column] = features[:, c]
+
+    # Assigns the groups of the objects accepted as cells
+    cells = ~df["ManualFilter"].astype(bool).to_numpy() if "ManualFilter" in df.columns else np.ones(len(df), bool)
+    columns = [classify.FEATURES[f] for f in args.feature or ["mean"]]
+    with profiling.stage("assign_groups"):
+        if args.marker_thresholds:
+            auto_groups, close = classify.threshold_groups(df.loc[cells, columns[0]], args.marker_thresholds,
+                                                           borderline=args.borderline)
+        else:
+            auto_groups, close = classify.kmeans_groups(df.loc[cells, columns].to_numpy(), ng,
+                                                        borderline=args.borderline, seed=args.seed)
+
+    df["Group"] = 0
+    df.loc[cells, "Group"] = auto_groups
+    borderline = np.zeros(len(df), dtype=bool)
+    borderline[cells] = close
+    borderline[failed] = False
+    df["Borderline"] = borderline
+
+    counts = ", ".join(f"G{g}: {(auto_groups == g).sum()}" for g in range(1, ng + 1))
+    print(f"Automatic groups ({'thresholds' if args.marker_thresholds else 'k-means'} on {', '.join(columns)}): "
+          f"{counts}. {int(borderline.sum())} borderline cells")
+
+# Groups are saved after every frame. Frames grouped in previous sessions are not displayed again
+root, ext = os.path.splitext(path)
+curation = CurationStore(curation_file(f"{root}_grp{ext}"), "Group")
+reviewed = curation.apply(df)
+
+# Extracting image filenames from analysis file. In automatic mode, only the frames with borderline cells are reviewed
+pending = ~reviewed if borderline is None else ~reviewed & borderline
+filenames = sorted(df.loc[pending, "Path"].unique())
+
+if args.reapply:
+    if borderline is None:
+        if filenames:
+            print(f"{len(filenames)} frames were not grouped and are left out")
+        df = df.loc[reviewed]
+        rows = df.groupby("Path", sort=False, observed=True).indices
+        if df.empty:
+            print(f"No groups saved in {curation.file}")
+            exit()
+    filenames = []
+elif len(curation):
+    print(f"Curation file: {curation.file} ({len(curation)} frames already grouped, {len(filenames)} left)")
+
+group = df["Group"].to_numpy(dtype=float)
+for file in filenames[:LOOKAHEAD + 1]:
+    images.load(image_files(file, fxm_prefix, marker_prefix))
 
-    partial_df = df.loc[df['Path'] == file]
+# Opens image by image in the interactive window
+# The next frame is cropped in the background while the user groups the current one
+frames = pipeline.prefetch(prepare_frame, filenames, centers=centers, images=images, fxm_prefix=fxm_prefix,
+                           marker_prefix=marker_prefix)
+for i, (file, prepared, e) in enumerate(frames):
+    if i + LOOKAHEAD + 1 < len(filenames):
+        images.load(image_files(filenames[i + LOOKAHEAD + 1], fxm_prefix, marker_prefix))
+    if e is not None:
+        raise e
+    img, marker, mask, tiles, marker_tiles = prepared
+
+    partial_df = df.iloc[rows[file]]
 
     # Pass None if user does not provide marker image
-    groups = filter_cells(img, marker, mask, partial_df, path=file)
+    with profiling.stage("filter_cells", frame=file):
+        if borderline is None:
+            groups = filter_cells(img, marker, mask, partial_df, path=file, ng=ng, tiles=tiles,
+                                  marker_tiles=marker_tiles)
+        else:
+            # Only displays the borderline cells, starting from their automatic group
+            show = borderline[rows[file]]
+            groups = filter_cells(img, marker, mask, partial_df, path=file, ng=ng, tiles=tiles,
+                                  marker_tiles=marker_tiles, groups=group[rows[file]], show=show)
+            groups = np.where(show, groups, group[rows[file]]).astype(int).tolist()
 
-    df.loc[df['Path'] == file, "Group"] = groups
+    group[rows[file]] = groups
+    curation.record(file, partial_df["ID"], groups)
+
+images.close()
+df["Group"] = group
 
 
 df["Group"] = df["Group"].astype(int)
@@ -310,10 +533,27 @@ print("Group information:")
 print(f"Total = {sum(counts)}")
 print(counts)
 """
-for i in range(0, ng + 1):
-    print_group_stats(df, i)
-    print()
+with profiling.stage("statistics"):
+    # Statistics of all the groups in a single pass
+    boot_params = {"n_boot": args.bootstrap, "ci": args.ci, "seed": args.seed}
+    group_stats = st.grouped_summary(df, ["Group"], **boot_params).set_index("Group")
+    all_stats = st.summarize(df["Volume"], df["Group"] != 0, **boot_params).iloc[0]
+    for i in range(0, (ng or int(df["Group"].max())) + 1):
+        if i == 0:
+            stats = all_stats
+        else:
+            stats = group_stats.loc[i] if i in group_stats.index else None
+        print_group_stats(df, i, stats, ci=args.ci)
+        print()
 print("-" * 40)
 
-# Saves .tsv with new column
-df.to_csv(path.replace(".tsv", "_grp.tsv"), sep="\t")
+# Saves analysis file with new column, in the same format
+with profiling.stage("save_output"):
+    output.save_table(df, f"{root}_grp{ext}")
+
+    if args.summary_by:
+        summary_file = f"{root}_grp_summary{ext}"
+        output.save_table(st.grouped_summary(df, args.summary_by + ["Group"], **boot_params), summary_file)
+        print(f"Summary saved to {summary_file}")
+
+profiling.report(args.profile or os.path.splitext(path)[0] + "_profile")
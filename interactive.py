@@ -1,37 +1,205 @@
 import numpy as np
 import matplotlib.pyplot as plt
 import autoSegment as auto
-import mahotas as mh
-import pandas as pd
 
 
-def on_click(event):
+# Number of objects displayed on each page of the selection window
+TILES_PER_PAGE = 40
+
+
+def make_tiles(img, mask, centers, box_size=200):
     """
-    Executed when user clicks on an object.
-    Changes status of the object from selected to deselected (or vice versa)
-    and draws a red line over the image.
+    Crops the 200x200 box around every object, with the background masked out.
+    Boxes clipped by the edges of the image are padded with zeros.
+    :param img: original image
+    :param mask: original segmentation mask
+    :param centers: array of shape (n, 2) with the center of every object (Center X, Center Y)
+    :param box_size: side of the box (px)
+    :return tiles: float32 array of shape (n, box_size, box_size)
     """
-    global ix
-    ix = event.xdata
-    axes = event.inaxes
+    tiles = np.zeros((len(centers), box_size, box_size), dtype=np.float32)
+    for i, pix in enumerate(centers):
+        # Gets 200x200 pixel area around object
+        [x0, x1, y0, y1] = auto.get_bg_box(int(pix[0]), int(pix[1]), img_size=img.shape[0], box_size=box_size)
+        tiles[i, :x1 - x0, :y1 - y0] = img[x0:x1, y0:y1] * (mask[x0:x1, y0:y1] > 0)
+    return tiles
+
 
-    if not axes or not axes in ax:  # Catches when user does not click on an image
-        return
+def grid_shape(n_tiles):
+    """
+    :return rows, columns: grid with at least n_tiles cells, wider than tall to fit a 16:9 window
+    """
+    rows = max(int(np.ceil(np.sqrt(n_tiles * 9 / 16))), 1)
+    columns = max(int(np.ceil(n_tiles / rows)), 1)
+    return rows, columns
 
-    # Finds clicked axes
-    index = ax.index(axes)
 
-    if preselection[index] is False:
-        axes.plot(range(200), range(200), '-', linewidth=3, color="red")
-        plt.draw()
-        preselection[index] = True
-    else:
-        axes.lines[-1].remove()
-        plt.draw()
-        preselection[index] = False
+class CellGallery:
+    """
+    Paged selection window. Displays the objects of a frame a page at a time. Clicking on an object deselects it
+    (red line) or selects it again.
 
+    The subplots are created once and reused by every page. Clicks only redraw the clicked subplot (blitting).
+    Keys: right / n / page down: next page, left / p / page up: previous page, home / end: first / last page,
+    q / escape / enter: close the window.
+    """
 
-def filter_cells(img, mask, cells_df, path=None):
+    def __init__(self, tiles, titles, path=None, per_page=TILES_PER_PAGE, deselected=None):
+        """
+        :param tiles: array of shape (n, 200, 200) with the image of every object (see make_tiles)
+        :param titles: title of every object
+        :param path: path of the analyzed files. Used as the window title
+        :param per_page: number of objects per page
+        :param deselected: initial state of the objects (True for deselected). Default: all selected
+        """
+        self.tiles = tiles
+        self.titles = titles
+        self.path = path
+        self.n_tiles = len(tiles)
+        self.per_page = max(min(per_page, self.n_tiles), 1)
+        self.n_pages = max(int(np.ceil(self.n_tiles / self.per_page)), 1)
+        self.page = 0
+        self.deselected = np.zeros(self.n_tiles, dtype=bool) if deselected is None else np.array(deselected, bool)
+
+        # Color limits of every tile, calculated once
+        self.clims = [(t.min(), t.max()) if t.size else (0, 1) for t in tiles]
+
+        rows, columns = grid_shape(self.per_page)
+        self.fig = plt.figure(figsize=(16, 9))  # Adapts these parameters for smaller screens
+        self.axes = []
+        self.images = []
+        self.lines = []
+        box = tiles.shape[1] if self.n_tiles else 200
+        for j in range(self.per_page):
+            subp = self.fig.add_subplot(rows, columns, j + 1)
+
+            # Formatting options
+            subp.set_yticklabels([])
+            subp.set_xticklabels([])
+            self.images.append(subp.imshow(np.zeros((box, box), dtype=np.float32)))
+
+            # Deselection mark, drawn over the image with blitting (or as a normal artist if the canvas cannot blit)
+            line, = subp.plot(range(box), range(box), '-', linewidth=3, color="red", animated=self.blitting(),
+                              visible=self.blitting())
+            self.axes.append(subp)
+            self.lines.append(line)
+
+        self.backgrounds = []
+        self.fig.canvas.mpl_connect('button_press_event', self.on_click)  # Listens for click on object
+        self.fig.canvas.mpl_connect('key_press_event', self.on_key)
+        self.fig.canvas.mpl_connect('draw_event', self.on_draw)
+
+        # Replaces the default keys of matplotlib (e.g. left and right move through the zoom history)
+        manager = self.fig.canvas.manager
+        if manager is not None and getattr(manager, "key_press_handler_id", None) is not None:
+            self.fig.canvas.mpl_disconnect(manager.key_press_handler_id)
+
+        self.show_page(0)
+
+    def blitting(self):
+        """
+        :return: True if the canvas supports blitting
+        """
+        return getattr(self.fig.canvas, "supports_blit", True)
+
+    def index(self, j):
+        """
+        :return: index of the object displayed in subplot j of the current page
+        """
+        return self.page * self.per_page + j
+
+    def show_page(self, page):
+        """
+        Displays the objects of a page. Updates the existing subplots instead of creating new ones
+        """
+        self.page = min(max(page, 0), self.n_pages - 1)
+        for j, (subp, image) in enumerate(zip(self.axes, self.images)):
+            i = self.index(j)
+            if i >= self.n_tiles:
+                subp.set_visible(False)
+                continue
+            subp.set_visible(True)
+            image.set_data(self.tiles[i])
+            image.set_clim(*self.clims[i])
+            subp.set_title(self.titles[i])
+            if not self.blitting():
+                self.lines[j].set_visible(bool(self.deselected[i]))
+
+        title = self.path or ""
+        if self.n_pages > 1:
+            title = f"{title}\nPage {self.page + 1}/{self.n_pages} (use the arrow keys to change page)"
+        self.fig.suptitle(title)
+        self.fig.canvas.draw_idle()
+
+    def on_draw(self, event):
+        """
+        Saves the background of every subplot after a full redraw, and draws the marks of the deselected objects
+        """
+        canvas = self.fig.canvas
+        if not self.blitting():
+            return
+        self.backgrounds = [canvas.copy_from_bbox(subp.bbox) for subp in self.axes]
+        for j, (subp, line) in enumerate(zip(self.axes, self.lines)):
+            i = self.index(j)
+            if i < self.n_tiles and self.deselected[i]:
+                subp.draw_artist(line)
+        canvas.blit(self.fig.bbox)
+
+    def redraw_tile(self, j):
+        """
+        Redraws only subplot j
+        """
+        canvas = self.fig.canvas
+        if not self.blitting():
+            # No blitting: the marks are drawn as normal artists
+            self.lines[j].set_visible(bool(self.deselected[self.index(j)]))
+            canvas.draw_idle()
+            return
+        if not self.backgrounds:  # Not drawn yet: the marks are drawn by on_draw
+            canvas.draw_idle()
+            return
+
+        subp = self.axes[j]
+        canvas.restore_region(self.backgrounds[j])
+        if self.deselected[self.index(j)]:
+            subp.draw_artist(self.lines[j])
+        canvas.blit(subp.bbox)
+
+    def on_click(self, event):
+        """
+        Executed when user clicks on an object.
+        Changes status of the object from selected to deselected (or vice versa)
+        and draws a red line over the image.
+        """
+        if event.inaxes not in self.axes:  # Catches when user does not click on an image
+            return
+
+        # Finds clicked axes
+        j = self.axes.index(event.inaxes)
+        i = self.index(j)
+        if i >= self.n_tiles:
+            return
+
+        self.deselected[i] = not self.deselected[i]
+        self.redraw_tile(j)
+
+    def on_key(self, event):
+        """
+        Page navigation
+        """
+        if event.key in ("right", "n", "pagedown", " "):
+            self.show_page(self.page + 1)
+        elif event.key in ("left", "p", "pageup", "backspace"):
+            self.show_page(self.page - 1)
+        elif event.key == "home":
+            self.show_page(0)
+        elif event.key == "end":
+            self.show_page(self.n_pages - 1)
+        elif event.key in ("q", "escape", "enter"):
+            plt.close(self.fig)
+
+
+def filter_cells(img, mask, cells_df, path=None, tiles=None, per_page=TILES_PER_PAGE):
     """
     Displays segmented objects. Allows for manual filtering
     of irrelevant objects based on their CALCULATED VOLUME
@@ -40,61 +208,21 @@ def filter_cells(img, mask, cells_df, path=None):
     :param mask: original segmentation mask
     :param cells_df: DataFrame with volume data
     :param path: path of the analyzed files. Will be used as the plot title
+    :param tiles: images of the objects already calculated by make_tiles (e.g. prepared in the background).
+    None calculates them
+    :param per_page: number of objects displayed on each page of the selection window
     :return cells_df: DataFrame with updated "ManualFilter" column (True for deselected objects)
     """
-
-    img_size = img.shape[0]
-
-    n_cells = len(cells_df["Volume"])
-
-    # List of objects to be excluded. Updated upon user click.
-    global preselection
-    preselection = [False] * n_cells
-
-    # Plotting parameters
-    rows = np.ceil(np.sqrt(n_cells))
-    columns = rows
-    fig = plt.figure(figsize=(16, 9))  # Adapts these parameters for smaller screens
-    fig.suptitle(path)
-
     centers = cells_df[["Center X", "Center Y"]].to_numpy()
+    if tiles is None:
+        tiles = make_tiles(img, mask, centers)
 
-    # Saves subplots in a list to be able to access them
-    global ax
-    ax = []
-
-    j = 0
-    for i, pix in enumerate(centers):
-
-        # Adds new empty plot to selection window
-        subp = fig.add_subplot(rows, columns, j + 1)
-
-        # Formatting options
-        subp.set_yticklabels([])
-        subp.set_xticklabels([])
-        subp.set_title(f"Cell: {str(i)} ({int(cells_df['Volume'][i])} µm3)")
-        ax.append(subp)
-
-        # Gets center coordinates of object
-        x = int(pix[0])
-        y = int(pix[1])
-
-        # Gets 200x200 pixel area around object
-        [x0, x1, y0, y1] = auto.get_bg_box(x, y, img_size=img_size)
-        select = img[x0:x1, y0:y1]
-        msk_img = select * (mask[x0:x1, y0:y1] > 0)
-
-        plt.imshow(msk_img)
-
-        # Uncomments next line to draw point to identify cell
-        # plt.scatter(100, 100, s=1, color="red")
-
-        j += 1  # Updates counter of displayed objects
-
-    cid = fig.canvas.mpl_connect('button_press_event', on_click)  # Listens for click on object
+    titles = [f"Cell: {i} ({int(volume)} µm3)" for i, volume in enumerate(cells_df["Volume"])]
 
+    gallery = CellGallery(tiles, titles, path=path, per_page=per_page)
     plt.show()
 
-    cells_df["ManualFilter"] = preselection
+    # List of objects to be excluded
+    cells_df["ManualFilter"] = list(gallery.deselected)
 
     return cells_df
@@ -0,0 +1,151 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import mahotas as mh
+import numpy as np
+from scipy.io import loadmat
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+
+NORM_FILE = "frame1.mat"  # Normalization file generated by the MATLAB normalization script
+HDF5_SIGNATURE = b"\x89HDF\r\n\x1a\n"
+
+
+def is_hdf5(mat_file):
+    """
+    Checks if a .mat file was saved in the v7.3 (HDF5) format.
+    MATLAB writes a 512 bytes header before the HDF5 signature.
+    """
+    with open(mat_file, "rb") as f:
+        for offset in (0, 512):
+            f.seek(offset)
+            if f.read(len(HDF5_SIGNATURE)) == HDF5_SIGNATURE:
+                return True
+    return False
+
+
+def _read_hdf5_variable(f, mat_file, name):
+    """
+    Reads a variable of a v7.3 .mat file. Contiguous, uncompressed datasets are memory-mapped,
+    so only the pages that are used are read from disk.
+    MATLAB stores arrays in column-major order, so the arrays are transposed.
+    """
+    ds = f[name]
+    offset = ds.id.get_offset()
+    if ds.chunks is None and ds.compression is None and offset is not None and ds.dtype.kind in "biuf":
+        array = np.memmap(mat_file, dtype=ds.dtype, mode="r", offset=offset, shape=ds.shape)
+    else:
+        array = ds[()]
+    return array.T
+
+
+def load_variables(mat_file, variable_names):
+    """
+    Loads only the requested variables of a .mat file
+    :param mat_file: path to the .mat file
+    :param variable_names: names of the variables to load
+    :return variables: dictionary with the requested variables
+    """
+    if is_hdf5(mat_file):
+        if h5py is None:
+            raise ImportError(f"{mat_file} is a MATLAB v7.3 file. Reading it requires the h5py package. "
+                              f"Install it with: pip install h5py")
+        with h5py.File(mat_file, "r") as f:
+            return {name: _read_hdf5_variable(f, mat_file, name) for name in variable_names}
+
+    mat = loadmat(mat_file, variable_names=list(variable_names))
+    return {name: mat[name] for name in variable_names}
+
+
+def load_frame(path, norm_file=NORM_FILE):
+    """
+    Loads the normalized image and the normalization mask of a frame
+    :param path: path to the folder containing the normalization file
+    :param norm_file: name of the normalization file
+    :return image, mask: normalized image and bool mask with background = False and cells and pillars = True
+    """
+    mat = load_variables(os.path.join(path, norm_file), ["imageFlat", "deadZoneMask"])
+    image = mat["imageFlat"]
+    mask = mat["deadZoneMask"]
+
+    # Converts the mask straight to bool, without an intermediate float copy
+    if mask.dtype != bool:
+        mask = np.greater(mask, 0)
+
+    return image, mask
+
+
+def channel_file(path, fxm_prefix, prefix, norm_file=NORM_FILE):
+    """
+    :param path: path to the folder containing the normalization file
+    :param fxm_prefix: prefix of the FXm file name (e.g. FITC, for FITC-1.tif file)
+    :param prefix: prefix of the file name of the other channel (e.g. mCherry, for mCherry-1.tif file)
+    :return: image file of the other channel, named like the FXm image of the frame (Path column of the output)
+    """
+    return os.path.abspath(os.path.join(path, "..")).replace(fxm_prefix, prefix) + ".tif"
+
+
+def load_channel(path, fxm_prefix, prefix):
+    """
+    Loads the image of another channel of a frame (see channel_file)
+    """
+    return mh.imread(channel_file(path, fxm_prefix, prefix))
+
+
+class ImageCache:
+    """
+    Small in-memory LRU cache of decoded images, keyed by absolute file path.
+
+    The channels of a frame (FXm image, marker image, mask) are read through the same cache, so a file used by several
+    channels is only decoded once. Images can be read in background threads before they are needed (see load).
+    When more than max_images images are cached, the least recently used ones are dropped.
+    """
+
+    def __init__(self, max_images=12, workers=2, imread=mh.imread):
+        """
+        :param max_images: maximum number of decoded images kept in memory
+        :param workers: number of threads reading images in the background
+        :param imread: function reading an image file
+        """
+        self.max_images = max_images
+        self.imread = imread
+        self.images = OrderedDict()  # {file: Future of the decoded image}, from least to most recently used
+        self.lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+
+    def _future(self, file):
+        file = os.path.abspath(file)
+        with self.lock:
+            future = self.images.get(file)
+            if future is None:
+                future = self.pool.submit(self.imread, file)
+                self.images[file] = future
+            self.images.move_to_end(file)
+            while len(self.images) > self.max_images:
+                self.images.popitem(last=False)
+        return future
+
+    def load(self, files):
+        """
+        Starts reading images in the background
+        :param files: list of image files. None items are ignored
+        """
+        for file in files:
+            if file is not None:
+                self._future(file)
+
+    def get(self, file):
+        """
+        :return: decoded image. Waits for it if it is being read in the background
+        """
+        return self._future(file).result()
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+        self.images.clear()
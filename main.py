@@ -1,74 +1,194 @@
 import numpy as np
 import pandas as pd
 import os
+import time
 import argparse
 
-from scipy.io import loadmat
 import autoSegment as auto
+import features
 import interactive as inter
+import loader
+import output
+import pipeline
+import profiling
+import stats as st
+from cache import ResultCache
+from curation import CurationStore, curation_file
+from manifest import FrameManifest, manifest_file
+from watcher import FrameWatcher
+
+
+def measure_frame(path, pillar_height=5.6, pixel_size=0.325, bg_box=200, bg_estimator="median", bg_tile=None,
+                  shape=False, channels=(), fxm_prefix=None):
+    """
+    Loads image and mask, segments the cells and calculates their volumes (and optionally other features)
+    :param path: path to normalization file
+    :param pillar_height: Height of the microfluidic chamber in µm
+    :param pixel_size: Size of image pixel in µm given by your camera pixel size and the magnification used
+    :param bg_box: Size of the box around each cell used to calculate the local background (px)
+    :param bg_estimator: Estimator of the local background ("median" or "trimmed_mean")
+    :param bg_tile: Size of the tiles of the shared background grid (px). None calculates the exact estimator per cell
+    :param shape: if True, adds the shape descriptors of the cells (see features.shape_features)
+    :param channels: prefixes of the images of other channels (e.g. mCherry). Adds the intensity statistics of the
+    cells in every channel (see features.channel_features)
+    :param fxm_prefix: prefix of the FXm file name, replaced by the prefix of every channel to find its image
+    :return image, mask, volumes: normalized image, normalization mask and DataFrame with volume data
+    """
+
+    # Load MATLAB normalization data (default). Only the image and the mask are read from the file
+    # If you have your own normalized images, load using mh.imread(os.path.join(path, "image.tif"))
+    with profiling.stage("load_frame", frame=path):
+        image, mask = loader.load_frame(path)
+
+    # Gets selections from normalization mask
+    with profiling.stage("segment", frame=path):
+        cells = auto.segment(mask)
+
+    # Calculates volumes. The sums over the cells share the foreground pixels with the other features
+    with profiling.stage("get_volume", frame=path):
+        sums = auto.LabelSums(cells)
+        volumes = auto.get_volume(image, mask, cells, pillar_height=pillar_height, pixel_size=pixel_size,
+                                  bg_box=bg_box, bg_estimator=bg_estimator, bg_tile=bg_tile, sums=sums)
+
+    # Other features of the cells, from the same segmentation
+    if (shape or channels) and not volumes.empty:
+        with profiling.stage("features", frame=path):
+            images = {prefix: loader.load_channel(path, fxm_prefix, prefix) for prefix in channels}
+            table = features.cell_features(cells, mask, volumes[["Center X", "Center Y"]].to_numpy(), images,
+                                           shape=shape, pixel_size=pixel_size, bg_box=bg_box,
+                                           bg_estimator=bg_estimator, bg_tile=bg_tile, sums=sums)
+            volumes = pd.concat([volumes, table], axis=1)
+
+    return image, mask, volumes
 
 
-def analyze_experiment(path, manual=False, pillar_height=5.6, pixel_size=0.325):
+def prepare_frame(path, tiles=True, **kwargs):
+    """
+    Measures a frame and crops its objects for the manual selection window.
+    Used to prepare the next frame in the background while the user filters the current one
+    :param path: path to normalization file
+    :param tiles: if False, does not crop the objects (no window will be opened)
+    :param kwargs: parameters of measure_frame
+    :return image, mask, volumes, tiles: outputs of measure_frame and images of the objects (see interactive.make_tiles)
+    """
+    image, mask, volumes = measure_frame(path, **kwargs)
+
+    if not tiles or volumes.empty:
+        tiles = None
+    else:
+        with profiling.stage("make_tiles", frame=path):
+            tiles = inter.make_tiles(image, mask, volumes[["Center X", "Center Y"]].to_numpy())
+
+    return image, mask, volumes, tiles
+
+
+def analyze_experiment(path, manual=False, pillar_height=5.6, pixel_size=0.325, bg_box=200, bg_estimator="median",
+                       bg_tile=None, shape=False, channels=(), fxm_prefix=None, measured=None, tiles=None, cache=None,
+                       out_ext=".tsv", curation=None, headless=False):
     """
     Loads image and mask, calculates volumes and decides whether or not to analyze objects manually
     :param path: path to normalization file
     :param manual: manual analysis flag. If True, calls interactive functions to manually select the objects
     :param pillar_height: Height of the microfluidic chamber in µm
     :param pixel_size: Size of image pixel in µm given by your camera pixel size and the magnification used
+    :param bg_box: Size of the box around each cell used to calculate the local background (px)
+    :param bg_estimator: Estimator of the local background ("median" or "trimmed_mean")
+    :param bg_tile: Size of the tiles of the shared background grid (px). None calculates the exact estimator per cell
+    :param shape: if True, adds the shape descriptors of the cells (see measure_frame)
+    :param channels: prefixes of the images of other channels (see measure_frame)
+    :param fxm_prefix: prefix of the FXm file name (see measure_frame)
+    :param measured: (image, mask, volumes) already returned by measure_frame (e.g. prefetched in the background)
+    :param tiles: images of the objects for the manual selection window, already calculated by prepare_frame
+    :param cache: ResultCache used to skip frames already analyzed with the same parameters (automatic mode only)
+    :param out_ext: extension of the frame output file (see output.FORMATS)
+    :param curation: CurationStore of the manual decisions. Frames reviewed before are not displayed again, and the
+    decisions of the new ones are saved as soon as their window is closed (manual mode only)
+    :param headless: only applies the decisions saved in curation, without opening any window. Raises ValueError if
+    the frame was not reviewed (manual mode only)
     :return volumes: DataFrame with volume data and manual or automatic filter
     """
 
-    # Load MATLAB normalization data (default)
-    # If you have your own normalized images, load using mh.imread(os.path.join(path, "image.tif"))
-    mat = loadmat(os.path.join(path, "frame1.mat"))
-    image = mat["imageFlat"]
-    mask = mat["deadZoneMask"]
-
-    mask = mask > 0
-
     # Output variables
     segm_path = os.path.join(path, "../Segmentation")
-    segm_file = "py_data_Auto.tsv"
-
-    # Gets selections from normalization mask
-    cells = auto.segment(mask)
-
-    # Calculates volumes
-    volumes = auto.get_volume(image, mask, cells, pillar_height=pillar_height, pixel_size=pixel_size)
+    segm_file = "py_data_Auto" + out_ext
+
+    # Skips unchanged frames analyzed before
+    if cache is not None and not manual:
+        # The images of the other channels are inputs of the frame too
+        channel_files = [loader.channel_file(path, fxm_prefix, prefix) for prefix in channels]
+        key = cache.key(os.path.join(path, "frame1.mat"), files=channel_files, pillar_height=pillar_height,
+                        pixel_size=pixel_size, bg_box=bg_box, bg_estimator=bg_estimator, bg_tile=bg_tile, shape=shape,
+                        channels=list(channels), fxm_prefix=fxm_prefix)
+        volumes = cache.get(key)
+        if volumes is not None:
+            if not volumes.empty:
+                volumes['Path'] = os.path.abspath(os.path.join(path, ".."))
+                output.save_table(volumes, os.path.join(segm_path, segm_file))  # Save
+            return volumes
+
+    if measured is None:
+        measured = measure_frame(path, pillar_height=pillar_height, pixel_size=pixel_size, bg_box=bg_box,
+                                 bg_estimator=bg_estimator, bg_tile=bg_tile, shape=shape, channels=channels,
+                                 fxm_prefix=fxm_prefix)
+    image, mask, volumes = measured
 
     if volumes.empty:
+        if cache is not None and not manual:
+            cache.put(key, pd.DataFrame({}))
         return pd.DataFrame({})
 
+    frame = os.path.abspath(os.path.join(path, ".."))
+
     if manual:
-        # Displays objects for manual filtering by the user
-        volumes = inter.filter_cells(image, mask, volumes, path=path)
-        segm_file = f"py_data_Manual.tsv"
+        decisions = curation.lookup(frame, volumes["ID"]) if curation is not None else None
+        if decisions is not None:
+            # Reviewed in a previous session
+            volumes["ManualFilter"] = decisions
+        elif headless:
+            raise ValueError("The objects of this frame were not reviewed in a previous manual session")
+        else:
+            # Displays objects for manual filtering by the user
+            with profiling.stage("manual_filter", frame=path):
+                volumes = inter.filter_cells(image, mask, volumes, path=path, tiles=tiles)
+            if curation is not None:
+                curation.record(frame, volumes["ID"], volumes["ManualFilter"])
+        segm_file = "py_data_Manual" + out_ext
 
     # Adds folder name column
-    volumes['Path'] = os.path.abspath(os.path.join(path, ".."))
+    volumes['Path'] = frame
+
+    with profiling.stage("save_frame", frame=path):
+        output.save_table(volumes, os.path.join(segm_path, segm_file))  # Save
 
-    volumes.to_csv(os.path.join(segm_path, segm_file), sep="\t")  # Save
+    if cache is not None and not manual:
+        cache.put(key, volumes)
 
     return volumes
 
 
-def print_output_stats(data, filter_name):
+def print_output_stats(data, filter_name, summary=None, n_boot=0, ci=0.95, seed=0):
     """
-    Prints the output of the analysis extracted from pd.DataFrame.describe()
+    Prints the statistics of the volumes of the cells accepted by a filter column
+    :param data: DataFrame with the volume data
+    :param filter_name: filter column (True for discarded objects)
+    :param summary: statistics of the accepted cells (row of stats.summarize). None calculates them
+    :param n_boot: number of resamples of the bootstrap confidence intervals. 0 does not print them
+    :param ci: confidence level of the bootstrap intervals
+    :param seed: seed of the random generator of the bootstrap
     """
+    if summary is None:
+        summary = st.summarize(data["Volume"], data[filter_name] == False, n_boot=n_boot, ci=ci, seed=seed).iloc[0]
+
+    cell_count = int(summary["count"])
+    mean_vol = summary["mean"]
+    std_vol = summary["std"]
+    min_vol = summary["min"]
+    Q1_vol = summary["25%"]
+    med_vol = summary["50%"]
+    mad = summary["mad"]
+    Q3_vol = summary["75%"]
+    max_vol = summary["max"]
 
-    stats = data.loc[data[filter_name] == False, "Volume"].describe()
-
-    cell_count = int(stats["count"])
-    mean_vol = stats["mean"]
-    std_vol = stats["std"]
-    min_vol = stats["min"]
-    Q1_vol = stats["25%"]
-    med_vol = stats["50%"]
-    mad = data.loc[data[filter_name] == False, "Volume"].mad()
-    Q3_vol = stats["75%"]
-    max_vol = stats["max"]
-    
     print(f"Total number\n{'of objects:':16}{len(data)}")
     print(f"{'Accepted cells:':16}{cell_count:d}")
     print()
@@ -81,119 +201,95 @@ def print_output_stats(data, filter_name):
     print(f"{'3rd quartile:':16}{Q3_vol:.1f} µm3")
     print(f"{'Max. volume:':16}{max_vol:.1f} µm3")
 
+    if "mean_low" in summary:
+        print()
+        print(f"Bootstrap {ci * 100:g} % confidence intervals:")
+        print(f"{'Mean volume:':16}[{summary['mean_low']:.1f}, {summary['mean_high']:.1f}] µm3")
+        print(f"{'Median:':16}[{summary['median_low']:.1f}, {summary['median_high']:.1f}] µm3")
 
-# User interaction and parameter logic
-parser = argparse.ArgumentParser(description="Analyze images for S. pombe volume measurement.")
-parser.add_argument("path", type=str, help="Path to images directory")
-parser.add_argument("pillar", type=float, help="Height of the microfluidic chamber in µm")
-parser.add_argument("--pixel", type=float, help="Size of image pixel in µm given by your camera pixel size and the "
-                                                "magnification used", required=False)
-
-group = parser.add_mutually_exclusive_group()
-group.add_argument("-t", "--thresholds", type=float, action="append", nargs='?',
-                   help="IQR factor to automatically filter outliers. It sets thresholds using the IQR method (t*IQR). "
-                        "Lower thresholds are more restrictive.")
-group.add_argument("-m", "--manual", action="store_true", help="Use manual filtering instead of automatic detection.")
-
-
-# Change defaults depending on your setup
-parser.set_defaults(
-    pixel=0.325,  # Pixel size of your images (µm)
-    thresholds=[1]  # List of thresholds to use for automatic outlier detection
-)
-
-args = parser.parse_args()
-
-analysis_dir = args.path
-pillar_height = args.pillar
-pixel_size = args.pixel
-thresholds = sorted([float(t) for t in set(args.thresholds)])
-manual = args.manual
-
-if not os.path.isdir(analysis_dir):
-    print(f"The analysis directory does not exist.")
-    exit()
-
-
-norm_file = "frame1.mat"  # Normalization file that the script will look for
 
+def load_previous(df_file, manifest, frames, norm_file="frame1.mat"):
+    """
+    Reads the rows of the frames analyzed in a previous run (incremental and watch modes).
+    Changed or deleted frames are removed from the manifest and their rows are dropped.
+    :param df_file: experiment output file
+    :param manifest: FrameManifest of the output file
+    :param frames: list of the folders containing a normalization file
+    :param norm_file: name of the normalization file
+    :return previous, todo: DataFrame with the rows still valid, without the filter columns (None if there is no
+    previous run), and folders of the frames to analyze
+    """
+    if not manifest.frames or manifest.partial is not None or not os.path.exists(df_file):
+        # Frames recorded in the partial file of an interrupted watch run are not in the output: starts again
+        manifest.frames = {}
+        manifest.partial = None
+        return None, frames
 
-df = pd.DataFrame({})
+    todo, removed = manifest.split(frames, norm_file)
+    for root in removed:
+        manifest.remove(root, norm_file)
 
-# File finding
-for root, dirs, files in os.walk(analysis_dir):
-    for file in files:
-        if file.endswith(norm_file):
-            print(root)
-            try:
-                v = analyze_experiment(root, manual, pillar_height=pillar_height, pixel_size=pixel_size)
-            except Exception as e:
-                print(f"Image could not be analyzed due to an exception:\n{e}")
-                continue
-            if v.empty:
-                print(f"No cells in image")
-                continue
-            if df.empty:
-                df = v
-            else:
-                df = df.append(v, ignore_index=True)
-
-print()
+    previous = output.load_table(df_file)
+    removed_paths = [os.path.abspath(os.path.join(root, "..")) for root in removed]
+    previous = previous.loc[~previous["Path"].isin(removed_paths)]
+    previous = previous.drop(columns=[c for c in previous.columns if c.startswith("AutoFilterIQR_")])
+    return previous, todo
 
-if df.empty:
-    print(f"No data obtained. Did not find any {norm_file} files inside the analysis directory.")
-    print(f"Have you normalized your images?")
-    exit()
 
-strain_dir = os.path.abspath(os.path.join(root, "../.."))
-df_file = strain_dir + f"_A.tsv"
+def merge_frames(previous, df, frames):
+    """
+    Merges new rows with the previous ones, in the same order as a full analysis
+    :param previous: DataFrame with the rows of the frames analyzed before, or None
+    :param df: DataFrame with the new rows
+    :param frames: list of the folders containing a normalization file, in os.walk order
+    """
+    if previous is not None:
+        df = pd.concat([previous, df], ignore_index=True)
+    order = {os.path.abspath(os.path.join(root, "..")): i for i, root in enumerate(frames)}
+    return df.iloc[np.argsort(df["Path"].map(order).to_numpy(), kind="stable")].reset_index(drop=True)
 
-# Saves data and prints output information
-if manual:
-    df_file = strain_dir + f"_M.tsv"
 
-    print("-" * 40)
-    print("MANUALLY FILTERED DATA")
-    print("-" * 40)
+def add_auto_filters(df, thresholds):
+    """
+    Adds one AutoFilterIQR_<th> column per threshold, True for the outliers of the volume distribution (th*IQR)
+    :return iqr: stats.IQRFilter with the outlier masks of all the thresholds
+    """
+    iqr = st.iqr_filter(df["Volume"], thresholds)
+    for th, outliers in zip(thresholds, iqr.outliers):
+        df[f"AutoFilterIQR_{th}"] = outliers
+    return iqr
 
-    print_output_stats(df, "ManualFilter")
 
-    #print(f"Total number of objects: {len(df)}")
-    #print(f"Accepted cells:")
-    #print(df.loc[df["ManualFilter"] == False, "Volume"].describe())
-    print()
-else:
-    df_file = strain_dir + f"_A.tsv"
+def print_auto_filter_stats(df, thresholds, n_boot=0, ci=0.95, seed=0):
+    """
+    Adds the automatic filter columns (see add_auto_filters) and prints the statistics of each threshold
+    :param n_boot, ci, seed: parameters of the bootstrap confidence intervals (see print_output_stats)
+    """
+    iqr = add_auto_filters(df, thresholds)
 
-    # Calculates IQR
-    Q1 = np.percentile(df["Volume"], 25)
-    med = np.percentile(df["Volume"], 50)
-    Q3 = np.percentile(df["Volume"], 75)
-    IQR = Q3 - Q1
+    # Statistics of the accepted cells and number of outliers of all the thresholds at once
+    summaries = st.summarize(df["Volume"], ~iqr.outliers, n_boot=n_boot, ci=ci, seed=seed)
+    n_low = iqr.low.sum(axis=1)
+    n_high = iqr.high.sum(axis=1)
 
-    for th in thresholds:
-        # Finds outliers
-        outliers = np.logical_or(df["Volume"] > (Q3 + IQR * th), df["Volume"] < (Q1 - IQR * th))
+    for i, th in enumerate(thresholds):
+        filter_name = f"AutoFilterIQR_{th}"  # Name of the column that includes IQR threshold (th*IQR)
 
         # Calculate number of outliers
-        n_total_outliers = len(df.loc[outliers])
-        n_high_outliers = len(df.loc[(df["Volume"] > Q3 + th * IQR)])
-        n_low_outliers = len(df.loc[(df["Volume"] < Q1 - th * IQR)])
+        n_low_outliers = int(n_low[i])
+        n_high_outliers = int(n_high[i])
+        n_total_outliers = n_low_outliers + n_high_outliers
 
         # Calculate percentages of outliers
         p_total_outliers = n_total_outliers / len(df) * 100
         p_high_outliers = n_high_outliers / len(df) * 100
         p_low_outliers = n_low_outliers / len(df) * 100
 
-        # Add column with automatic filter
-        filter_name = f"AutoFilterIQR_{th}"  # Name of the column that includes IQR threshold (th*IQR)
-        df[filter_name] = outliers
-        
         print("-" * 40)
         print(f"AUTOMATICALLY FILTERED DATA ({th}*IQR):")
         print("-" * 40)
 
-        print_output_stats(df, filter_name)
+        print_output_stats(df, filter_name, summaries.iloc[i], ci=ci)
 
         # Prints outlier percentages
         print()
@@ -202,6 +298,482 @@ else:
         print(f"{'Total outliers:':16}{n_total_outliers:d} ({p_total_outliers:.1f} %)")
         print()
 
-print("-" * 40)
-print(f'Output file: {df_file}')
-df.to_csv(df_file, sep="\t")
+
+def save_summary(df, by, summary_file, n_boot=0, ci=0.95, seed=0):
+    """
+    Saves the volume statistics of the cells accepted by every filter column, for every combination of the values of
+    the by columns (see stats.grouped_summary)
+    :param n_boot, ci, seed: parameters of the bootstrap confidence intervals (see print_output_stats)
+    """
+    missing = [c for c in by if c not in df.columns]
+    if missing:
+        print(f"Summary not saved. Columns not found: {', '.join(missing)}")
+        return
+    filters = [c for c in df.columns if c.startswith("AutoFilterIQR_") or c == "ManualFilter"]
+    output.save_table(st.grouped_summary(df, by, filters=filters, n_boot=n_boot, ci=ci, seed=seed), summary_file)
+    print(f"Summary file: {summary_file}")
+
+
+def resume_partial(df_file, manifest, frames, keep=("Volume", "Path"), norm_file="frame1.mat"):
+    """
+    Continues the partial output file of a watch run that was interrupted before writing its output (e.g. killed).
+    Changed or deleted frames are removed from the manifest and their rows are dropped.
+    :param df_file: experiment output file (.tsv or .parquet)
+    :param manifest: FrameManifest of the output file
+    :param frames: list of the folders containing a normalization file
+    :param keep: columns kept in memory, including Volume and Path
+    :param norm_file: name of the normalization file
+    :return data, rows, dropped: StreamWriter with the rows recorded in the manifest (None if there is no run to
+    continue), indices of the rows of every frame, and list of arrays with the indices of the replaced rows
+    """
+    if manifest.partial is None:
+        return None, {}, []
+
+    try:
+        data = output.StreamWriter(df_file, keep=keep, resume=manifest.partial["rows"])
+    except (ValueError, OSError) as e:
+        print(f"Could not continue the interrupted watch run, all the frames are analyzed again:\n{e}")
+        return None, {}, []
+    print(f"Continuing the interrupted watch run from {data.partial}")
+
+    dropped = [np.asarray(manifest.partial["dropped"], dtype=np.int64)]
+    valid = np.flatnonzero(_valid_rows(len(data), dropped))
+    paths = pd.Series(data.data()["Path"].to_numpy()[valid])
+    rows = {path: valid[i] for path, i in paths.groupby(paths, sort=False).indices.items()}
+
+    _, removed = manifest.split(frames, norm_file)
+    for root in removed:
+        manifest.remove(root, norm_file)
+        frame = os.path.abspath(os.path.join(root, ".."))
+        if frame in rows:
+            dropped.append(rows.pop(frame))
+    return data, rows, dropped
+
+
+def _valid_rows(n_rows, dropped):
+    """
+    :param n_rows: number of rows written
+    :param dropped: list of arrays with the indices of the replaced rows
+    :return valid: bool array, False for the replaced rows
+    """
+    valid = np.ones(n_rows, dtype=bool)
+    if dropped:
+        valid[np.concatenate(dropped)] = False
+    return valid
+
+
+def watch_experiment(analysis_dir, thresholds, jobs=1, interval=5., settle=2., timeout=0, out_ext=".tsv",
+                     cache=None, norm_file="frame1.mat", keep=(), pillar_height=5.6, pixel_size=0.325,
+                     **frame_params):
+    """
+    Analyzes the frames as they are written by the normalization script, and appends their rows to the experiment
+    output file until interrupted (Ctrl+C). A frame written again replaces its previous rows. The filter columns are
+    added when the watch stops. The manifest is saved after every batch of frames, so that a killed run continues from
+    the partial output file
+    :param analysis_dir: path to the experiment directory
+    :param thresholds: IQR factors of the automatic filters
+    :param jobs: number of worker processes
+    :param interval: time between two scans of the folder (s)
+    :param settle: time a normalization file must stay unchanged before it is analyzed (s)
+    :param timeout: stops when no frame has been found or analyzed for timeout seconds. 0 watches until interrupted
+    :param out_ext: extension of the experiment output file (see output.FORMATS)
+    :param cache: ResultCache used to skip frames already analyzed with the same parameters
+    :param norm_file: name of the normalization file
+    :param keep: columns of the returned table, besides Volume and the filter columns (e.g. the summary columns)
+    :return df, df_file: Volume, keep and filter columns of the final experiment table (None if no cell was found) and
+    the path of the table
+    """
+    watcher = FrameWatcher(analysis_dir, norm_file, interval=interval, settle=settle)
+    print(f"Watching {analysis_dir} for new {norm_file} files. Press Ctrl+C to stop.")
+    print()
+
+    data = None
+    df_file = None
+    manifest = None
+    try:
+        start = time.monotonic()
+        frames = pipeline.find_frames(analysis_dir, norm_file)
+        while not frames:
+            idle = time.monotonic() - start
+            if timeout and idle >= timeout:
+                return None, df_file
+            watcher.wait(timeout - idle if timeout else None)
+            frames = pipeline.find_frames(analysis_dir, norm_file)
+
+        strain_dir = os.path.abspath(os.path.join(frames[-1], "../.."))
+        df_file = strain_dir + "_A" + out_ext
+
+        # Continues a previous incremental or watch run. The rows of a watch run that was killed are still in the
+        # partial output file
+        manifest = FrameManifest(manifest_file(df_file), pillar_height=pillar_height, pixel_size=pixel_size,
+                                 **frame_params)
+        columns = list(dict.fromkeys(["Volume", "Path"] + list(keep)))
+        data, rows, dropped = None, {}, []
+        if out_ext != output.FORMATS["feather"]:
+            data, rows, dropped = resume_partial(df_file, manifest, frames, columns, norm_file)
+
+        if data is None:
+            previous, _ = load_previous(df_file, manifest, frames, norm_file)
+
+            # New rows are appended to the output instead of rewriting it. Feather files cannot be written in chunks:
+            # their rows are kept in memory and written when the watch stops
+            if out_ext == output.FORMATS["feather"]:
+                data = output.ColumnBuffer()
+            else:
+                data = output.StreamWriter(df_file, keep=columns)
+
+            # Rows of every frame, so that the rows of a frame written again are replaced by the new ones
+            if previous is not None and not previous.empty:
+                rows = previous.groupby("Path", sort=False, observed=True).indices
+                data.append(previous)
+
+        watcher.known.update(manifest.frames)
+        if manifest.frames:
+            print(f"{len(manifest.frames)} frames already analyzed")
+
+        for batch in pipeline.watch_frames(analyze_experiment, watcher, jobs=jobs, timeout=timeout,
+                                           pillar_height=pillar_height, pixel_size=pixel_size, cache=cache,
+                                           out_ext=out_ext, **frame_params):
+            for root, v, e in batch:
+                print(root)
+                frame = os.path.abspath(os.path.join(root, ".."))
+                if frame in rows:
+                    dropped.append(rows.pop(frame))
+                if e is not None:
+                    print(f"Image could not be analyzed due to an exception:\n{e}")
+                    manifest.remove(root, norm_file)
+                    continue
+                manifest.add(root, norm_file)
+                if v.empty:
+                    print(f"No cells in image")
+                    continue
+                rows[frame] = np.arange(len(data), len(data) + len(v))
+                data.append(v)
+
+            valid = _valid_rows(len(data), dropped)
+            if isinstance(data, output.StreamWriter):
+                # Records the frames after every batch, so that a killed run can be resumed
+                data.flush()
+                manifest.partial = {"rows": len(data), "dropped": np.flatnonzero(~valid).tolist()}
+                manifest.save()
+            if not valid.any():
+                continue
+
+            # Running statistics, from the volumes kept in memory
+            volumes = (data.to_frame() if isinstance(data, output.ColumnBuffer) else data.data())["Volume"][valid]
+            iqr = st.iqr_filter(volumes, thresholds)
+            accepted = ", ".join(f"{int(n)} ({th}*IQR)" for th, n in zip(thresholds, (~iqr.outliers).sum(axis=1)))
+            print(f"{len(manifest.frames)} frames, {len(volumes)} objects, median volume {volumes.median():.1f} µm3, "
+                  f"accepted cells: {accepted}")
+            print()
+    except KeyboardInterrupt:
+        print()
+    finally:
+        watcher.stop()
+        if cache is not None:
+            cache.evict()  # The workers only know the size of the results they wrote
+
+    if data is None or data.empty:
+        return None, df_file
+
+    # Adds the filter columns, calculated over the whole table without the replaced rows, and records the frames of
+    # the output
+    valid = _valid_rows(len(data), dropped)
+    if isinstance(data, output.ColumnBuffer):
+        df = data.to_frame().loc[valid].reset_index(drop=True)
+        add_auto_filters(df, thresholds)
+        output.save_table(df, df_file)
+        df = df[["Volume"] + [c for c in keep if c in df.columns] + [f"AutoFilterIQR_{th}" for th in thresholds]]
+    else:
+        df = data.data().loc[valid]
+        add_auto_filters(df, thresholds)
+        data.close(df[[f"AutoFilterIQR_{th}" for th in thresholds]], drop=np.flatnonzero(~valid))
+        df = df.reset_index(drop=True)
+    manifest.partial = None
+    manifest.save()
+
+    if df.empty:
+        return None, df_file
+    return df, df_file
+
+
+if __name__ == "__main__":
+    # User interaction and parameter logic
+    parser = argparse.ArgumentParser(description="Analyze images for S. pombe volume measurement.")
+    parser.add_argument("path", type=str, help="Path to images directory")
+    parser.add_argument("pillar", type=float, help="Height of the microfluidic chamber in µm")
+    parser.add_argument("--pixel", type=float, help="Size of image pixel in µm given by your camera pixel size and the "
+                                                    "magnification used", required=False)
+    parser.add_argument("--bg-box", type=int, help="Size of the box around each cell used to calculate the local "
+                                                   "background (px)", required=False)
+    parser.add_argument("--bg-estimator", choices=["median", "trimmed_mean"],
+                        help="Estimator of the local background", required=False)
+    parser.add_argument("--bg-tile", type=int, help="Approximate the local background with a shared grid of tiles "
+                                                    "of this size (px), faster on dense frames. By default, the exact "
+                                                    "estimator is calculated on the box of every cell",
+                        required=False)
+
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument("-t", "--thresholds", type=float, action="append", nargs='?',
+                       help="IQR factor to automatically filter outliers. It sets thresholds using the IQR method "
+                            "(t*IQR). Lower thresholds are more restrictive.")
+    group.add_argument("-m", "--manual", action="store_true",
+                       help="Use manual filtering instead of automatic detection.")
+    parser.add_argument("--shape", action="store_true",
+                        help="Add the shape descriptors of every cell (area, length, width, aspect ratio, eccentricity)")
+    parser.add_argument("-c", "--channel", type=str, action="append", default=[], metavar="PREFIX",
+                        help="Add the intensity statistics and local background of every cell in the images of "
+                             "another channel (e.g. mCherry, for mCherry-1.tif files). Can be used several times")
+    parser.add_argument("-f", "--fxm-prefix", type=str,
+                        help="Prefix of the FXm file name (e.g. FITC, for FITC-1.tif file), replaced by the prefix of "
+                             "each channel to find its images")
+    parser.add_argument("--reapply", action="store_true",
+                        help="Manual mode: apply the decisions saved by previous manual sessions without opening any "
+                             "window. Frames that were not reviewed are skipped")
+    parser.add_argument("-j", "--jobs", type=int, help="Number of frames analyzed in parallel in automatic mode. In "
+                                                       "manual mode, the next frame is always prepared in the "
+                                                       "background.", required=False)
+    parser.add_argument("--format", choices=list(output.FORMATS), help="Format of the output files",
+                        required=False)
+    parser.add_argument("--cache", type=str, nargs="?", const="", metavar="CACHE_DIR",
+                        help="Reuse the results of frames analyzed before with the same parameters (automatic mode). "
+                             "Results are stored in CACHE_DIR (default: <path>/.fxm_cache)")
+    parser.add_argument("--cache-size", type=float, help="Maximum size of the cache (MB)", required=False)
+    parser.add_argument("--cache-hash", action="store_true",
+                        help="Identify cached frames by the hash of their content instead of their modification time")
+    parser.add_argument("--profile", type=str, nargs="?", const="", metavar="TRACE",
+                        help="Record the time and memory of every stage of the analysis. Saves the trace to "
+                             "TRACE.json and TRACE.csv (default: <strain>_profile)")
+    parser.add_argument("--profile-stage", type=str, action="append", default=[], metavar="STAGE",
+                        help="Also profile a stage (e.g. get_volume) with cProfile. Can be used several times")
+    parser.add_argument("--incremental", action="store_true",
+                        help="Only analyze the frames that are new or have changed since the last run and add them to "
+                             "the existing output file (automatic mode)")
+    parser.add_argument("--watch", type=float, nargs="?", const=5., metavar="INTERVAL",
+                        help="Keep running and analyze the frames as soon as they are normalized (automatic mode). "
+                             "The folder is scanned every INTERVAL seconds (default: 5)")
+    parser.add_argument("--settle", type=float,
+                        help="Time a normalization file must stay unchanged before it is analyzed in watch mode (s)",
+                        required=False)
+    parser.add_argument("--watch-timeout", type=float,
+                        help="Stop watching when no new frame has been found for this time (s). 0 watches until "
+                             "interrupted", required=False)
+    parser.add_argument("-s", "--summary-by", type=str, action="append", default=[], metavar="COLUMN",
+                        help="Save the volume statistics of the accepted cells of every filter for every value of "
+                             "COLUMN (e.g. Path) to <strain>_A_summary or <strain>_M_summary. Can be used several "
+                             "times")
+    parser.add_argument("--bootstrap", type=int, nargs="?", const=10000, metavar="N",
+                        help="Calculate bootstrap confidence intervals of the mean and median volumes with N "
+                             "resamples (default: 10000)")
+    parser.add_argument("--ci", type=float, help="Confidence level of the bootstrap intervals", required=False)
+    parser.add_argument("--seed", type=int, help="Seed of the random generator of the bootstrap", required=False)
+    parser.add_argument("--stream", action="store_true",
+                        help="Write the rows of each frame straight to the output file instead of keeping all the "
+                             "data in memory")
+
+
+    # Change defaults depending on your setup
+    parser.set_defaults(
+        pixel=0.325,  # Pixel size of your images (µm)
+        bg_box=200,  # Size of the box used to calculate the local background (px)
+        bg_estimator="median",  # Estimator of the local background
+        bg_tile=0,  # Size of the tiles of the background grid (px). 0 calculates the exact background of every cell
+        thresholds=[1],  # List of thresholds to use for automatic outlier detection
+        jobs=1,  # Number of worker processes in automatic mode
+        format="tsv",  # Format of the experiment output file
+        cache_size=1024,  # Maximum size of the result cache (MB)
+        settle=2,  # Time a normalization file must stay unchanged before it is analyzed in watch mode (s)
+        watch_timeout=0,  # Time without new frames after which watch mode stops (s)
+        ci=0.95,  # Confidence level of the bootstrap intervals
+        seed=0  # Seed of the bootstrap, for reproducible intervals
+    )
+
+    args = parser.parse_args()
+
+    analysis_dir = args.path
+    pillar_height = args.pillar
+    pixel_size = args.pixel
+    # Parameters of the analysis of every frame
+    frame_params = {"bg_box": args.bg_box, "bg_estimator": args.bg_estimator, "bg_tile": args.bg_tile or None,
+                    "shape": args.shape, "channels": args.channel, "fxm_prefix": args.fxm_prefix}
+    boot_params = {"n_boot": args.bootstrap or 0, "ci": args.ci, "seed": args.seed}
+    thresholds = sorted([float(t) for t in set(args.thresholds)])
+    manual = args.manual
+    jobs = args.jobs
+    out_ext = output.FORMATS[args.format]
+    stream = args.stream
+    incremental = args.incremental and not manual
+
+    headless = args.reapply
+    if args.channel and not args.fxm_prefix:
+        print("Use -f to give the prefix of the FXm images: it is replaced by the prefix of each channel to find "
+              "its images.")
+        exit()
+    if headless and not manual:
+        print("--reapply is only available in manual mode (-m).")
+        exit()
+    if args.incremental and manual:
+        print("Incremental mode is only available in automatic mode. Analyzing all the frames.")
+    if args.watch is not None and manual:
+        print("Watch mode is only available in automatic mode.")
+        exit()
+    if incremental and stream:
+        print("Incremental mode keeps the output in memory: --stream is ignored.")
+        stream = False
+    if stream and args.format == "feather":
+        print("Feather files cannot be written in chunks: --stream is ignored. Use --format parquet to stream the "
+              "output.")
+        stream = False
+
+    cache = None
+    if args.cache is not None and not manual:
+        cache = ResultCache(args.cache or os.path.join(analysis_dir, ".fxm_cache"), max_size=args.cache_size,
+                            content_hash=args.cache_hash)
+
+    if not os.path.isdir(analysis_dir):
+        print(f"The analysis directory does not exist.")
+        exit()
+
+    if args.profile is not None:
+        profiling.enable(cprofile_stages=args.profile_stage)
+        if jobs > 1:
+            print("Profiling: the stages of frames analyzed in worker processes are not recorded. Use -j 1 to "
+                  "profile every stage.")
+
+
+    norm_file = "frame1.mat"  # Normalization file that the script will look for
+
+    if args.watch is not None:
+        df, df_file = watch_experiment(analysis_dir, thresholds, jobs=jobs, interval=args.watch, settle=args.settle,
+                                       timeout=args.watch_timeout, out_ext=out_ext, cache=cache, norm_file=norm_file,
+                                       keep=args.summary_by, pillar_height=pillar_height, pixel_size=pixel_size,
+                                       **frame_params)
+        if df is None:
+            print(f"No data obtained.")
+            exit()
+
+        print_auto_filter_stats(df, thresholds, **boot_params)
+        print("-" * 40)
+        print(f'Output file: {df_file}')
+        if args.summary_by:
+            save_summary(df, args.summary_by, os.path.splitext(df_file)[0] + "_summary" + out_ext, **boot_params)
+        profiling.report(args.profile or f"{os.path.splitext(df_file)[0]}_profile")
+        exit()
+
+    # File finding
+    frames = pipeline.find_frames(analysis_dir, norm_file)
+
+    if not frames:
+        print(f"No data obtained. Did not find any {norm_file} files inside the analysis directory.")
+        print(f"Have you normalized your images?")
+        exit()
+
+    strain_dir = os.path.abspath(os.path.join(frames[-1], "../.."))
+    df_file = strain_dir + ("_M" if manual else "_A") + out_ext
+
+    # Incremental mode: keeps the rows of the frames processed before and only analyzes the new or changed ones
+    previous = None
+    manifest = None
+    todo = frames
+    if incremental:
+        manifest = FrameManifest(manifest_file(df_file), pillar_height=pillar_height, pixel_size=pixel_size,
+                                 **frame_params)
+        previous, todo = load_previous(df_file, manifest, frames, norm_file)
+
+        print(f"Incremental mode: {len(frames) - len(todo)} frames already analyzed, {len(todo)} new or changed "
+              f"frames")
+        print()
+
+    # Per-frame results are collected column by column (or written straight to the output file)
+    # and concatenated once at the end
+    if stream:
+        data = output.StreamWriter(df_file, keep=(["Volume", "ManualFilter"] if manual else ["Volume"]) +
+                                   args.summary_by)
+    else:
+        data = output.ColumnBuffer()
+
+    curation = None
+    if manual:
+        # Decisions are saved after every frame. Frames reviewed before are not displayed again
+        curation = CurationStore(curation_file(df_file), "ManualFilter")
+        if len(curation):
+            print(f"Curation file: {curation.file} ({len(curation)} frames already reviewed)")
+            print()
+
+    if headless:
+        results = pipeline.map_frames(prepare_frame, frames, jobs=jobs, tiles=False, pillar_height=pillar_height,
+                                      pixel_size=pixel_size, **frame_params)
+    elif manual:
+        # The next frame is measured and cropped in the background while the user filters the current one
+        results = pipeline.prefetch(prepare_frame, frames, pillar_height=pillar_height, pixel_size=pixel_size,
+                                    **frame_params)
+    else:
+        results = pipeline.map_frames(analyze_experiment, todo, jobs=jobs, pillar_height=pillar_height,
+                                      pixel_size=pixel_size, cache=cache, out_ext=out_ext, **frame_params)
+
+    for root, v, e in results:
+        print(root)
+        if e is None and manual:
+            try:
+                v = analyze_experiment(root, manual, pillar_height=pillar_height, pixel_size=pixel_size,
+                                       measured=v[:3], tiles=v[3], out_ext=out_ext, curation=curation,
+                                       headless=headless, **frame_params)
+            except Exception as exc:
+                e = exc
+        if e is not None:
+            print(f"Image could not be analyzed due to an exception:\n{e}")
+            continue
+        if manifest is not None:
+            manifest.add(root, norm_file)
+        if v.empty:
+            print(f"No cells in image")
+            continue
+        data.append(v)
+
+    if cache is not None:
+        cache.evict()  # The workers only know the size of the results they wrote
+
+    print()
+
+    if data.empty and (previous is None or previous.empty):
+        print(f"No data obtained. Did not find any {norm_file} files inside the analysis directory.")
+        print(f"Have you normalized your images?")
+        exit()
+
+    df = data.data() if stream else data.to_frame()
+
+    if previous is not None:
+        df = merge_frames(previous, df, frames)
+
+    # Saves data and prints output information
+    with profiling.stage("statistics"):
+        if manual:
+            print("-" * 40)
+            print("MANUALLY FILTERED DATA")
+            print("-" * 40)
+
+            print_output_stats(df, "ManualFilter", **boot_params)
+
+            #print(f"Total number of objects: {len(df)}")
+            #print(f"Accepted cells:")
+            #print(df.loc[df["ManualFilter"] == False, "Volume"].describe())
+            print()
+        else:
+            print_auto_filter_stats(df, thresholds, **boot_params)
+
+    print("-" * 40)
+    print(f'Output file: {df_file}')
+    with profiling.stage("save_output"):
+        if stream:
+            data.close(df.drop(columns=["Volume", "ManualFilter"] + args.summary_by, errors="ignore"))
+        else:
+            output.save_table(df, df_file)
+
+    if manifest is not None:
+        manifest.save()
+
+    if args.summary_by:
+        save_summary(df, args.summary_by, strain_dir + ("_M_summary" if manual else "_A_summary") + out_ext,
+                     **boot_params)
+
+    profiling.report(args.profile or f"{strain_dir}_profile")
@@ -0,0 +1,93 @@
+import json
+import os
+
+
+# Increase when a change in the analysis invalidates the processed frames
+MANIFEST_VERSION = 1
+
+
+def manifest_file(df_file):
+    """
+    :param df_file: experiment output file (e.g. <strain>_A.tsv)
+    :return: path of its manifest (e.g. <strain>_A.tsv.manifest.json)
+    """
+    return df_file + ".manifest.json"
+
+
+class FrameManifest:
+    """
+    Record of the normalization files already included in an experiment output file, with their size and
+    modification time, used by the incremental mode of main.py to only analyze new or changed frames.
+    The record is discarded if the analysis parameters change.
+    """
+
+    def __init__(self, file, **params):
+        """
+        :param file: manifest file (see manifest_file)
+        :param params: analysis parameters that change the result (pillar height, pixel size, background...)
+        """
+        self.file = file
+        self.params = json.loads(json.dumps(params, default=str))  # Same types as when read back from the file
+        self.frames = {}
+        # Rows of the temporary "<output>.partial" file holding the frames while the watch mode is running, and indices
+        # of its replaced rows: {"rows": n, "dropped": [...]}. None when the frames are in the output file
+        self.partial = None
+
+        try:
+            with open(file) as f:
+                saved = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+
+        if saved.get("version") == MANIFEST_VERSION and saved.get("params") == self.params:
+            self.frames = saved.get("frames", {})
+            self.partial = saved.get("partial")
+
+    @staticmethod
+    def stamp(mat_file):
+        st = os.stat(mat_file)
+        return [st.st_size, st.st_mtime_ns]
+
+    def split(self, frames, norm_file="frame1.mat"):
+        """
+        Compares the frames found in the experiment with the processed ones
+        :param frames: list of the folders containing a normalization file
+        :param norm_file: name of the normalization file
+        :return todo, removed: folders of the new or changed frames, and folders of processed frames that changed or
+        no longer exist (their rows must be removed from the output)
+        """
+        found = {os.path.abspath(os.path.join(root, norm_file)): root for root in frames}
+
+        todo = []
+        removed = []
+        for mat_file, root in found.items():
+            if mat_file not in self.frames:
+                todo.append(root)
+            elif self.frames[mat_file] != self.stamp(mat_file):
+                todo.append(root)
+                removed.append(root)
+
+        for mat_file in self.frames:
+            if mat_file not in found:
+                removed.append(os.path.dirname(mat_file))
+
+        return todo, removed
+
+    def add(self, root, norm_file="frame1.mat"):
+        """
+        Records a processed frame
+        """
+        mat_file = os.path.abspath(os.path.join(root, norm_file))
+        self.frames[mat_file] = self.stamp(mat_file)
+
+    def remove(self, root, norm_file="frame1.mat"):
+        self.frames.pop(os.path.abspath(os.path.join(root, norm_file)), None)
+
+    def save(self):
+        tmp = f"{self.file}.{os.getpid()}.tmp"
+        with open(tmp, "w") as f:
+            saved = {"version": MANIFEST_VERSION, "params": self.params, "frames": self.frames}
+            if self.partial is not None:
+                saved["partial"] = self.partial
+            json.dump(saved, f, indent=1)
+        os.replace(tmp, self.file)
@@ -0,0 +1,355 @@
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+
+FORMATS = {"tsv": ".tsv", "parquet": ".parquet", "feather": ".feather"}
+
+# Types of the known columns of the outputs, used by the binary formats (Parquet and Feather).
+# Text columns repeated on many rows are stored as categories, i.e. dictionary-encoded in the files.
+# The AutoFilterIQR_<th> columns are bool
+COLUMN_TYPES = {"Path": "category",
+                "ID": "int64",
+                "Center X": "float64",
+                "Center Y": "float64",
+                "Pillar Height": "float64",
+                "Pixel Size": "float64",
+                "Background": "float64",
+                "Surface": "int64",
+                "Intensity": "float64",
+                "Volume": "float64",
+                "ManualFilter": "bool",
+                "Group": "int64",
+                "Borderline": "bool",
+                "DetecDivGroup": "category"}
+
+
+def _require_pyarrow():
+    """
+    Imports pyarrow, which is only needed for Parquet and Feather outputs
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("Parquet and Feather outputs require the pyarrow package. Install it with: "
+                          "pip install pyarrow")
+    return pyarrow
+
+
+def is_binary(path):
+    """
+    :return: True if path is a Parquet or Feather file
+    """
+    return path.endswith((FORMATS["parquet"], FORMATS["feather"]))
+
+
+def typed(df):
+    """
+    Casts the known columns of a DataFrame to the types of the binary formats (see COLUMN_TYPES).
+    Integer columns with missing values are kept as float
+    :return df: DataFrame with the new types
+    """
+    types = {}
+    for name in df.columns:
+        t = "bool" if name.startswith("AutoFilterIQR_") else COLUMN_TYPES.get(name)
+        if t is None or df[name].dtype == t:
+            continue
+        if t in ("int64", "bool") and df[name].isna().any():
+            continue
+        types[name] = t
+    return df.astype(types) if types else df
+
+
+def save_table(df, path):
+    """
+    Saves a DataFrame as .tsv, .parquet or .feather, depending on the extension of path.
+    Binary formats use the types of COLUMN_TYPES and do not store the index
+    :param df: DataFrame to save
+    :param path: output file
+    """
+    if path.endswith(FORMATS["parquet"]):
+        _require_pyarrow()
+        typed(df).to_parquet(path, index=False)
+    elif path.endswith(FORMATS["feather"]):
+        _require_pyarrow()
+        typed(df).reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path, sep="\t")
+
+
+def load_table(path):
+    """
+    Reads a table saved by save_table
+    :param path: .tsv, .parquet or .feather file
+    :return df: DataFrame
+    """
+    if path.endswith(FORMATS["parquet"]):
+        _require_pyarrow()
+        return pd.read_parquet(path)
+    if path.endswith(FORMATS["feather"]):
+        _require_pyarrow()
+        return pd.read_feather(path)
+    return pd.read_csv(path, sep="\t", index_col=0, float_precision="round_trip")
+
+
+class ColumnBuffer:
+    """
+    Collects the per-frame DataFrames column by column and builds the full table with a single concatenation,
+    instead of copying the accumulated table every time a frame is added.
+    """
+
+    def __init__(self, columns=None):
+        """
+        :param columns: names of the columns to keep. None keeps all of them
+        """
+        self.keep = columns
+        self.columns = {}
+        self.n_rows = 0
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def empty(self):
+        return self.n_rows == 0
+
+    def append(self, df):
+        """
+        Adds the rows of a DataFrame. Columns missing in some of the frames are filled with NaN
+        """
+        n = len(df)
+        names = df.columns if self.keep is None else [c for c in self.keep if c in df.columns]
+        for name in names:
+            if name not in self.columns:
+                # New column: fills the previous frames
+                self.columns[name] = [np.full(self.n_rows, np.nan)] if self.n_rows else []
+            self.columns[name].append(df[name].to_numpy())
+
+        for name, chunks in self.columns.items():
+            if name not in names:
+                chunks.append(np.full(n, np.nan))
+
+        self.n_rows += n
+
+    def to_frame(self):
+        """
+        :return df: DataFrame with all the collected rows, indexed from 0
+        """
+        return pd.DataFrame({name: np.concatenate(chunks) if chunks else np.zeros(0)
+                             for name, chunks in self.columns.items()})
+
+
+def _arrow_table(df, schema=None):
+    """
+    Converts a DataFrame to a pyarrow Table with the types of the binary formats, for chunked writes
+    :param schema: schema of the previous chunks. None creates it from df, with 32-bit dictionary indices so
+    the next chunks can have more categories
+    :return table, schema
+    """
+    import pyarrow as pa
+
+    df = typed(df)
+    if schema is None:
+        schema = pa.Schema.from_pandas(df, preserve_index=False)
+        for i, field in enumerate(schema):
+            if pa.types.is_dictionary(field.type):
+                schema = schema.set(i, field.with_type(pa.dictionary(pa.int32(), field.type.value_type)))
+    return pa.Table.from_pandas(df, schema=schema, preserve_index=False), schema
+
+
+class StreamWriter:
+    """
+    Writes the per-frame DataFrames straight to the output file, so memory does not grow with the number of cells.
+    Only the columns needed for the final statistics are kept in memory.
+    Rows are written to a temporary "<path>.partial" file (a folder of Parquet parts for Parquet outputs, as a Parquet
+    file can only be read once it is closed). Columns that depend on the whole data set (e.g. the IQR filters) are
+    added in a final pass over that file, chunk by chunk.
+    """
+
+    def __init__(self, path, keep=("Volume",), chunksize=100000, resume=0):
+        """
+        :param path: output file (.tsv or .parquet)
+        :param keep: columns kept in memory
+        :param chunksize: number of rows read at once in the final pass
+        :param resume: number of rows of the partial file of an interrupted run to continue from. Rows written after
+        them are discarded. 0 starts a new file
+        """
+        self.path = path
+        self.partial = path + ".partial"
+        self.parquet = path.endswith(FORMATS["parquet"])
+        if path.endswith(FORMATS["feather"]):
+            raise ValueError("Feather files cannot be written in chunks. Use the Parquet format to stream the output")
+        self.chunksize = chunksize
+        self.kept = ColumnBuffer(columns=list(keep))
+        self.n_rows = 0
+        self._writer = None
+        self._schema = None
+        self._parts = []
+
+        if self.parquet:
+            _require_pyarrow()
+        if resume:
+            self._resume(resume)
+        elif os.path.isdir(self.partial):
+            shutil.rmtree(self.partial)
+        elif os.path.exists(self.partial):
+            os.remove(self.partial)
+
+    def __len__(self):
+        return self.n_rows
+
+    @property
+    def empty(self):
+        return self.n_rows == 0
+
+    def _resume(self, rows):
+        """
+        Reads back the kept columns of the first rows of the partial file, and removes the rows written after them
+        """
+        if not os.path.exists(self.partial):
+            raise ValueError(f"{self.partial} does not exist")
+
+        if self.parquet:
+            import pyarrow.parquet as pq
+
+            discard = False
+            for name in sorted(os.listdir(self.partial)):
+                part = os.path.join(self.partial, name)
+                try:
+                    n = pq.ParquetFile(part).metadata.num_rows
+                except Exception:  # Part being written when the run was interrupted
+                    discard = True
+                discard = discard or self.n_rows + n > rows
+                if discard:
+                    os.remove(part)
+                    continue
+                schema = pq.read_schema(part)
+                df = pq.read_table(part, columns=[c for c in self.kept.keep if c in schema.names]).to_pandas()
+                self.kept.append(df)
+                self.n_rows += n
+                self._parts.append(part)
+                if self._schema is None:
+                    self._schema = schema
+        else:
+            keep = self.kept.keep
+            total = 0
+            for chunk in pd.read_csv(self.partial, sep="\t", index_col=0, chunksize=self.chunksize,
+                                     usecols=lambda c: c in keep or c.startswith("Unnamed"),
+                                     float_precision="round_trip"):
+                total += len(chunk)
+                chunk = chunk.iloc[:rows - self.n_rows]
+                self.kept.append(chunk)
+                self.n_rows += len(chunk)
+            if total > rows == self.n_rows:
+                # Rows written after the last record of the interrupted run, maybe incomplete
+                tmp = f"{self.partial}.{os.getpid()}.tmp"
+                for i, chunk in enumerate(pd.read_csv(self.partial, sep="\t", index_col=0, chunksize=self.chunksize,
+                                                      nrows=rows, float_precision="round_trip")):
+                    chunk.to_csv(tmp, sep="\t", mode="a", header=i == 0)
+                os.replace(tmp, self.partial)
+
+        if self.n_rows != rows:
+            raise ValueError(f"{self.partial} has {self.n_rows} rows, {rows} expected")
+
+    def append(self, df):
+        """
+        Writes the rows of a DataFrame at the end of the output
+        """
+        df = df.reset_index(drop=True)
+        df.index += self.n_rows
+
+        if self.parquet:
+            import pyarrow.parquet as pq
+
+            table, self._schema = _arrow_table(df, self._schema)
+            if self._writer is None:
+                os.makedirs(self.partial, exist_ok=True)
+                self._parts.append(os.path.join(self.partial, f"part-{len(self._parts):05d}.parquet"))
+                self._writer = pq.ParquetWriter(self._parts[-1], self._schema)
+            self._writer.write_table(table)
+        else:
+            df.to_csv(self.partial, sep="\t", mode="a", header=self.n_rows == 0)
+
+        self.kept.append(df)
+        self.n_rows += len(df)
+
+    def flush(self):
+        """
+        Makes the rows written so far readable from the partial file (e.g. before recording them in a manifest)
+        """
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def data(self):
+        """
+        :return df: DataFrame with the columns kept in memory
+        """
+        return self.kept.to_frame()
+
+    def close(self, extra=None, drop=None):
+        """
+        Finishes the output file
+        :param extra: DataFrame indexed like the written rows with columns to add to the output, or None
+        :param drop: indices of written rows to leave out of the output (e.g. rows of a frame analyzed again), or
+        None. The remaining rows are numbered again from 0
+        """
+        self.flush()
+
+        if self.n_rows == 0:
+            return
+
+        if extra is None or extra.empty or len(extra.columns) == 0:
+            extra = None
+        if drop is not None and len(drop):
+            keep = np.ones(self.n_rows, dtype=bool)
+            keep[np.asarray(drop, dtype=np.int64)] = False
+        else:
+            keep = None
+
+        if self.parquet:
+            import pyarrow.parquet as pq
+
+            if extra is None and keep is None and len(self._parts) == 1:
+                os.replace(self._parts[0], self.path)
+            else:
+                writer = None
+                schema = None
+                start = 0
+                for part in self._parts:
+                    for batch in pq.ParquetFile(part).iter_batches(batch_size=self.chunksize):
+                        chunk = batch.to_pandas()
+                        chunk.index = np.arange(start, start + len(chunk))
+                        start += len(chunk)
+                        if extra is not None:
+                            chunk = chunk.join(extra)
+                        if keep is not None:
+                            chunk = chunk.loc[keep[chunk.index.to_numpy()]]
+                        table, schema = _arrow_table(chunk, schema)
+                        if writer is None:
+                            writer = pq.ParquetWriter(self.path, schema)
+                        writer.write_table(table)
+                writer.close()
+            shutil.rmtree(self.partial)
+            return
+
+        if extra is None and keep is None:
+            os.replace(self.partial, self.path)
+            return
+
+        if os.path.exists(self.path):
+            os.remove(self.path)
+        written = 0
+        for i, chunk in enumerate(pd.read_csv(self.partial, sep="\t", index_col=0, chunksize=self.chunksize,
+                                              float_precision="round_trip")):
+            if extra is not None:
+                chunk = chunk.join(extra)
+            if keep is not None:
+                chunk = chunk.loc[keep[chunk.index.to_numpy()]]
+                chunk.index = np.arange(written, written + len(chunk))
+                written += len(chunk)
+            chunk.to_csv(self.path, sep="\t", mode="a", header=i == 0)
+        os.remove(self.partial)
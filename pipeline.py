@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+
+def find_frames(analysis_dir, norm_file="frame1.mat"):
+    """
+    Looks for normalization files inside the analysis directory
+    :param analysis_dir: path to the experiment directory
+    :param norm_file: name of the normalization file
+    :return frames: list of the folders containing a normalization file, in os.walk order
+    """
+    frames = []
+    for root, dirs, files in os.walk(analysis_dir):
+        for file in files:
+            if file.endswith(norm_file):
+                frames.append(root)
+    return frames
+
+
+def _call(func, path, kwargs):
+    """
+    Calls func on one frame and returns the exception instead of raising it
+    """
+    try:
+        return func(path, **kwargs), None
+    except Exception as e:
+        return None, e
+
+
+def map_frames(func, paths, jobs=1, **kwargs):
+    """
+    Applies func to every frame, optionally spreading the frames across a pool of processes.
+    Results are always yielded in the order of paths.
+    :param func: function called as func(path, **kwargs). Must be importable (picklable) when jobs > 1
+    :param paths: list of frame folders
+    :param jobs: number of worker processes. 1 processes the frames serially in this process
+    :param kwargs: keyword arguments passed to func
+    :return: generator of (path, result, exception) tuples. exception is None if the frame was processed
+    """
+    if jobs is None or jobs <= 1 or len(paths) <= 1:
+        for path in paths:
+            result, error = _call(func, path, kwargs)
+            yield path, result, error
+        return
+
+    with ProcessPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(_call, func, path, kwargs) for path in paths]
+        for path, future in zip(paths, futures):
+            try:
+                result, error = future.result()
+            except Exception as e:  # The worker died or the result could not be sent back
+                result, error = None, e
+            yield path, result, error
+
+
+def watch_frames(func, watcher, jobs=1, timeout=0, **kwargs):
+    """
+    Applies func to the frames found by a FrameWatcher as soon as they are written, in a pool of processes.
+    :param func: function called as func(path, **kwargs). Must be importable (picklable)
+    :param watcher: FrameWatcher of the experiment folder
+    :param jobs: number of worker processes
+    :param timeout: stops when no frame has been found or analyzed for timeout seconds. 0 watches until interrupted
+    :param kwargs: keyword arguments passed to func
+    :return: generator of lists of (path, result, exception) tuples, one list each time some frames are finished
+    """
+    with ProcessPoolExecutor(max_workers=max(jobs or 1, 1)) as pool:
+        running = {}
+        last_activity = time.monotonic()
+        while True:
+            for path in watcher.ready():
+                running[pool.submit(_call, func, path, kwargs)] = path
+                last_activity = time.monotonic()
+
+            if not running:
+                idle = time.monotonic() - last_activity
+                if timeout and idle >= timeout:
+                    return
+                watcher.wait(timeout - idle if timeout else None)
+                continue
+
+            done, _ = wait(running, timeout=watcher.interval, return_when=FIRST_COMPLETED)
+            batch = []
+            for future in done:
+                path = running.pop(future)
+                try:
+                    result, error = future.result()
+                except Exception as e:  # The worker died or the result could not be sent back
+                    result, error = None, e
+                batch.append((path, result, error))
+            if batch:
+                last_activity = time.monotonic()
+                yield batch
+
+
+def prefetch(func, paths, **kwargs):
+    """
+    Applies func to every frame in a background thread, one frame ahead of the consumer.
+    Used in interactive modes to prepare the next frame while the user is working on the current one.
+    :param func: function called as func(path, **kwargs)
+    :param paths: list of frame folders
+    :param kwargs: keyword arguments passed to func
+    :return: generator of (path, result, exception) tuples, in the order of paths
+    """
+    def start(path):
+        box = {}
+
+        def work():
+            box["result"], box["error"] = _call(func, path, kwargs)
+
+        thread = threading.Thread(target=work, daemon=True)
+        thread.start()
+        return thread, box
+
+    pending = start(paths[0]) if paths else None
+    for i, path in enumerate(paths):
+        thread, box = pending
+        thread.join()
+
+        # Starts working on the next frame before handing this one over
+        pending = start(paths[i + 1]) if i + 1 < len(paths) else None
+
+        yield path, box["result"], box["error"]
+
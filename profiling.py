@@ -0,0 +1,183 @@
+import cProfile
+import csv
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+# Profiling state. Disabled by default: stage() does nothing until enable() is called
+_enabled = False
+_records = []
+_profilers = {}
+_active_profiler = [None]  # Only one cProfile profiler can run at a time
+_local = threading.local()  # Stacks of running stages of each thread (frames are prefetched in threads)
+
+
+def _stacks():
+    """
+    :return peaks, frames: stacks with the traced memory peak and the frame of the running stages of this thread
+    """
+    if not hasattr(_local, "peaks"):
+        _local.peaks = []
+        _local.frames = [None]
+    return _local.peaks, _local.frames
+
+
+def enable(cprofile_stages=()):
+    """
+    Starts recording the stages of the analysis
+    :param cprofile_stages: names of the stages that are also profiled with cProfile
+    """
+    global _enabled
+    _enabled = True
+    for name in cprofile_stages:
+        _profilers[name] = cProfile.Profile()
+    tracemalloc.start()
+
+
+def _max_rss():
+    """
+    :return: peak resident memory of the process (MB)
+    """
+    if resource is None:
+        return float("nan")
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024  # Bytes on macOS, kB on Linux
+
+
+def _reset_peak():
+    if hasattr(tracemalloc, "reset_peak"):  # Python >= 3.9
+        tracemalloc.reset_peak()
+
+
+@contextmanager
+def stage(name, frame=None):
+    """
+    Records the wall time, CPU time and peak memory of a stage of the analysis.
+    Stages can be nested; nested stages are recorded under the frame of the outer stage.
+    The traced memory peak is shared by all threads, so it is approximate for stages running in parallel.
+    :param name: name of the stage
+    :param frame: frame being processed (e.g. path of the normalization file)
+    """
+    if not _enabled:
+        yield
+        return
+
+    _peaks, _frames = _stacks()
+    frame = frame if frame is not None else _frames[-1]
+    _frames.append(frame)
+
+    # Keeps the peak of the running stage before measuring this one
+    _, peak = tracemalloc.get_traced_memory()
+    if _peaks:
+        _peaks[-1] = max(_peaks[-1], peak)
+    _reset_peak()
+    _peaks.append(0)
+    start_mem, _ = tracemalloc.get_traced_memory()
+
+    profiler = _profilers.get(name)
+    if profiler is not None and _active_profiler[0] is None:
+        _active_profiler[0] = profiler
+        profiler.enable()
+    else:
+        profiler = None
+
+    wall = time.perf_counter()
+    cpu = time.process_time()
+    try:
+        yield
+    finally:
+        wall = time.perf_counter() - wall
+        cpu = time.process_time() - cpu
+
+        if profiler is not None:
+            profiler.disable()
+            _active_profiler[0] = None
+
+        _, peak = tracemalloc.get_traced_memory()
+        peak = max(peak, _peaks.pop())
+        if _peaks:
+            _peaks[-1] = max(_peaks[-1], peak)
+        _reset_peak()
+        _frames.pop()
+
+        _records.append({"stage": name,
+                         "frame": frame,
+                         "wall_s": wall,
+                         "cpu_s": cpu,
+                         "peak_mb": peak / 1024 ** 2,
+                         "alloc_mb": (peak - start_mem) / 1024 ** 2,
+                         "max_rss_mb": _max_rss()})
+
+
+def summary():
+    """
+    Aggregates the recorded stages by name
+    :return: list of dictionaries with the number of calls, total and mean times and the maximum peak of each stage
+    """
+    stages = {}
+    for r in _records:
+        s = stages.setdefault(r["stage"], {"stage": r["stage"], "calls": 0, "wall_s": 0., "cpu_s": 0., "peak_mb": 0.})
+        s["calls"] += 1
+        s["wall_s"] += r["wall_s"]
+        s["cpu_s"] += r["cpu_s"]
+        s["peak_mb"] = max(s["peak_mb"], r["peak_mb"])
+    for s in stages.values():
+        s["mean_wall_s"] = s["wall_s"] / s["calls"]
+    return list(stages.values())
+
+
+def report(trace_file=None):
+    """
+    Prints the summary table and saves the trace
+    :param trace_file: output path without extension. Saves <trace_file>.json (all records and summary),
+    <trace_file>.csv (all records) and <trace_file>_<stage>.prof (cProfile stats)
+    """
+    if not _enabled:
+        return
+
+    print("-" * 40)
+    print("PROFILE")
+    print("-" * 40)
+    print(f"{'Stage':24}{'Calls':>7}{'Wall (s)':>11}{'CPU (s)':>10}{'Mean (ms)':>11}{'Peak (MB)':>11}")
+    for s in summary():
+        print(f"{s['stage']:24}{s['calls']:7d}{s['wall_s']:11.2f}{s['cpu_s']:10.2f}{s['mean_wall_s'] * 1000:11.1f}"
+              f"{s['peak_mb']:11.1f}")
+    print(f"{'Max. resident memory:':24}{_max_rss():.0f} MB")
+
+    for name, profiler in _profilers.items():
+        if not profiler.getstats():
+            continue  # The stage never ran
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(20)
+        print()
+        print(f"cProfile of stage '{name}':")
+        print(out.getvalue())
+
+    if trace_file is None:
+        return
+
+    with open(trace_file + ".json", "w") as f:
+        json.dump({"records": _records, "summary": summary()}, f, indent=1)
+
+    with open(trace_file + ".csv", "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=["stage", "frame", "wall_s", "cpu_s", "peak_mb", "alloc_mb",
+                                               "max_rss_mb"])
+        writer.writeheader()
+        writer.writerows(_records)
+
+    for name, profiler in _profilers.items():
+        if profiler.getstats():
+            profiler.dump_stats(f"{trace_file}_{name}.prof")
+
+    print(f"Profile trace: {trace_file}.json, {trace_file}.csv")
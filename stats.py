@@ -0,0 +1,315 @@
+from collections import namedtuple
+
+import numpy as np
+import pandas as pd
+
+
+# Statistics calculated by summarize, in the order of pd.DataFrame.describe() (plus the mean absolute deviation)
+SUMMARY = ["count", "mean", "std", "min", "25%", "50%", "75%", "max", "mad"]
+
+
+class IQRFilter(namedtuple("IQRFilter", ["thresholds", "q1", "q3", "codes", "low", "high"])):
+    """
+    Result of iqr_filter
+    thresholds: IQR factors, shape (t,)
+    q1, q3: quartiles of every group, shape (g,)
+    codes: group of every value, shape (n,)
+    low, high: masks of the values below Q1 - th*IQR and above Q3 + th*IQR, shape (t, n)
+    """
+    __slots__ = ()
+
+    @property
+    def iqr(self):
+        return self.q3 - self.q1
+
+    @property
+    def outliers(self):
+        return self.low | self.high
+
+
+def _lerp(a, b, t):
+    """
+    Linear interpolation between a and b, computed like np.percentile so that the results are identical
+    """
+    diff = b - a
+    return np.where(t >= 0.5, b - diff * (1 - t), a + diff * t)
+
+
+def _segments(counts):
+    """
+    :param counts: number of values of every segment of a flat array
+    :return starts, segment: first index of every segment, and segment of every value
+    """
+    starts = np.concatenate([[0], np.cumsum(counts)[:-1]]).astype(np.intp)
+    segment = np.repeat(np.arange(len(counts)), counts)
+    return starts, segment
+
+
+def segment_quantiles(sorted_values, counts, q):
+    """
+    Quantiles of consecutive segments of a sorted array, with the linear interpolation of np.percentile
+    :param sorted_values: flat array made of sorted segments
+    :param counts: number of values of every segment
+    :param q: quantiles to calculate (between 0 and 1), shape (m,)
+    :return quantiles: array of shape (m, segments). NaN for empty segments
+    """
+    counts = np.asarray(counts)
+    q = np.atleast_1d(np.asarray(q, dtype=float))[:, None]
+    if len(sorted_values) == 0:
+        return np.full((q.shape[0], len(counts)), np.nan)
+
+    starts, _ = _segments(counts)
+    pos = q * np.maximum(counts - 1, 0)
+    below = np.floor(pos).astype(np.intp)
+    above = np.minimum(below + 1, np.maximum(counts - 1, 0))
+    last = len(sorted_values) - 1  # Empty segments point past their end
+
+    quantiles = _lerp(sorted_values[np.minimum(starts + below, last)], sorted_values[np.minimum(starts + above, last)],
+                      pos - below)
+    quantiles[:, counts == 0] = np.nan
+    return quantiles
+
+
+def group_codes(groups, n):
+    """
+    :param groups: group of every value (array-like), or None for a single group
+    :param n: number of values
+    :return codes, names: group number of every value and name of every group
+    """
+    if groups is None:
+        return np.zeros(n, dtype=np.intp), pd.Index([None])
+    codes, names = pd.factorize(np.asarray(groups) if not isinstance(groups, pd.Series) else groups, sort=True)
+    return codes.astype(np.intp), pd.Index(names)
+
+
+def grouped_quartiles(values, codes, n_groups):
+    """
+    Q1 and Q3 of every group, with a single sort of all the values
+    :return q1, q3: arrays of shape (n_groups,)
+    """
+    order = np.lexsort((values, codes))
+    order = order[np.isfinite(values[order])]  # Like pandas, NaN values are skipped
+    counts = np.bincount(codes[order], minlength=n_groups)
+    q1, q3 = segment_quantiles(values[order], counts, [0.25, 0.75])
+    return q1, q3
+
+
+def iqr_filter(values, thresholds, groups=None):
+    """
+    Finds the outliers of a distribution for several IQR thresholds at once.
+    A value is an outlier if it is below Q1 - th*IQR or above Q3 + th*IQR, where the quartiles are those of its group
+    :param values: array of shape (n,), e.g. volumes
+    :param thresholds: IQR factors
+    :param groups: group of every value (e.g. the Path column for per-position filters). None uses all the values
+    :return: IQRFilter
+    """
+    values = np.asarray(values, dtype=float)
+    thresholds = np.asarray(thresholds, dtype=float)
+    codes, names = group_codes(groups, len(values))
+
+    q1, q3 = grouped_quartiles(values, codes, len(names))
+    iqr = q3 - q1
+
+    # Bounds of every threshold and value: shape (t, n)
+    low = values < (q1 - thresholds[:, None] * iqr)[:, codes]
+    high = values > (q3 + thresholds[:, None] * iqr)[:, codes]
+
+    return IQRFilter(thresholds, q1, q3, codes, low, high)
+
+
+def segment_bootstrap(sorted_values, counts, n_boot=10000, ci=0.95, seed=0, chunk_size=2 ** 20):
+    """
+    Bootstrap percentile confidence intervals of the mean and the median of consecutive segments of a sorted array.
+
+    Every segment is resampled n_boot times with replacement. The resampled means are drawn from index matrices, in
+    chunks of at most chunk_size indices, so the cost grows with n_boot times the number of values. The resampled
+    medians are drawn from the distribution of the order statistics of a resample, which gives the same distribution
+    without drawing every value: the k-th smallest of n resampled values is the value of rank ceil(n * U), where U
+    is the k-th smallest of n uniform values, U ~ Beta(k, n - k + 1).
+    :param sorted_values: flat array made of sorted segments
+    :param counts: number of values of every segment
+    :param n_boot: number of resamples
+    :param ci: confidence level
+    :param seed: seed of the random generator
+    :param chunk_size: maximum number of random numbers or resampled statistics held in memory at once
+    :return bounds: DataFrame with one row per segment and the columns mean_low, mean_high, median_low, median_high
+    """
+    counts = np.asarray(counts)
+    n_segments = len(counts)
+    starts, _ = _segments(counts)
+    rng = np.random.default_rng(seed)
+    q = np.array([(1 - ci) / 2, (1 + ci) / 2]) * 100
+    bounds = pd.DataFrame(np.nan, index=range(n_segments), columns=["mean_low", "mean_high", "median_low",
+                                                                      "median_high"])
+
+    # Non-empty segments are processed in batches of at most chunk_size values and chunk_size resampled statistics
+    full = np.flatnonzero(counts > 0)
+    ends = np.cumsum(counts[full])
+    step = max(chunk_size // n_boot, 1)
+    b = 0
+    while b < len(full):
+        e = min(np.searchsorted(ends, ends[b] - counts[full[b]] + chunk_size, side="right"), b + step)
+        batch = full[b:max(e, b + 1)]
+        b += len(batch)
+
+        # Means: rows of resampled indices, drawn for all the segments of the batch at once and summed per segment
+        size = counts[batch]
+        offsets = np.concatenate([[0], np.cumsum(size)[:-1]])
+        segment = np.repeat(np.arange(len(batch)), size)
+        first, length = starts[batch][segment], size[segment]
+        means = np.empty((n_boot, len(batch)))
+        rows = max(chunk_size // int(size.sum()), 1)
+        for r in range(0, n_boot, rows):
+            shape = (min(rows, n_boot - r), len(segment))
+            if len(batch) == 1:
+                index = rng.integers(starts[batch[0]], starts[batch[0]] + size[0], shape)
+            else:
+                u = rng.random(shape)
+                u *= length
+                index = u.astype(np.intp)
+                np.minimum(index, length - 1, out=index)
+                index += first
+            means[r:r + shape[0]] = np.add.reduceat(np.take(sorted_values, index), offsets, axis=1) / size
+
+        # Medians: mean of the k-th and (k+1)-th smallest values for even sizes. The (k+1)-th smallest uniform value is
+        # U + (1 - U) * Beta(1, n - k), i.e. 1 - (1 - U) * exp(-E / (n - k)) with E ~ Exp(1)
+        k = (size + 1) // 2
+        u1 = rng.beta(k, size - k + 1, size=(n_boot, len(batch)))
+        u2 = u1.copy()
+        even = np.flatnonzero(size % 2 == 0)
+        if len(even):
+            exponential = rng.standard_exponential((n_boot, len(even)))
+            u2[:, even] = 1 - (1 - u1[:, even]) * np.exp(-exponential / (size[even] - k[even]))
+        low = starts[batch] + np.clip(np.ceil(size * u1).astype(np.intp) - 1, 0, size - 1)
+        high = starts[batch] + np.clip(np.ceil(size * u2).astype(np.intp) - 1, 0, size - 1)
+        medians = (sorted_values[low] + sorted_values[high]) / 2
+
+        bounds.loc[batch, ["mean_low", "mean_high"]] = np.percentile(means, q, axis=0).T
+        bounds.loc[batch, ["median_low", "median_high"]] = np.percentile(medians, q, axis=0).T
+
+    return bounds
+
+
+def segment_summary(sorted_values, counts):
+    """
+    Summary statistics of consecutive segments of a sorted array
+    :param sorted_values: flat array made of sorted segments
+    :param counts: number of values of every segment
+    :return summary: DataFrame with one row per segment and the SUMMARY columns. The standard deviation uses
+    ddof=1, like pandas. "mad" is the mean absolute deviation around the mean (former pd.Series.mad())
+    """
+    counts = np.asarray(counts)
+    n_segments = len(counts)
+    _, segment = _segments(counts)
+
+    with np.errstate(invalid="ignore", divide="ignore"):  # Empty segments give NaN
+        mean = np.bincount(segment, weights=sorted_values, minlength=n_segments) / counts
+        dev = sorted_values - mean[segment]
+        std = np.sqrt(np.bincount(segment, weights=dev ** 2, minlength=n_segments) / (counts - 1))
+        mad = np.bincount(segment, weights=np.abs(dev), minlength=n_segments) / counts
+    std[counts < 2] = np.nan
+
+    q1, median, q3, lowest, highest = segment_quantiles(sorted_values, counts, [0.25, 0.5, 0.75, 0, 1])
+
+    return pd.DataFrame({"count": counts,
+                         "mean": mean,
+                         "std": std,
+                         "min": lowest,
+                         "25%": q1,
+                         "50%": median,
+                         "75%": q3,
+                         "max": highest,
+                         "mad": mad})
+
+
+def _selections(values, accepted):
+    """
+    :return sorted_values, counts: sorted values of every selection, concatenated, and their number. Non-finite values
+    (e.g. volumes of cells without background) are skipped, like in pd.Series.describe()
+    """
+    values = np.asarray(values, dtype=float)
+    order = np.argsort(values, kind="stable")
+    order = order[np.isfinite(values[order])]
+    if accepted is None:
+        return values[order], np.array([len(order)])
+
+    accepted = np.atleast_2d(np.asarray(accepted, dtype=bool))[:, order]
+    return np.broadcast_to(values[order], accepted.shape)[accepted], accepted.sum(axis=1)
+
+
+def summarize(values, accepted=None, n_boot=0, ci=0.95, seed=0):
+    """
+    Summary statistics of several selections of the same values (e.g. the cells accepted by every filter),
+    with a single sort
+    :param values: array of shape (n,)
+    :param accepted: bool mask of shape (n,) or (k, n) with the values of every selection. None selects all the values
+    :param n_boot: number of resamples of the bootstrap confidence intervals of the mean and the median. 0 does not
+    calculate them
+    :param ci: confidence level of the bootstrap intervals
+    :param seed: seed of the random generator of the bootstrap
+    :return summary: DataFrame with one row per selection, the SUMMARY columns (see segment_summary) and the bounds of
+    the bootstrap intervals (see segment_bootstrap)
+    """
+    sorted_values, counts = _selections(values, accepted)
+    summary = segment_summary(sorted_values, counts)
+    if n_boot:
+        summary = pd.concat([summary, segment_bootstrap(sorted_values, counts, n_boot=n_boot, ci=ci, seed=seed)],
+                            axis=1)
+    return summary
+
+
+def grouped_summary(df, by=(), value="Volume", filters=None, n_boot=0, ci=0.95, seed=0):
+    """
+    Summary statistics of every combination of grouping keys (e.g. Path, Group, DetecDivGroup), with a single
+    groupby pass and a single sort of the values
+    :param df: DataFrame with the volume data
+    :param by: grouping columns. An empty list summarizes the whole table
+    :param value: column to summarize
+    :param filters: filter columns (True for discarded objects, e.g. AutoFilterIQR_1.0). The statistics are calculated
+    on the accepted objects of every filter. None uses all the objects
+    :param n_boot: number of resamples of the bootstrap confidence intervals of the mean and the median. 0 does not
+    calculate them
+    :param ci: confidence level of the bootstrap intervals
+    :param seed: seed of the random generator of the bootstrap
+    :return summary: tidy DataFrame with one row per filter and combination of keys: the grouping columns, "Filter"
+    (if filters are given), "objects" (number of objects of the group, including discarded ones), the SUMMARY
+    columns and the bounds of the bootstrap intervals (see segment_bootstrap)
+    """
+    by = list(by)
+    values = df[value].to_numpy(dtype=float)
+
+    if by:
+        grouper = df.groupby(by, sort=True, observed=True, dropna=False)
+        codes = grouper.ngroup().to_numpy()
+        keys = grouper.size().index.to_frame(index=False)
+    else:
+        codes = np.zeros(len(df), dtype=np.intp)
+        keys = pd.DataFrame(index=range(1))
+    n_groups = len(keys)
+
+    objects = np.bincount(codes, minlength=n_groups)
+    order = np.lexsort((values, codes))
+    order = order[np.isfinite(values[order])]  # Like pandas, NaN volumes are skipped
+    sorted_values = values[order]
+    sorted_codes = codes[order]
+    finite = np.bincount(sorted_codes, minlength=n_groups)
+
+    tables = []
+    for name in filters if filters is not None else [None]:
+        if name is None:
+            selected, counts = sorted_values, finite
+        else:
+            # Keeping the accepted values of the sorted array keeps the segments sorted
+            accepted = ~df[name].to_numpy(dtype=bool)[order]
+            selected, counts = sorted_values[accepted], np.bincount(sorted_codes[accepted], minlength=n_groups)
+
+        summary = segment_summary(selected, counts)
+        if n_boot:
+            summary = pd.concat([summary, segment_bootstrap(selected, counts, n_boot=n_boot, ci=ci, seed=seed)],
+                                axis=1)
+        summary.insert(0, "objects", objects)
+        if name is not None:
+            summary.insert(0, "Filter", name)
+        tables.append(pd.concat([keys, summary], axis=1))
+
+    return pd.concat(tables, ignore_index=True)
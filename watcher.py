@@ -0,0 +1,107 @@
+import os
+import threading
+import time
+
+import pipeline
+from manifest import FrameManifest
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:
+    Observer = None
+
+
+if Observer is not None:
+    class _NormFileHandler(FileSystemEventHandler):
+        """
+        Wakes the watcher up when a normalization file is created, modified or moved into the experiment
+        """
+
+        def __init__(self, norm_file, event):
+            self.norm_file = norm_file
+            self.event = event
+
+        def on_any_event(self, event):
+            paths = [getattr(event, "src_path", ""), getattr(event, "dest_path", "")]
+            if any(str(p).endswith(self.norm_file) for p in paths):
+                self.event.set()
+
+
+class FrameWatcher:
+    """
+    Watches an experiment folder for normalization files written by the MATLAB normalization script.
+
+    A file is ready to be analyzed once its size and modification time have not changed for settle seconds.
+    Every version of a file (size and modification time) is handed over only once.
+    The folder is scanned every interval seconds. If the watchdog package is installed, file system events
+    (inotify on Linux) wake the watcher up as soon as a file is written.
+    """
+
+    def __init__(self, analysis_dir, norm_file="frame1.mat", interval=5., settle=2., known=None):
+        """
+        :param analysis_dir: path to the experiment directory
+        :param norm_file: name of the normalization file
+        :param interval: time between two scans of the folder (s)
+        :param settle: time a file must stay unchanged before it is considered completely written (s)
+        :param known: dictionary {normalization file: stamp} of the files already analyzed (see FrameManifest)
+        """
+        self.analysis_dir = analysis_dir
+        self.norm_file = norm_file
+        self.interval = interval
+        self.settle = settle
+        self.known = dict(known or {})
+        self.candidates = {}  # Files being written: {normalization file: (stamp, time the stamp was first seen)}
+        self.event = threading.Event()
+
+        self.observer = None
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(_NormFileHandler(norm_file, self.event), analysis_dir, recursive=True)
+            self.observer.start()
+
+    def ready(self):
+        """
+        Scans the folder
+        :return frames: folders of the normalization files that are new or changed, and completely written
+        """
+        now = time.monotonic()
+        frames = []
+        for root in pipeline.find_frames(self.analysis_dir, self.norm_file):
+            mat_file = os.path.abspath(os.path.join(root, self.norm_file))
+            try:
+                stamp = FrameManifest.stamp(mat_file)
+            except FileNotFoundError:  # Removed or renamed since the scan
+                continue
+            if self.known.get(mat_file) == stamp:
+                continue
+
+            seen = self.candidates.get(mat_file)
+            if seen is None or seen[0] != stamp:
+                # Files last modified long ago (e.g. before the watcher started) do not need to settle
+                if time.time() - stamp[1] / 1e9 < self.settle:
+                    self.candidates[mat_file] = (stamp, now)
+                    continue
+            elif now - seen[1] < self.settle:
+                continue
+
+            self.candidates.pop(mat_file, None)
+            self.known[mat_file] = stamp
+            frames.append(root)
+
+        return frames
+
+    def wait(self, timeout=None):
+        """
+        Waits for a file system event or for the next scan
+        :param timeout: maximum waiting time (s). The watcher waits at most interval, or settle if files are being
+        written
+        """
+        wait = min(self.interval, self.settle) if self.candidates else self.interval
+        self.event.wait(wait if timeout is None else min(wait, timeout))
+        self.event.clear()
+
+    def stop(self):
+        if self.observer is not None:
+            self.observer.stop()
+            self.observer.join()